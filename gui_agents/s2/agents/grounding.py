@@ -4,9 +4,7 @@ from collections import defaultdict
 from io import BytesIO
 from typing import Any, Dict, List, Optional, Tuple, Union
 
-import pytesseract
 from PIL import Image
-from pytesseract import Output
 
 from gui_agents.s2.memory.procedural_memory import PROCEDURAL_MEMORY
 from gui_agents.s2.core.mllm import LMMAgent
@@ -212,6 +210,9 @@ class OSWorldACI(ACI):
     # Calls pytesseract to generate word level bounding boxes for text grounding
     def get_ocr_elements(self, b64_image_data: str) -> Tuple[str, List]:
         image = Image.open(BytesIO(b64_image_data))
+        import pytesseract
+        from pytesseract import Output
+
         image_data = pytesseract.image_to_data(image, output_type=Output.DICT)
 
         # Clean text by removing leading and trailing spaces and non-alphabetical characters, but keeping punctuation
@@ -3,7 +3,6 @@ import os
 from typing import Dict, Tuple
 
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 from gui_agents.s2.core.module import BaseModule
 from gui_agents.s2.memory.procedural_memory import PROCEDURAL_MEMORY
@@ -186,6 +185,8 @@ class KnowledgeBase(BaseModule):
 
         save_embeddings(self.embeddings_path, embeddings)
 
+        from sklearn.metrics.pairwise import cosine_similarity
+
         similarities = cosine_similarity(
             instruction_embedding, np.vstack(candidate_embeddings)
         )[0]
@@ -223,6 +224,8 @@ class KnowledgeBase(BaseModule):
 
         save_embeddings(self.embeddings_path, embeddings)
 
+        from sklearn.metrics.pairwise import cosine_similarity
+
         similarities = cosine_similarity(
             instruction_embedding, np.vstack(candidate_embeddings)
         )[0]
@@ -2,7 +2,6 @@ import json
 import re
 from typing import List
 import time
-import tiktoken
 
 from typing import Tuple, List, Union, Dict
 
@@ -168,6 +167,8 @@ def parse_single_code_from_string(input_string):
 
 
 def get_input_token_length(input_string):
+    import tiktoken
+
     enc = tiktoken.encoding_for_model("gpt-4")
     tokens = enc.encode(input_string)
     return len(tokens)
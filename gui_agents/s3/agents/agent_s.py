@@ -4,6 +4,7 @@ from typing import Dict, List, Tuple
 
 from gui_agents.s3.agents.grounding import ACI
 from gui_agents.s3.agents.worker import Worker
+from gui_agents.s3.core.metrics import aggregate_usage
 
 logger = logging.getLogger("desktopenv.agent")
 
@@ -91,4 +92,18 @@ class AgentS3(UIAgent):
         # concatenate the three info dictionaries
         info = {**{k: v for d in [executor_info or {}] for k, v in d.items()}}
 
+        # Provider-reported usage of every agent involved in this step
+        info["usage"] = aggregate_usage(self._usage_metrics())
+        logger.info("STEP USAGE: %s", info["usage"]["total"])
+
         return info, actions
+
+    def _usage_metrics(self):
+        agents = [
+            self.executor.generator_agent,
+            self.executor.reflection_agent,
+            getattr(self.grounding_agent, "grounding_model", None),
+            getattr(self.grounding_agent, "text_span_agent", None),
+            getattr(getattr(self.grounding_agent, "code_agent", None), "agent", None),
+        ]
+        return [agent.metrics for agent in agents if agent is not None]
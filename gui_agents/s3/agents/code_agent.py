@@ -108,6 +108,7 @@ class CodeAgent:
         self.agent = LMMAgent(
             engine_params=self.engine_params,
             system_prompt=PROCEDURAL_MEMORY.CODE_AGENT_PROMPT,
+            name="code_agent",
         )
 
     def execute(self, task_instruction: str, screenshot: str, env_controller) -> Dict:
@@ -318,6 +319,7 @@ Keep the summary under 150 words and use clear, factual language.
             summary_agent = LMMAgent(
                 engine_params=self.engine_params,
                 system_prompt=PROCEDURAL_MEMORY.CODE_SUMMARY_AGENT_PROMPT,
+                metrics=self.agent.metrics,
             )
             summary_agent.add_message(summary_prompt, role="user")
             summary = call_llm_safe(summary_agent, temperature=1)
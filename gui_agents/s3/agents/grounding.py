@@ -1,20 +1,31 @@
 import re
-from collections import defaultdict
 from io import BytesIO
 from typing import Any, Dict, List, Optional, Tuple
 
-import pytesseract
 from PIL import Image
-from pytesseract import Output
 
 from gui_agents.s3.memory.procedural_memory import PROCEDURAL_MEMORY
+from gui_agents.s3.core.cache import ResponseCache
 from gui_agents.s3.core.mllm import LMMAgent
-from gui_agents.s3.utils.common_utils import call_llm_safe
+from gui_agents.s3.core.thread_pool import SharedThreadPool
+from gui_agents.s3.utils.common_utils import call_llm_safe, crop_box
+from gui_agents.s3.utils.grounding_cache import GroundingCache
+from gui_agents.s3.utils.ocr import MAX_REGION_FRACTION, ocr_engine
+from gui_agents.s3.utils.screen_diff import ScreenChangeDetector
+from gui_agents.s3.utils.text_match import PhraseMatcher
 from gui_agents.s3.agents.code_agent import CodeAgent
 import logging
 
 logger = logging.getLogger("desktopenv.agent")
 
+# Spaces grounding models answer in, set with engine_params["grounding_coordinates"]:
+# "normalized" models answer in grounding_width x grounding_height whatever the size of the image,
+# "pixel" models (e.g. UI-TARS) in pixels of the image they are shown
+GROUNDING_COORDINATES = ("normalized", "pixel")
+
+# Threads sending the concurrent grounding requests of one step
+_pool = SharedThreadPool(max_workers=8, thread_name_prefix="grounding")
+
 
 class ACI:
     def __init__(self):
@@ -204,15 +215,63 @@ class OSWorldACI(ACI):
 
         # Screenshot used during ACI execution
         self.obs = None
+        # How obs differs from the previous screenshot (utils.screen_diff.ScreenDiff), set by the Worker
+        self.screen_diff = None
+        # Compares each screenshot OCRed with the previous one, to OCR only what changed
+        self._ocr_changes = ScreenChangeDetector(factor=1)
+        # Grounded coordinates of the current screenshot, keyed by (screenshot id, kind, query,
+        # alignment), so the plan validation and the execution of an action ground it once
+        self.grounding_memo = {}
+        self._memo_screenshot = None
+        self.grounding_memo_hits = 0
 
         # Configure the visual grounding model responsible for coordinate generation
-        self.grounding_model = LMMAgent(engine_params_for_grounding)
+        self.grounding_model = LMMAgent(
+            engine_params_for_grounding,
+            response_cache=ResponseCache.from_params(engine_params_for_grounding),
+            name="grounding",
+        )
         self.engine_params_for_grounding = engine_params_for_grounding
+        # Unset, answers are taken as grounding space, which holds for full screenshots only
+        self.grounding_coordinates = engine_params_for_grounding.get(
+            "grounding_coordinates"
+        )
+        if self.grounding_coordinates not in (None, *GROUNDING_COORDINATES):
+            raise ValueError(
+                f"Unsupported grounding_coordinates '{self.grounding_coordinates}', expected one of {list(GROUNDING_COORDINATES)}"
+            )
+        # Two-stage grounding: on the screenshot downscaled by coarse_scale, then on a crop of
+        # fine_crop times its width and height around the coarse point
+        self.coarse_to_fine = engine_params_for_grounding.get("coarse_to_fine", False)
+        if self.coarse_to_fine and self.grounding_coordinates is None:
+            # Scaling answers on the downscaled screenshot and the crop depends on it
+            raise ValueError(
+                f"coarse_to_fine requires grounding_coordinates, one of {list(GROUNDING_COORDINATES)}"
+            )
+        self.coarse_scale = engine_params_for_grounding.get("coarse_scale", 0.5)
+        self.fine_crop = engine_params_for_grounding.get("fine_crop", 0.3)
+        # Elements grounded in earlier steps of the episode, 0 entries to disable
+        grounding_cache_size = engine_params_for_grounding.get(
+            "grounding_cache_size", 64
+        )
+        self.grounding_cache = (
+            GroundingCache(max_entries=grounding_cache_size)
+            if grounding_cache_size
+            else None
+        )
 
         # Configure text grounding agent
         self.text_span_agent = LMMAgent(
             engine_params=engine_params_for_generation,
             system_prompt=PROCEDURAL_MEMORY.PHRASE_TO_WORD_COORDS_PROMPT,
+            response_cache=ResponseCache.from_params(engine_params_for_generation),
+            name="text_span",
+        )
+        # Matches phrases against the OCR words before asking the text span agent
+        self.phrase_matcher = (
+            PhraseMatcher()
+            if engine_params_for_generation.get("text_span_fast_path", True)
+            else None
         )
 
         # Configure code agent
@@ -225,106 +284,347 @@ class OSWorldACI(ACI):
         self.current_task_instruction = None
         self.last_code_agent_result = None
 
+    def _memoized_coords(
+        self, obs: Dict, kind: str, queries: List[Tuple[str, str]], ground
+    ) -> List[List[int]]:
+        """Returns the coordinates of each (query, alignment) of queries in obs.
+
+        ground(missing) is called once with the queries that are not memoized yet.
+        """
+        screenshot = obs["screenshot"]
+        if screenshot is not self._memo_screenshot:
+            # A new observation, the coordinates of the previous one no longer apply
+            self.grounding_memo = {}
+            self._memo_screenshot = screenshot
+        keys = [
+            (id(screenshot), kind, query, alignment) for query, alignment in queries
+        ]
+        missing = list(dict.fromkeys(k for k in keys if k not in self.grounding_memo))
+        for key in set(keys) - set(missing):
+            self.grounding_memo_hits += 1
+            logger.info("GROUNDING MEMO HIT: %s", key[1:])
+        if missing:
+            coords = ground([key[2:] for key in missing])
+            self.grounding_memo.update(zip(missing, coords))
+        return [list(self.grounding_memo[key]) for key in keys]
+
+    @staticmethod
+    def _get_responses(agent: LMMAgent, list_of_messages: List[List[Dict]]):
+        """Gets the responses of independent requests to agent, concurrently if there are several.
+
+        Every request goes through get_response, so the response cache, single-flight and hedging
+        of the agent apply to each.
+        """
+        if len(list_of_messages) <= 1:
+            return [
+                call_llm_safe(agent, messages=messages) for messages in list_of_messages
+            ]
+        agents = agent.concurrent_copies(len(list_of_messages))
+        return list(
+            _pool.get().map(
+                lambda agent, messages: call_llm_safe(agent, messages=messages),
+                agents,
+                list_of_messages,
+            )
+        )
+
     # Given the state and worker's referring expression, use the grounding model to generate (x,y)
     def generate_coords(self, ref_expr: str, obs: Dict) -> List[int]:
+        return self.generate_coords_many([ref_expr], obs)[0]
+
+    def generate_coords_many(self, ref_exprs: List[str], obs: Dict) -> List[List[int]]:
+        """Grounds several referring expressions in obs, with concurrent grounding model calls."""
+        return self._memoized_coords(
+            obs,
+            "element",
+            [(ref_expr, "") for ref_expr in ref_exprs],
+            lambda missing: self._ground_elements_across_steps(
+                [ref_expr for ref_expr, _ in missing], obs
+            ),
+        )
 
-        # Reset the grounding model state
-        self.grounding_model.reset()
+    def _ground_elements_across_steps(
+        self, ref_exprs: List[str], obs: Dict
+    ) -> List[List[int]]:
+        """Reuses the coordinates grounded in earlier steps whose surroundings are unchanged."""
+        if self.grounding_cache is None:
+            return self._ground_elements(ref_exprs, obs)
+        image = Image.open(BytesIO(obs["screenshot"]))
+        coords = [self.grounding_cache.get(ref_expr, image) for ref_expr in ref_exprs]
+        for ref_expr, point in zip(ref_exprs, coords):
+            if point is not None:
+                logger.info("GROUNDING CACHE HIT: %s -> %s", ref_expr, point)
+        missing = [i for i, point in enumerate(coords) if point is None]
+        if missing:
+            grounded = self._ground_elements([ref_exprs[i] for i in missing], obs)
+            for i, point in zip(missing, grounded):
+                coords[i] = point
+                self.grounding_cache.put(
+                    ref_exprs[i], image, point, self._to_pixels(point, image.size)
+                )
+        return coords
 
-        # Configure the context, UI-TARS demo does not use system prompt
-        prompt = f"Query:{ref_expr}\nOutput only the coordinate of one point in your response.\n"
-        self.grounding_model.add_message(
-            text_content=prompt, image_content=obs["screenshot"], put_text_last=True
+    def _ground_elements(self, ref_exprs: List[str], obs: Dict) -> List[List[int]]:
+        screenshot = obs["screenshot"]
+        if not self.coarse_to_fine:
+            coords = self._ground_in_images(ref_exprs, [screenshot] * len(ref_exprs))
+            assert all(coords)
+            return coords
+
+        # Localize on a downscaled screenshot, then refine on a full resolution crop around that point
+        image = Image.open(BytesIO(screenshot))
+        coarse = self._ground_in_images(
+            ref_exprs, [self._downscale(image)] * len(ref_exprs)
+        )
+        assert all(coarse)
+        boxes = [self._fine_box(image.size, point) for point in coarse]
+        fine = self._ground_in_images(
+            ref_exprs, [self._crop(image, box) for box in boxes]
         )
+        return [
+            self._from_crop(point, box, image.size) if point else coarse_point
+            for point, box, coarse_point in zip(fine, boxes, coarse)
+        ]
 
-        # Generate and parse coordinates
-        response = call_llm_safe(self.grounding_model)
-        print("RAW GROUNDING MODEL RESPONSE:", response)
-        numericals = re.findall(r"\d+", response)
-        assert len(numericals) >= 2
-        return [int(numericals[0]), int(numericals[1])]
-
-    # Calls pytesseract to generate word level bounding boxes for text grounding
-    def get_ocr_elements(self, b64_image_data: str) -> Tuple[str, List]:
-        image = Image.open(BytesIO(b64_image_data))
-        image_data = pytesseract.image_to_data(image, output_type=Output.DICT)
-
-        # Clean text by removing leading and trailing spaces and non-alphabetical characters, but keeping punctuation
-        for i, word in enumerate(image_data["text"]):
-            image_data["text"][i] = re.sub(
-                r"^[^a-zA-Z\s.,!?;:\-\+]+|[^a-zA-Z\s.,!?;:\-\+]+$", "", word
+    def _ground_in_images(
+        self, ref_exprs: List[str], images: List[bytes]
+    ) -> List[Optional[List[int]]]:
+        """Grounds each referring expression in its image.
+
+        Returns:
+            The points in grounding space of their image, None for a response without coordinates.
+        """
+        list_of_messages = []
+        for ref_expr, image in zip(ref_exprs, images):
+            # Each request has its own messages, the grounding model's stay untouched
+            messages = self.grounding_model.initial_messages()
+            # Configure the context, UI-TARS demo does not use system prompt
+            prompt = f"Query:{ref_expr}\nOutput only the coordinate of one point in your response.\n"
+            self.grounding_model.add_message(
+                text_content=prompt,
+                image_content=image,
+                put_text_last=True,
+                messages=messages,
             )
+            list_of_messages.append(messages)
 
-        ocr_elements = []
-        ocr_table = "Text Table:\nWord id\tText\n"
-        # Obtain the <id, text, group number, word number> for each valid element
-        grouping_map = defaultdict(list)
-        ocr_id = 0
-        for i in range(len(image_data["text"])):
-            block_num = image_data["block_num"][i]
-            if image_data["text"][i]:
-                grouping_map[block_num].append(image_data["text"][i])
-                ocr_table += f"{ocr_id}\t{image_data['text'][i]}\n"
-                ocr_elements.append(
-                    {
-                        "id": ocr_id,
-                        "text": image_data["text"][i],
-                        "group_num": block_num,
-                        "word_num": len(grouping_map[block_num]),
-                        "left": image_data["left"][i],
-                        "top": image_data["top"][i],
-                        "width": image_data["width"][i],
-                        "height": image_data["height"][i],
-                    }
-                )
-                ocr_id += 1
+        # Generate and parse coordinates
+        coords = []
+        for response in self._get_responses(self.grounding_model, list_of_messages):
+            print("RAW GROUNDING MODEL RESPONSE:", response)
+            numericals = re.findall(r"\d+", response)
+            if len(numericals) >= 2:
+                coords.append([int(numericals[0]), int(numericals[1])])
+            else:
+                coords.append(None)
+        if self.grounding_coordinates == "pixel":
+            coords = [
+                self._from_image_pixels(point, image) if point else None
+                for point, image in zip(coords, images)
+            ]
+        return coords
+
+    def _from_image_pixels(self, point: List[int], image: bytes) -> List[int]:
+        """Maps a point in pixels of image, as answered by a pixel-space model, to grounding space."""
+        grounding_width, grounding_height = self._grounding_size()
+        # Only the header is read for the size
+        width, height = Image.open(BytesIO(image)).size
+        return [
+            round(point[0] * grounding_width / width),
+            round(point[1] * grounding_height / height),
+        ]
+
+    # Points are kept in grounding_width x grounding_height space of the image they were grounded
+    # in, and scaled to other images through the fractions of the image they fall at
+    def _grounding_size(self) -> Tuple[int, int]:
+        return (
+            self.engine_params_for_grounding["grounding_width"],
+            self.engine_params_for_grounding["grounding_height"],
+        )
+
+    def _downscale(self, image: Image.Image) -> bytes:
+        size = (
+            max(1, round(image.width * self.coarse_scale)),
+            max(1, round(image.height * self.coarse_scale)),
+        )
+        output = BytesIO()
+        image.resize(size, Image.LANCZOS).save(output, format="PNG")
+        return output.getvalue()
+
+    def _to_pixels(
+        self, point: List[int], image_size: Tuple[int, int]
+    ) -> Tuple[int, int]:
+        """Maps a point in grounding space to pixels of an image of image_size."""
+        grounding_width, grounding_height = self._grounding_size()
+        return (
+            round(point[0] * image_size[0] / grounding_width),
+            round(point[1] * image_size[1] / grounding_height),
+        )
+
+    def _fine_box(
+        self, image_size: Tuple[int, int], point: List[int]
+    ) -> Tuple[int, int, int, int]:
+        """Returns the crop around a point in grounding space, with the aspect ratio of the image."""
+        width, height = image_size
+        return crop_box(
+            image_size,
+            *self._to_pixels(point, image_size),
+            max(1, round(width * self.fine_crop)),
+            max(1, round(height * self.fine_crop)),
+        )
 
-        return ocr_table, ocr_elements
+    @staticmethod
+    def _crop(image: Image.Image, box: Tuple[int, int, int, int]) -> bytes:
+        output = BytesIO()
+        image.crop(box).save(output, format="PNG")
+        return output.getvalue()
+
+    def _from_crop(
+        self,
+        point: List[int],
+        box: Tuple[int, int, int, int],
+        image_size: Tuple[int, int],
+    ) -> List[int]:
+        """Maps a point grounded in the crop box back to grounding space of the whole image."""
+        grounding_width, grounding_height = self._grounding_size()
+        left, top, right, bottom = box
+        x = left + point[0] * (right - left) / grounding_width
+        y = top + point[1] * (bottom - top) / grounding_height
+        return [
+            round(x * grounding_width / image_size[0]),
+            round(y * grounding_height / image_size[1]),
+        ]
+
+    # Generates word level bounding boxes for text grounding, cached per screenshot and re-OCRing
+    # only the region that changed since the previous screenshot (see utils/ocr.py)
+    def get_ocr_elements(self, b64_image_data: bytes) -> Tuple[str, List]:
+        previous = self._ocr_changes.reference
+        diff = self._ocr_changes.diff(b64_image_data)
+        if previous is None:
+            return ocr_engine.elements(b64_image_data)
+        if not diff.changed:
+            return ocr_engine.elements(previous)
+        if diff.changed_fraction < 1.0 and ocr_engine.is_cached(previous):
+            left, top, right, bottom = diff.bbox
+            width, height = Image.open(BytesIO(b64_image_data)).size
+            if (right - left) * (bottom - top) <= MAX_REGION_FRACTION * width * height:
+                return ocr_engine.elements_since(b64_image_data, previous, diff.bbox)
+        return ocr_engine.elements(b64_image_data)
 
     # Given the state and worker's text phrase, generate the coords of the first/last word in the phrase
     def generate_text_coords(
         self, phrase: str, obs: Dict, alignment: str = ""
     ) -> List[int]:
+        return self.generate_text_coords_many([(phrase, alignment)], obs)[0]
+
+    def generate_text_coords_many(
+        self, spans: List[Tuple[str, str]], obs: Dict
+    ) -> List[List[int]]:
+        """Grounds several (phrase, alignment) pairs in obs, with one OCR pass and concurrent LLM calls."""
+        return self._memoized_coords(
+            obs, "text", spans, lambda missing: self._ground_text_spans(missing, obs)
+        )
 
+    def _ground_text_spans(
+        self, spans: List[Tuple[str, str]], obs: Dict
+    ) -> List[List[int]]:
         ocr_table, ocr_elements = self.get_ocr_elements(obs["screenshot"])
 
-        alignment_prompt = ""
-        if alignment == "start":
-            alignment_prompt = "**Important**: Output the word id of the FIRST word in the provided phrase.\n"
-        elif alignment == "end":
-            alignment_prompt = "**Important**: Output the word id of the LAST word in the provided phrase.\n"
-
-        # Load LLM prompt
-        self.text_span_agent.reset()
-        self.text_span_agent.add_message(
-            alignment_prompt + "Phrase: " + phrase + "\n" + ocr_table, role="user"
-        )
-        self.text_span_agent.add_message(
-            "Screenshot:\n", image_content=obs["screenshot"], role="user"
-        )
-
-        # Obtain the target element
-        response = call_llm_safe(self.text_span_agent)
-        print("TEXT SPAN AGENT RESPONSE:", response)
-        numericals = re.findall(r"\d+", response)
-        if len(numericals) > 0:
-            text_id = int(numericals[-1])
-        else:
-            text_id = 0
-        elem = ocr_elements[text_id]
-
-        # Compute the element coordinates
-        if alignment == "start":
-            coords = [elem["left"], elem["top"] + (elem["height"] // 2)]
-        elif alignment == "end":
-            coords = [elem["left"] + elem["width"], elem["top"] + (elem["height"] // 2)]
-        else:
-            coords = [
-                elem["left"] + (elem["width"] // 2),
-                elem["top"] + (elem["height"] // 2),
-            ]
+        # Word ids of the spans, found locally when the phrase matches the OCR words unambiguously
+        text_ids = [None] * len(spans)
+        if self.phrase_matcher is not None:
+            for i, (phrase, alignment) in enumerate(spans):
+                words = self.phrase_matcher.match(phrase, ocr_elements)
+                if words is None:
+                    continue
+                if alignment == "start":
+                    text_ids[i] = words[0]
+                elif alignment == "end":
+                    text_ids[i] = words[-1]
+                else:
+                    text_ids[i] = words[len(words) // 2]
+                logger.info("TEXT SPAN FAST PATH: %r -> word %s", phrase, text_ids[i])
+        pending = [i for i, text_id in enumerate(text_ids) if text_id is None]
+
+        list_of_messages = []
+        for i in pending:
+            phrase, alignment = spans[i]
+            alignment_prompt = ""
+            if alignment == "start":
+                alignment_prompt = "**Important**: Output the word id of the FIRST word in the provided phrase.\n"
+            elif alignment == "end":
+                alignment_prompt = "**Important**: Output the word id of the LAST word in the provided phrase.\n"
+
+            # Load LLM prompt, in messages of its own
+            messages = self.text_span_agent.initial_messages()
+            self.text_span_agent.add_message(
+                alignment_prompt + "Phrase: " + phrase + "\n" + ocr_table,
+                role="user",
+                messages=messages,
+            )
+            self.text_span_agent.add_message(
+                "Screenshot:\n",
+                image_content=obs["screenshot"],
+                role="user",
+                messages=messages,
+            )
+            list_of_messages.append(messages)
+
+        # Obtain the remaining target elements
+        responses = self._get_responses(self.text_span_agent, list_of_messages)
+        for i, response in zip(pending, responses):
+            print("TEXT SPAN AGENT RESPONSE:", response)
+            numericals = re.findall(r"\d+", response)
+            if len(numericals) > 0:
+                text_ids[i] = int(numericals[-1])
+            else:
+                text_ids[i] = 0
+
+        coords = []
+        for (_, alignment), text_id in zip(spans, text_ids):
+            elem = ocr_elements[text_id]
+
+            # Compute the element coordinates
+            if alignment == "start":
+                coords.append([elem["left"], elem["top"] + (elem["height"] // 2)])
+            elif alignment == "end":
+                coords.append(
+                    [elem["left"] + elem["width"], elem["top"] + (elem["height"] // 2)]
+                )
+            else:
+                coords.append(
+                    [
+                        elem["left"] + (elem["width"] // 2),
+                        elem["top"] + (elem["height"] // 2),
+                    ]
+                )
         return coords
 
+    def grounding_stats(self) -> Dict:
+        """Returns how often grounding was served without a model call."""
+        return {
+            "memo_hits": self.grounding_memo_hits,
+            "text_fast_path": (
+                self.phrase_matcher.stats() if self.phrase_matcher is not None else None
+            ),
+            "cache": (
+                {
+                    **self.grounding_cache.stats(),
+                    # A coarse-to-fine grounding takes two model calls
+                    "saved_calls": self.grounding_cache.hits
+                    * (2 if self.coarse_to_fine else 1),
+                }
+                if self.grounding_cache is not None
+                else None
+            ),
+        }
+
+    def reset_grounding_cache(self):
+        """Forgets the elements grounded so far, at the start of an episode."""
+        if self.grounding_cache is not None:
+            self.grounding_cache.clear()
+        self._ocr_changes.reset()
+
     def assign_screenshot(self, obs: Dict):
         self.obs = obs
 
@@ -480,8 +780,10 @@ class OSWorldACI(ACI):
             ending_description:str, a very detailed description of where to end the drag action. This description should be at least a full sentence.
             hold_keys:List list of keys to hold while dragging
         """
-        coords1 = self.generate_coords(starting_description, self.obs)
-        coords2 = self.generate_coords(ending_description, self.obs)
+        # Both ends are grounded concurrently
+        coords1, coords2 = self.generate_coords_many(
+            [starting_description, ending_description], self.obs
+        )
         x1, y1 = self.resize_coordinates(coords1)
         x2, y2 = self.resize_coordinates(coords2)
 
@@ -509,10 +811,10 @@ class OSWorldACI(ACI):
             ending_phrase:str, the phrase that denotes the end of the text span you want to highlight. If you only want to highlight one word, just pass in that single word.
             button:str, the button to use to highlight the text span. Defaults to "left". Can be "left", "right", or "middle".
         """
-        coords1 = self.generate_text_coords(
-            starting_phrase, self.obs, alignment="start"
+        # Both ends are grounded concurrently, on the same OCR pass
+        coords1, coords2 = self.generate_text_coords_many(
+            [(starting_phrase, "start"), (ending_phrase, "end")], self.obs
         )
-        coords2 = self.generate_text_coords(ending_phrase, self.obs, alignment="end")
         x1, y1 = coords1
         x2, y2 = coords2
 
@@ -4,15 +4,20 @@ import textwrap
 from typing import Dict, List, Tuple
 
 from gui_agents.s3.agents.grounding import ACI
+from gui_agents.s3.core.blobs import blob_store
+from gui_agents.s3.core.context import ContextWindow
+from gui_agents.s3.core.mllm import LMMAgent
 from gui_agents.s3.core.module import BaseModule
 from gui_agents.s3.memory.procedural_memory import PROCEDURAL_MEMORY
 from gui_agents.s3.utils.common_utils import (
+    agent_action_block_complete,
     call_llm_safe,
     call_llm_formatted,
     parse_code_from_string,
     split_thinking_response,
     create_pyautogui_code,
 )
+from gui_agents.s3.utils.screen_diff import ScreenChangeDetector
 from gui_agents.s3.utils.formatters import (
     SINGLE_ACTION_FORMATTER,
     CODE_VALID_FORMATTER,
@@ -20,6 +25,8 @@ from gui_agents.s3.utils.formatters import (
 
 logger = logging.getLogger("desktopenv.agent")
 
+UNCHANGED_SCREEN_NOTE = "\n(The screen is unchanged since the previous screenshot, so no new screenshot is provided.)"
+
 
 class Worker(BaseModule):
     def __init__(
@@ -54,9 +61,19 @@ class Worker(BaseModule):
             "claude-sonnet-4-5-20250929",
             "claude-opus-4-5-20251101",
         ]
+        # Stream plans and stop as soon as the grounded action block is complete
+        self.stream_generation = worker_engine_params.get("stream", False)
         self.grounding_agent = grounding_agent
         self.max_trajectory_length = max_trajectory_length
+        # Extra images tolerated before old ones are evicted, see _context_window
+        self.image_eviction_slack = worker_engine_params.get(
+            "image_eviction_slack", max_trajectory_length // 2
+        )
         self.enable_reflection = enable_reflection
+        # Send a note instead of the screenshot when the screen did not change, see screen_diff.py
+        self.skip_unchanged_screenshots = worker_engine_params.get(
+            "skip_unchanged_screenshots", True
+        )
 
         self.reset()
 
@@ -76,51 +93,66 @@ class Worker(BaseModule):
             type(self.grounding_agent), skipped_actions=skipped_actions
         ).replace("CURRENT_OS", self.platform)
 
-        self.generator_agent = self._create_agent(sys_prompt)
+        self.generator_agent = self._create_agent(sys_prompt, name="worker")
         self.reflection_agent = self._create_agent(
-            PROCEDURAL_MEMORY.REFLECTION_ON_TRAJECTORY
+            PROCEDURAL_MEMORY.REFLECTION_ON_TRAJECTORY, name="reflection"
         )
+        self.generator_agent.context = self._context_window()
+        self.reflection_agent.context = self._context_window()
 
         self.turn_count = 0
         self.worker_history = []
         self.reflections = []
         self.cost_this_turn = 0
         self.screenshot_inputs = []
+        self.screen_detector = ScreenChangeDetector()
+        # A new episode, elements grounded in the previous one are not reused
+        if hasattr(self.grounding_agent, "reset_grounding_cache"):
+            self.grounding_agent.reset_grounding_cache()
+        # How the current screenshot differs from the last one sent to the models
+        self.screen_diff = None
+
+    def _context_window(self) -> ContextWindow:
+        """Returns the context limits of the generator and reflection agents."""
+        engine_type = self.engine_params.get("engine_type", "")
+        # Long-context models keep all text and only the latest images, others keep the latest turns
+        long_context = engine_type in ["anthropic", "openai", "gemini"]
+        return ContextWindow(
+            max_tokens=self.engine_params.get("context_budget"),
+            max_images=self.max_trajectory_length if long_context else None,
+            max_turns=None if long_context else self.max_trajectory_length,
+            image_slack=self.image_eviction_slack,
+        )
 
-    def flush_messages(self):
-        """Flush messages based on the model's context limits.
+    def _screen_input(self, obs: Dict, agent: LMMAgent) -> Tuple[object, str]:
+        """Returns the image to add to this step's messages to agent and a note to append to their text."""
+        if (
+            self.skip_unchanged_screenshots
+            and self.turn_count > 0
+            and not self.screen_diff.changed
+            and self._has_images(agent)
+        ):
+            return None, UNCHANGED_SCREEN_NOTE
+        return obs["screenshot"], ""
 
-        This method ensures that the agent's message history does not exceed the maximum trajectory length.
+    @staticmethod
+    def _has_images(agent: LMMAgent) -> bool:
+        # Images are evicted oldest first, so the previous screenshot is still in the messages if any image is
+        agent.context.track(agent.messages)
+        return agent.context.num_images > 0
 
-        Side Effects:
-            - Modifies the messages of generator, reflection, and bon_judge agents to fit within the context limits.
-        """
-        engine_type = self.engine_params.get("engine_type", "")
+    def flush_messages(self) -> Dict:
+        """Trims the generator and reflection messages to their context limits.
 
-        # Flush strategy for long-context models: keep all text, only keep latest images
-        if engine_type in ["anthropic", "openai", "gemini"]:
-            max_images = self.max_trajectory_length
-            for agent in [self.generator_agent, self.reflection_agent]:
-                if agent is None:
-                    continue
-                # keep latest k images
-                img_count = 0
-                for i in range(len(agent.messages) - 1, -1, -1):
-                    for j in range(len(agent.messages[i]["content"])):
-                        if "image" in agent.messages[i]["content"][j].get("type", ""):
-                            img_count += 1
-                            if img_count > max_images:
-                                del agent.messages[i]["content"][j]
-
-        # Flush strategy for non-long-context models: drop full turns
-        else:
-            # generator msgs are alternating [user, assistant], so 2 per round
-            if len(self.generator_agent.messages) > 2 * self.max_trajectory_length + 1:
-                self.generator_agent.messages.pop(1)
-                self.generator_agent.messages.pop(1)
-            # reflector msgs are all [(user text, user image)], so 1 per round
-            if len(self.reflection_agent.messages) > self.max_trajectory_length + 1:
-                self.reflection_agent.messages.pop(1)
+        Returns:
+            Dict: The estimated size of the kept context of each agent.
+        """
+        agents = {"worker": self.generator_agent, "reflection": self.reflection_agent}
+        return {
+            name: agent.fit_context()
+            for name, agent in agents.items()
+            if agent is not None
+        }
 
     def _generate_reflection(self, instruction: str, obs: Dict) -> Tuple[str, str]:
         """
@@ -159,9 +191,10 @@ class Worker(BaseModule):
                 )
             # Load the latest action
             else:
+                image_content, note = self._screen_input(obs, self.reflection_agent)
                 self.reflection_agent.add_message(
-                    text_content=self.worker_history[-1],
-                    image_content=obs["screenshot"],
+                    text_content=self.worker_history[-1] + note,
+                    image_content=image_content,
                     role="user",
                 )
                 full_reflection = call_llm_safe(
@@ -184,6 +217,8 @@ class Worker(BaseModule):
 
         self.grounding_agent.assign_screenshot(obs)
         self.grounding_agent.set_task_instruction(instruction)
+        self.screen_diff = self.screen_detector.diff(obs["screenshot"])
+        self.grounding_agent.screen_diff = self.screen_diff
 
         generator_message = (
             ""
@@ -304,8 +339,9 @@ class Worker(BaseModule):
             self.grounding_agent.last_code_agent_result = None
 
         # Finalize the generator message
+        image_content, note = self._screen_input(obs, self.generator_agent)
         self.generator_agent.add_message(
-            generator_message, image_content=obs["screenshot"], role="user"
+            generator_message + note, image_content=image_content, role="user"
         )
 
         # Generate the plan and next action
@@ -313,15 +349,23 @@ class Worker(BaseModule):
             SINGLE_ACTION_FORMATTER,
             partial(CODE_VALID_FORMATTER, self.grounding_agent, obs),
         ]
+        stream_kwargs = (
+            {"stream": True, "stop_condition": agent_action_block_complete}
+            if self.stream_generation
+            else {}
+        )
         plan = call_llm_formatted(
             self.generator_agent,
             format_checkers,
             temperature=self.temperature,
             use_thinking=self.use_thinking,
+            **stream_kwargs,
         )
         self.worker_history.append(plan)
         self.generator_agent.add_message(plan, role="assistant")
         logger.info("PLAN:\n %s", plan)
+        if self.stream_generation:
+            logger.info("PLAN TIME TO FIRST TOKEN: %s", self.generator_agent.last_ttft)
 
         # Extract the next action from the plan
         plan_code = parse_code_from_string(plan)
@@ -342,6 +386,13 @@ class Worker(BaseModule):
             "exec_code": exec_code,
             "reflection": reflection,
             "reflection_thoughts": reflection_thoughts,
+            "plan_ttft": self.generator_agent.last_ttft,
+            "screen_diff": self.screen_diff.to_dict(),
+            "grounding": (
+                self.grounding_agent.grounding_stats()
+                if hasattr(self.grounding_agent, "grounding_stats")
+                else None
+            ),
             "code_agent_output": (
                 self.grounding_agent.last_code_agent_result
                 if hasattr(self.grounding_agent, "last_code_agent_result")
@@ -350,6 +401,7 @@ class Worker(BaseModule):
             ),
         }
         self.turn_count += 1
-        self.screenshot_inputs.append(obs["screenshot"])
-        self.flush_messages()
+        # Digests in the shared blob store, so the episode's screenshots are not all held in memory
+        self.screenshot_inputs.append(blob_store.put(obs["screenshot"]))
+        executor_info["context"] = self.flush_messages()
         return executor_info, [exec_code]
@@ -1,24 +1,34 @@
+from gui_agents.s3.core.client_pool import run_sync
+from gui_agents.s3.core.cache import ResponseCache, SingleFlight
 from gui_agents.s3.core.mllm import LMMAgent
 from gui_agents.s3.memory.procedural_memory import PROCEDURAL_MEMORY
 from gui_agents.s3.utils.common_utils import (
+    acall_llm_formatted,
     call_llm_formatted,
     split_thinking_response,
     compress_image,
+    crop_box,
 )
 from gui_agents.s3.utils.formatters import (
     THOUGHTS_ANSWER_TAG_FORMATTER,
 )
 from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import base64
-import cv2
 import numpy as np
 
 
 class BehaviorNarrator:
     def __init__(self, engine_params):
-        self.judge_agent = LMMAgent(engine_params=engine_params)
+        self.judge_agent = LMMAgent(
+            engine_params=engine_params,
+            response_cache=ResponseCache.from_params(engine_params),
+            name="behavior_narrator",
+            # The same transitions recur across trajectories narrated concurrently
+            single_flight=SingleFlight(ttl=engine_params.get("single_flight_ttl", 300)),
+        )
 
     @staticmethod
     def extract_mouse_action(action: str) -> list[str]:
@@ -135,12 +145,7 @@ class BehaviorNarrator:
         """
         # Find zoom dimensions
         img = Image.open(BytesIO(image_bytes)).convert("RGB")
-        cx, cy = x - width // 2, y - height // 2  # Center coordinates
-        W, H = img.size
-        left = min(max(cx, 0), W - width)
-        top = min(max(cy, 0), H - height)
-        right = left + width
-        bottom = top + height
+        left, top, right, bottom = crop_box(img.size, x, y, width, height)
         zoomed_img = img.crop((left, top, right, bottom))
         # Add noticeable bounding box to original image
         if add_bounding_box:
@@ -153,6 +158,8 @@ class BehaviorNarrator:
         else:
             original_with_box_bytes = image_bytes
         if upscaling:
+            import cv2
+
             # Upscale and enhance zoomed image
             zoomed_img = cv2.cvtColor(
                 np.array(zoomed_img), cv2.COLOR_RGB2BGR
@@ -169,13 +176,9 @@ class BehaviorNarrator:
         zoomed_img_bytes = compress_image(image=zoomed_img)  # Compress to reduce size
         return zoomed_img_bytes, original_with_box_bytes
 
-    def judge(
-        self,
-        screenshot_num: int,
-        before_img_bytes: bytes,
-        after_img_bytes: bytes,
-        pyautogui_action: str,
-    ) -> Dict[str, str]:
+    @staticmethod
+    def terminal_fact(pyautogui_action: str) -> Optional[Dict[str, str]]:
+        """Returns the fixed fact for DONE/FAIL actions, which need no LLM call."""
         if pyautogui_action == "DONE":
             return {
                 "fact_thoughts": "The agent has indicated that it is done with the task.",
@@ -186,6 +189,13 @@ class BehaviorNarrator:
                 "fact_thoughts": "The agent has indicated that it is impossible to proceed further with the task.",
                 "fact_answer": "The agent has indicated that it is impossible to proceed further with the task.",
             }
+        return None
+
+    @staticmethod
+    def build_fact_message(
+        before_img_bytes: bytes, after_img_bytes: bytes, pyautogui_action: str
+    ) -> List[Dict]:
+        """Builds the narration request: the annotated before image, the action and the (zoomed) after image."""
         # Prepare ANNOTATED BEFORE image
         mouse_actions = BehaviorNarrator.extract_mouse_action(pyautogui_action)
         before_img = Image.open(BytesIO(before_img_bytes))
@@ -258,16 +268,130 @@ class BehaviorNarrator:
                 zoomed_after_img_message,
             ]
         fact_message += [{"role": "user", "content": fact_message_content}]
+        return fact_message
+
+    @staticmethod
+    def parse_fact_response(screenshot_num: int, fact_response: str) -> Dict[str, str]:
+        fact_answer, fact_thoughts = split_thinking_response(fact_response)
+        return {
+            "fact_thoughts": fact_thoughts,
+            "fact_answer": f"Fact Caption from Screenshot {screenshot_num}: {fact_answer}",
+        }
+
+    def judge(
+        self,
+        screenshot_num: int,
+        before_img_bytes: bytes,
+        after_img_bytes: bytes,
+        pyautogui_action: str,
+    ) -> Dict[str, str]:
+        terminal_fact = BehaviorNarrator.terminal_fact(pyautogui_action)
+        if terminal_fact is not None:
+            return terminal_fact
+        fact_message = BehaviorNarrator.build_fact_message(
+            before_img_bytes, after_img_bytes, pyautogui_action
+        )
         fact_response = call_llm_formatted(
             self.judge_agent,
             [THOUGHTS_ANSWER_TAG_FORMATTER],
             messages=fact_message,
             temperature=0.0,
         )
-        fact_answer, fact_thoughts = split_thinking_response(fact_response)
+        return BehaviorNarrator.parse_fact_response(screenshot_num, fact_response)
 
-        result = {
-            "fact_thoughts": fact_thoughts,
-            "fact_answer": f"Fact Caption from Screenshot {screenshot_num}: {fact_answer}",
-        }
-        return result
+    def judge_many(
+        self,
+        transitions: List[Tuple[int, bytes, bytes, str]],
+        max_in_flight: Optional[int] = None,
+    ) -> List[Dict[str, str]]:
+        """Sync variant of ajudge_many, run on the shared background event loop."""
+        return run_sync(self.ajudge_many(transitions, max_in_flight=max_in_flight))
+
+    async def ajudge(
+        self,
+        screenshot_num: int,
+        before_img_bytes: bytes,
+        after_img_bytes: bytes,
+        pyautogui_action: str,
+    ) -> Dict[str, str]:
+        """Async variant of judge. Only the image annotation runs off the event loop, the LLM call is native async."""
+        terminal_fact = BehaviorNarrator.terminal_fact(pyautogui_action)
+        if terminal_fact is not None:
+            return terminal_fact
+        fact_message = await asyncio.to_thread(
+            BehaviorNarrator.build_fact_message,
+            before_img_bytes,
+            after_img_bytes,
+            pyautogui_action,
+        )
+        fact_response = await acall_llm_formatted(
+            self.judge_agent,
+            [THOUGHTS_ANSWER_TAG_FORMATTER],
+            messages=fact_message,
+            temperature=0.0,
+        )
+        return BehaviorNarrator.parse_fact_response(screenshot_num, fact_response)
+
+    async def ajudge_many(
+        self,
+        transitions: List[Tuple[int, bytes, bytes, str]],
+        max_in_flight: Optional[int] = None,
+    ) -> List[Dict[str, str]]:
+        """Narrates many transitions at once.
+
+        All requests go out together through the engine's batch path, with at most max_in_flight
+        outstanding, so that a self-hosted server can batch them. Responses that fail the format
+        check are then retried one by one like in judge.
+
+        Args:
+            transitions: (screenshot_num, before_img_bytes, after_img_bytes, pyautogui_action) tuples.
+            max_in_flight: Bound on concurrent requests, the engine's default if None.
+
+        Returns:
+            The fact for every transition, in order.
+        """
+        results = [None] * len(transitions)
+        pending = []
+        for i, (_, _, _, pyautogui_action) in enumerate(transitions):
+            terminal_fact = BehaviorNarrator.terminal_fact(pyautogui_action)
+            if terminal_fact is not None:
+                results[i] = terminal_fact
+            else:
+                pending.append(i)
+
+        fact_messages = await asyncio.gather(
+            *[
+                asyncio.to_thread(
+                    BehaviorNarrator.build_fact_message, *transitions[i][1:]
+                )
+                for i in pending
+            ]
+        )
+        fact_responses = await self.judge_agent.aget_responses(
+            fact_messages, temperature=0.0, max_in_flight=max_in_flight
+        )
+
+        async def finish(i, fact_message, fact_response):
+            if (
+                isinstance(fact_response, Exception)
+                or not THOUGHTS_ANSWER_TAG_FORMATTER(fact_response)[0]
+            ):
+                fact_response = await acall_llm_formatted(
+                    self.judge_agent,
+                    [THOUGHTS_ANSWER_TAG_FORMATTER],
+                    messages=fact_message,
+                    temperature=0.0,
+                )
+            results[i] = BehaviorNarrator.parse_fact_response(
+                transitions[i][0], fact_response
+            )
+
+        await asyncio.gather(
+            *[
+                finish(i, fact_message, fact_response)
+                for i, fact_message, fact_response in zip(
+                    pending, fact_messages, fact_responses
+                )
+            ]
+        )
+        return results
@@ -1,10 +1,15 @@
 import os
+import asyncio
 import base64
 from typing import List, Tuple, Optional, List
 
 from gui_agents.s3.core.mllm import LMMAgent
 from gui_agents.s3.memory.procedural_memory import PROCEDURAL_MEMORY
-from gui_agents.s3.utils.common_utils import call_llm_formatted, split_thinking_response
+from gui_agents.s3.utils.common_utils import (
+    acall_llm_formatted,
+    call_llm_formatted,
+    split_thinking_response,
+)
 
 
 def get_final_screenshot_file(task_dir: str) -> str:
@@ -61,19 +66,18 @@ def image_to_openai_message_format(
 
 class ComparativeJudge:
     def __init__(self, engine_params):
-        self.judge_agent = LMMAgent(engine_params=engine_params)
+        self.judge_agent = LMMAgent(
+            engine_params=engine_params, name="comparative_judge"
+        )
 
-    def judge(
-        self,
+    @staticmethod
+    def build_messages(
         task_description: str,
         task: str,
         result_dirs: List[str],
         all_fact_captions: List[List[str]],
-    ) -> Tuple[str, str, Optional[str]]:
-        """
-        Fact captions + initial/final screenshots judging.
-        Pipeline: use provided fact captions → include initial/final screenshots → judge.
-        """
+    ) -> List[dict]:
+        """Builds the judging request from the fact captions and the initial/final screenshots."""
         num_trajectories = len(result_dirs)
         system_prompt = PROCEDURAL_MEMORY.VLM_EVALUATOR_PROMPT_COMPARATIVE_BASELINE
         system_prompt = system_prompt.replace(
@@ -134,7 +138,13 @@ class ComparativeJudge:
             }
         )
 
-        response = call_llm_formatted(self.judge_agent, [], messages=messages)
+        return messages
+
+    @staticmethod
+    def parse_response(
+        response: str, result_dirs: List[str]
+    ) -> Tuple[str, str, Optional[str]]:
+        num_trajectories = len(result_dirs)
         answer, thoughts = split_thinking_response(response)
 
         try:
@@ -147,3 +157,38 @@ class ComparativeJudge:
             selected_trajectory = None
 
         return answer, thoughts, selected_trajectory
+
+    def judge(
+        self,
+        task_description: str,
+        task: str,
+        result_dirs: List[str],
+        all_fact_captions: List[List[str]],
+    ) -> Tuple[str, str, Optional[str]]:
+        """
+        Fact captions + initial/final screenshots judging.
+        Pipeline: use provided fact captions → include initial/final screenshots → judge.
+        """
+        messages = ComparativeJudge.build_messages(
+            task_description, task, result_dirs, all_fact_captions
+        )
+        response = call_llm_formatted(self.judge_agent, [], messages=messages)
+        return ComparativeJudge.parse_response(response, result_dirs)
+
+    async def ajudge(
+        self,
+        task_description: str,
+        task: str,
+        result_dirs: List[str],
+        all_fact_captions: List[List[str]],
+    ) -> Tuple[str, str, Optional[str]]:
+        """Async variant of judge. Screenshots are loaded off the event loop, the LLM call is native async."""
+        messages = await asyncio.to_thread(
+            ComparativeJudge.build_messages,
+            task_description,
+            task,
+            result_dirs,
+            all_fact_captions,
+        )
+        response = await acall_llm_formatted(self.judge_agent, [], messages=messages)
+        return ComparativeJudge.parse_response(response, result_dirs)
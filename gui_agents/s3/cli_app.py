@@ -4,7 +4,6 @@ import io
 import logging
 import os
 import platform
-import pyautogui
 import signal
 import sys
 import time
@@ -153,6 +152,9 @@ def scale_screen_dimensions(width: int, height: int, max_dim_size: int):
 
 
 def run_agent(agent, instruction: str, scaled_width: int, scaled_height: int):
+    # Imported here since it connects to the display, which --help does not need
+    import pyautogui
+
     global paused
     obs = {}
     traj = "Task:\n" + instruction
@@ -257,6 +259,12 @@ def main():
         default=None,
         help="Temperature to fix the generation model at (e.g. o3 can only be run with 1.0)",
     )
+    parser.add_argument(
+        "--model_stream",
+        action="store_true",
+        default=False,
+        help="Stream the main generation model and stop once the action code block is complete",
+    )
 
     # Grounding model config: Self-hosted endpoint based (required)
     parser.add_argument(
@@ -269,7 +277,7 @@ def main():
         "--ground_url",
         type=str,
         required=True,
-        help="The URL of the grounding model",
+        help="The URL of the grounding model (vllm/huggingface: comma-separated replicas are load-balanced)",
     )
     parser.add_argument(
         "--ground_api_key",
@@ -318,6 +326,8 @@ def main():
 
     args = parser.parse_args()
 
+    import pyautogui
+
     # Re-scales screenshot size to ensure it fits in UI-TARS context limit
     screen_width, screen_height = pyautogui.size()
     scaled_width, scaled_height = scale_screen_dimensions(
@@ -331,6 +341,7 @@ def main():
         "base_url": args.model_url,
         "api_key": args.model_api_key,
         "temperature": getattr(args, "model_temperature", None),
+        "stream": args.model_stream,
     }
 
     # Load the grounding engine from a custom endpoint
@@ -0,0 +1,158 @@
+"""Reference-based storage of the screenshots held in agents' messages.
+
+LMMAgent.add_message stores an image part as an ImageRef, which holds the content hash of the image
+in a BlobStore and how to encode it, instead of the base64 string itself. The messages of an agent
+therefore stay small however long the episode runs. The ImageRefs are materialized into base64
+(through image_cache, so once per screenshot) only when a request is built, and that copy is
+dropped after the request.
+
+The BlobStore keeps the most recently used images in memory up to a size bound and spills the
+others to files, from which they are read back on demand. The bound is set with
+AGENT_S_BLOB_MEMORY_MB (default 64) and the spill directory with AGENT_S_BLOB_DIR (default: a
+temporary directory removed at exit).
+"""
+
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from gui_agents.s3.core.image_cache import image_cache
+
+
+class BlobStore:
+    """Content-addressed image store, bounded in memory and spilling to disk."""
+
+    def __init__(self, max_memory_mb: float = 64, spill_dir: Optional[str] = None):
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self._spill_dir = spill_dir
+        # digest -> bytes, in LRU order
+        self._memory = OrderedDict()
+        self.memory_bytes = 0
+        self._spilled = set()
+        # id(bytes) -> (bytes, digest) of recent puts, so the same screenshot is hashed once
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "BlobStore":
+        return cls(
+            max_memory_mb=float(os.getenv("AGENT_S_BLOB_MEMORY_MB", "64")),
+            spill_dir=os.getenv("AGENT_S_BLOB_DIR"),
+        )
+
+    @property
+    def spill_dir(self) -> str:
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="agent_s_blobs_")
+            atexit.register(shutil.rmtree, self._spill_dir, ignore_errors=True)
+        os.makedirs(self._spill_dir, exist_ok=True)
+        return self._spill_dir
+
+    def put(self, data: bytes) -> str:
+        """Stores data and returns its digest."""
+        with self._lock:
+            recent = self._recent.get(id(data))
+            if recent is not None and recent[0] is data:
+                digest = recent[1]
+                if digest in self._memory or digest in self._spilled:
+                    return digest
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._recent[id(data)] = (data, digest)
+            while len(self._recent) > 4:
+                self._recent.popitem(last=False)
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+            elif digest not in self._spilled:
+                self._memory[digest] = data
+                self.memory_bytes += len(data)
+                self._spill()
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with self._lock:
+            data = self._memory.get(digest)
+            if data is not None:
+                self._memory.move_to_end(digest)
+                return data
+            if digest not in self._spilled:
+                raise KeyError(f"Unknown blob {digest}")
+        with open(os.path.join(self.spill_dir, digest), "rb") as f:
+            return f.read()
+
+    def _spill(self):
+        # Called with the lock held. The newest blob stays in memory even if it alone is too big.
+        while self.memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            digest, data = self._memory.popitem(last=False)
+            self.memory_bytes -= len(data)
+            path = os.path.join(self.spill_dir, digest)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            self._spilled.add(digest)
+
+
+class ImageRef:
+    """An image part of a message, encoded as prefix + base64 of the (policy-transcoded) blob on demand."""
+
+    __slots__ = ("digest", "prefix", "policy")
+
+    def __init__(self, digest: str, prefix: str = "", policy=None):
+        self.digest = digest
+        self.prefix = prefix
+        self.policy = policy
+
+    def materialize(self) -> str:
+        return image_cache.encode_blob(
+            blob_store, self.digest, self.prefix, self.policy
+        )
+
+    def __str__(self):
+        # Stands in for the payload in request hashes and logs
+        policy = self.policy.key if self.policy is not None else ""
+        return f"{self.prefix}<blob:{self.digest}|{policy}>"
+
+    __repr__ = __str__
+
+
+def materialize(messages: List[Dict]) -> List[Dict]:
+    """Returns messages with every ImageRef replaced by its encoding.
+
+    Only the containers holding an ImageRef are copied, the agent's own messages are left as they are.
+    """
+
+    def resolve(value):
+        if isinstance(value, ImageRef):
+            return value.materialize()
+        if isinstance(value, dict):
+            resolved = {key: resolve(item) for key, item in value.items()}
+            changed = any(resolved[key] is not value[key] for key in value)
+            return resolved if changed else value
+        if isinstance(value, list):
+            resolved = [resolve(item) for item in value]
+            changed = any(new is not old for new, old in zip(resolved, value))
+            return resolved if changed else value
+        return value
+
+    return resolve(messages)
+
+
+# Shared by all agents of the process
+blob_store = BlobStore.from_env()
+
+
+def _reset_after_fork():
+    # A forked child keeps the parent's blobs. Spilled files are content-addressed and written
+    # atomically, so sharing the spill directory is safe.
+    blob_store._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
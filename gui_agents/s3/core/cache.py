@@ -0,0 +1,278 @@
+"""Content-addressed, disk-backed cache of LLM responses, and request deduplication.
+
+Only deterministic calls (temperature 0) are worth caching, and only some agents make them
+(e.g. the grounding model or the behavior narrator), so caching is opt-in per LMMAgent:
+
+    agent = LMMAgent(engine_params, response_cache=ResponseCache.from_params(engine_params))
+
+where engine_params["response_cache"] is True (default location) or a cache directory, and
+engine_params["response_cache_max_mb"] optionally bounds the cache size.
+
+SingleFlight is the in-memory counterpart for agents shared by many concurrent callers: identical
+requests in flight at the same time are sent once, and their result is reused for a short TTL.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, List, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "agent_s")
+
+
+def request_hash(engine, messages: List[Dict], temperature, **kwargs) -> str:
+    """Stable hash of everything that determines a response.
+
+    Covers the engine type and model, the full messages (image payloads included, since they are
+    embedded in the messages), the temperature and any extra generation arguments.
+    """
+    header = {
+        "engine": type(engine).__name__,
+        "model": getattr(engine, "model", None),
+        "engine_temperature": getattr(engine, "temperature", None),
+        "temperature": temperature,
+        "kwargs": kwargs,
+    }
+    digest = hashlib.sha256()
+    digest.update(json.dumps(header, sort_keys=True, default=str).encode("utf-8"))
+    digest.update(json.dumps(messages, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_deterministic(engine, temperature) -> bool:
+    """True if neither the call nor an engine-forced temperature allows sampling."""
+    engine_temperature = getattr(engine, "temperature", None)
+    return not temperature and not engine_temperature
+
+
+class ResponseCache:
+    """Size-bounded LRU store of responses in a SQLite file, safe to share across processes."""
+
+    def __init__(self, cache_dir: Optional[str] = None, max_mb: float = 512):
+        cache_dir = cache_dir or os.getenv("AGENT_S_CACHE_DIR", DEFAULT_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "responses.sqlite")
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        conn = self._connection()
+        # WAL is a property of the database file, so setting it once covers every connection
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+            )
+
+    @classmethod
+    def from_params(cls, engine_params: Optional[Dict]) -> Optional["ResponseCache"]:
+        """Builds the cache requested by engine_params["response_cache"], or returns None if caching is off."""
+        if not engine_params or not engine_params.get("response_cache"):
+            return None
+        cache_dir = engine_params["response_cache"]
+        return cls(
+            cache_dir=cache_dir if isinstance(cache_dir, str) else None,
+            max_mb=engine_params.get("response_cache_max_mb", 512),
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the connection of the calling thread, opened on first use.
+
+        A connection must not be used from another thread, nor across a fork, so a forked child
+        opens its own.
+        """
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=30)
+            local.pid = os.getpid()
+        return local.conn
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "SELECT response FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE responses SET last_access = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, key: str, response: str):
+        if response is None:
+            return
+        size = len(response.encode("utf-8"))
+        with self._lock, self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[
+            0
+        ]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until the cache fits again
+        rows = conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+class SingleFlight:
+    """Collapses identical concurrent requests, from threads or coroutines, into one call.
+
+    The first caller of a key runs the call; callers arriving while it is in flight wait for it
+    and share its result (or exception). Results are kept for ttl seconds afterwards.
+    """
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self.calls = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        # key -> (expiry, result), in expiry order since the TTL is fixed
+        self._results = OrderedDict()
+
+    def _join(self, key: str):
+        """Returns (result future, whether the caller leads the call)."""
+        with self._lock:
+            now = time.time()
+            while self._results and next(iter(self._results.values()))[0] < now:
+                self._results.popitem(last=False)
+            if key in self._results:
+                self.shared += 1
+                future = Future()
+                future.set_result(self._results[key][1])
+                return future, False
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            self.calls += 1
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _finish(self, key: str, future: Future, result=None, error=None):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if error is None:
+                self._results[key] = (time.time() + self.ttl, result)
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def do(self, key: str, call: Callable):
+        """Returns call(), or the result of the identical call already in flight."""
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        result, error = None, None
+        try:
+            result = call()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # Also releases the waiters on KeyboardInterrupt or SystemExit in the leader
+            self._finish(key, future, result=result, error=error)
+        return result
+
+    async def ado(self, key: str, call: Callable[[], Awaitable]):
+        """Async variant of do, where call returns a coroutine."""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        result, error = None, None
+        try:
+            result = await call()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # Also releases the waiters if the leading coroutine is cancelled
+            self._finish(key, future, result=result, error=error)
+        return result
+
+    async def ado_batch(
+        self, keys: List[str], call: Callable[[List[str]], Awaitable[List]]
+    ) -> List:
+        """Batch variant of ado for distinct keys.
+
+        call(keys) is awaited with the keys not already in flight and returns their results in
+        order, with an exception in place of a failed one.
+
+        Returns:
+            The results of all keys in order, with the exception in place of a failed one.
+        """
+        joined = {key: self._join(key) for key in keys}
+        led = [key for key, (_, leader) in joined.items() if leader]
+        results, error = [], None
+        try:
+            if led:
+                results = await call(led)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # Also releases the waiters if the batch raised or was cancelled
+            for i, key in enumerate(led):
+                result = error if error is not None else results[i]
+                if isinstance(result, BaseException):
+                    self._finish(key, joined[key][0], error=result)
+                else:
+                    self._finish(key, joined[key][0], result=result)
+        outcomes = []
+        for key in keys:
+            try:
+                outcomes.append(await asyncio.wrap_future(joined[key][0]))
+            except Exception as e:
+                outcomes.append(e)
+        return outcomes
+
+    def stats(self) -> Dict:
+        total = self.calls + self.shared
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "shared_rate": self.shared / total if total else 0.0,
+        }
@@ -0,0 +1,214 @@
+"""Process-wide registry of provider SDK clients.
+
+Every engine asks this module for its client instead of constructing one, so all
+LMMAgents that talk to the same (provider, base_url, api_key) share one SDK client,
+and all clients of one SDK share one pooled, keep-alive HTTP transport. This keeps TLS
+connections warm across agents and steps instead of re-handshaking per call. The SDK
+default keep-alive expiry (5s) is shorter than a typical agent step, so it is raised here.
+
+Async clients (used by the agenerate APIs) are pooled the same way, but per event loop,
+since async connections cannot outlive the loop that opened them. Sync wrappers of the async
+APIs therefore run their coroutines with run_sync() on one long-lived background loop, rather
+than with asyncio.run(), whose fresh loop per call would open new clients and connections every
+time and leave them unclosed.
+
+The SDKs are imported when their first client is created, so importing this module (and the
+engines) does not pay for a provider that is never used.
+
+The pool can be tuned with the AGENT_S_HTTP_MAX_CONNECTIONS, AGENT_S_HTTP_MAX_KEEPALIVE
+and AGENT_S_HTTP_KEEPALIVE_EXPIRY environment variables, or with configure_http_pool().
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+_pool_config = {
+    "max_connections": int(os.getenv("AGENT_S_HTTP_MAX_CONNECTIONS", "100")),
+    "max_keepalive_connections": int(os.getenv("AGENT_S_HTTP_MAX_KEEPALIVE", "20")),
+    "keepalive_expiry": float(os.getenv("AGENT_S_HTTP_KEEPALIVE_EXPIRY", "120")),
+}
+
+_lock = threading.Lock()
+_http_clients: Dict[str, object] = {}
+_clients: Dict[Tuple, object] = {}
+# event loop -> {key: client}, including that loop's async HTTP transports
+_async_clients = weakref.WeakKeyDictionary()
+# Event loop of run_sync, started on first use
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def configure_http_pool(
+    max_connections: Optional[int] = None,
+    max_keepalive_connections: Optional[int] = None,
+    keepalive_expiry: Optional[float] = None,
+):
+    """Tune the shared connection pool.
+
+    Only clients created after this call use the new settings, so call it before
+    building any agents.
+    """
+    with _lock:
+        if max_connections is not None:
+            _pool_config["max_connections"] = max_connections
+        if max_keepalive_connections is not None:
+            _pool_config["max_keepalive_connections"] = max_keepalive_connections
+        if keepalive_expiry is not None:
+            _pool_config["keepalive_expiry"] = keepalive_expiry
+        _http_clients.clear()
+        _clients.clear()
+        _async_clients.clear()
+
+
+def _get_http_client(sdk, http_clients: Dict, is_async: bool) -> object:
+    # Each SDK pins its own httpx flavour, so the pool is shared per SDK module
+    http_client = http_clients.get(sdk.__name__)
+    if http_client is None:
+        limits = type(sdk.DEFAULT_CONNECTION_LIMITS)(**_pool_config)
+        if is_async:
+            http_client = sdk.DefaultAsyncHttpxClient(limits=limits)
+        else:
+            http_client = sdk.DefaultHttpxClient(limits=limits)
+        http_clients[sdk.__name__] = http_client
+    return http_client
+
+
+def _make_openai(api_key, base_url, http_clients, is_async, **kwargs):
+    import openai
+
+    client_cls = openai.AsyncOpenAI if is_async else openai.OpenAI
+    return client_cls(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=_get_http_client(openai, http_clients, is_async),
+        **kwargs,
+    )
+
+
+def _make_azure(api_key, base_url, http_clients, is_async, **kwargs):
+    import openai
+
+    client_cls = openai.AsyncAzureOpenAI if is_async else openai.AzureOpenAI
+    return client_cls(
+        api_key=api_key,
+        http_client=_get_http_client(openai, http_clients, is_async),
+        **kwargs,
+    )
+
+
+def _make_anthropic(api_key, base_url, http_clients, is_async, **kwargs):
+    import anthropic
+
+    client_cls = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+    return client_cls(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=_get_http_client(anthropic, http_clients, is_async),
+        **kwargs,
+    )
+
+
+_CLIENT_FACTORIES = {
+    "openai": _make_openai,
+    "azure": _make_azure,
+    "anthropic": _make_anthropic,
+}
+
+
+def get_client(provider: str, api_key: str, base_url: Optional[str] = None, **kwargs):
+    """Return the shared SDK client for (provider, base_url, api_key).
+
+    Args:
+        provider (str): One of "openai" (any OpenAI-compatible server), "azure" or "anthropic".
+        api_key (str): The API key the client authenticates with.
+        base_url (str): The endpoint of the API. None or "" selects the SDK default.
+        **kwargs: Extra SDK constructor arguments (e.g. organization, api_version). They are part of the key.
+
+    Returns:
+        The SDK client, created on first use.
+    """
+    if provider not in _CLIENT_FACTORIES:
+        raise ValueError(f"Unsupported client provider '{provider}'")
+    base_url = base_url or None
+    key = (provider, base_url, api_key, tuple(sorted(kwargs.items())))
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _CLIENT_FACTORIES[provider](
+                api_key=api_key,
+                base_url=base_url,
+                http_clients=_http_clients,
+                is_async=False,
+                **kwargs,
+            )
+            _clients[key] = client
+    return client
+
+
+def get_async_client(
+    provider: str, api_key: str, base_url: Optional[str] = None, **kwargs
+):
+    """Return the shared async SDK client for (provider, base_url, api_key) on the running event loop.
+
+    Takes the same arguments as get_client() and must be called from inside a coroutine.
+    """
+    if provider not in _CLIENT_FACTORIES:
+        raise ValueError(f"Unsupported client provider '{provider}'")
+    base_url = base_url or None
+    key = (provider, base_url, api_key, tuple(sorted(kwargs.items())))
+    loop = asyncio.get_running_loop()
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {"http": {}})
+        client = loop_clients.get(key)
+        if client is None:
+            client = _CLIENT_FACTORIES[provider](
+                api_key=api_key,
+                base_url=base_url,
+                http_clients=loop_clients["http"],
+                is_async=True,
+                **kwargs,
+            )
+            loop_clients[key] = client
+    return client
+
+
+def run_sync(coroutine):
+    """Runs coroutine on the process's background event loop and returns its result.
+
+    Blocks the calling thread, which can be any thread but the background loop's own.
+    """
+    global _background_loop
+    with _lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_background_loop.run_forever,
+                name="agent-s-async",
+                daemon=True,
+            ).start()
+        loop = _background_loop
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coroutine.close()
+        raise RuntimeError("run_sync cannot be called from the background event loop")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def _reset_after_fork():
+    # Connections must never be shared between a parent and a forked child
+    global _lock, _http_clients, _clients, _async_clients, _background_loop
+    _lock = threading.Lock()
+    _http_clients = {}
+    _clients = {}
+    _async_clients = weakref.WeakKeyDictionary()
+    # The loop's thread does not exist in the child
+    _background_loop = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
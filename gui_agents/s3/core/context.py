@@ -0,0 +1,176 @@
+"""Token-budgeted context window of an LMMAgent.
+
+Every agent keeps a running estimate of the input tokens of its messages (see
+rate_limit.estimate_tokens), updated as messages are added, so deciding whether the context must
+shrink costs O(1) per step. ContextWindow.fit then evicts, oldest first and only as far as needed:
+
+1. images beyond max_images,
+2. images, while the estimate exceeds max_tokens,
+3. the text of old assistant turns (the plans), replaced by a short placeholder,
+4. whole turns, i.e. a user message and the replies that follow it.
+
+The system prompt and the newest turn are never evicted. Every eviction rewrites the prompt from
+that point on, so each limit has some slack: eviction only starts once the limit is exceeded by
+the slack, and then goes back down to the limit. In between, the prompt prefix stays unchanged
+(and cacheable by the provider) for several steps.
+"""
+
+from typing import Dict, List, Optional
+
+from gui_agents.s3.core.rate_limit import estimate_tokens
+
+EVICTED_TEXT = "(Earlier plan omitted to save context.)"
+_EVICTED_CONTENT = [{"type": "text", "text": EVICTED_TEXT}]
+
+
+def _count_images(message: Dict) -> int:
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return 0
+    return sum(1 for part in content if "image" in part.get("type", ""))
+
+
+class ContextWindow:
+    """Tracks the estimated size of an agent's messages and trims them to the configured limits."""
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_images: Optional[int] = None,
+        max_turns: Optional[int] = None,
+        image_slack: int = 0,
+        token_slack: Optional[int] = None,
+    ):
+        """
+        Args:
+            max_tokens (int): Budget of estimated input tokens, None for no budget.
+            max_images (int): Number of most recent images kept, None for no limit.
+            max_turns (int): Number of most recent user turns kept, None for no limit.
+            image_slack (int): Images tolerated beyond max_images before evicting.
+            token_slack (int): Tokens tolerated beyond max_tokens before evicting, a tenth of
+                max_tokens by default.
+        """
+        self.max_tokens = max_tokens
+        self.max_images = max_images
+        self.max_turns = max_turns
+        self.image_slack = image_slack
+        self.token_slack = (
+            token_slack
+            if token_slack is not None
+            else (max_tokens // 10 if max_tokens else 0)
+        )
+        # Estimated tokens and images of each tracked message, None to recount
+        self._sizes: Optional[List[int]] = None
+        self._images: List[int] = []
+        self.tokens = 0
+        self.num_images = 0
+        self.num_turns = 0
+        self.evictions = {"images": 0, "texts": 0, "turns": 0}
+
+    @classmethod
+    def from_params(cls, engine_params: Optional[Dict]) -> "ContextWindow":
+        """Builds the window of an agent, with the budget of engine_params["context_budget"] if set."""
+        return cls(max_tokens=(engine_params or {}).get("context_budget"))
+
+    def invalidate(self):
+        """Forces a recount, after messages were changed other than by appending."""
+        self._sizes = None
+
+    def track(self, messages: List[Dict]):
+        """Counts the messages appended since the last call. Recounts all after invalidate()."""
+        if self._sizes is None or len(self._sizes) > len(messages):
+            self._sizes, self._images = [], []
+            self.tokens = self.num_images = self.num_turns = 0
+        for message in messages[len(self._sizes) :]:
+            self._add(message)
+
+    def _add(self, message: Dict):
+        size, images = estimate_tokens([message]), _count_images(message)
+        self._sizes.append(size)
+        self._images.append(images)
+        self.tokens += size
+        self.num_images += images
+        self.num_turns += message["role"] == "user"
+
+    def _pop(self, messages: List[Dict], index: int):
+        message = messages.pop(index)
+        self.tokens -= self._sizes.pop(index)
+        self.num_images -= self._images.pop(index)
+        self.num_turns -= message["role"] == "user"
+
+    def _resize(self, messages: List[Dict], index: int):
+        # Recounts a message whose content was trimmed in place
+        size, images = estimate_tokens([messages[index]]), _count_images(
+            messages[index]
+        )
+        self.tokens += size - self._sizes[index]
+        self.num_images += images - self._images[index]
+        self._sizes[index], self._images[index] = size, images
+
+    def _over_tokens(self, slack: int = 0) -> bool:
+        return self.max_tokens is not None and self.tokens > self.max_tokens + slack
+
+    def fit(self, messages: List[Dict]):
+        """Trims messages in place to the configured limits."""
+        self.track(messages)
+        if self.max_images is not None and (
+            self.num_images > self.max_images + self.image_slack
+        ):
+            self._evict_images(messages, lambda: self.num_images > self.max_images)
+        if self.max_turns is not None and self.num_turns > self.max_turns:
+            self._evict_turns(messages, lambda: self.num_turns > self.max_turns)
+        if not self._over_tokens(self.token_slack):
+            return
+        for evict in (self._evict_images, self._evict_texts, self._evict_turns):
+            evict(messages, self._over_tokens)
+            if not self._over_tokens():
+                return
+
+    def _last_turn_start(self, messages: List[Dict]) -> int:
+        for i in range(len(messages) - 1, 0, -1):
+            if messages[i]["role"] == "user":
+                return i
+        return len(messages)
+
+    def _evict_images(self, messages: List[Dict], over):
+        last_turn = self._last_turn_start(messages)
+        for i in range(1, last_turn):
+            if not over():
+                return
+            if not self._images[i]:
+                continue
+            messages[i]["content"] = [
+                part
+                for part in messages[i]["content"]
+                if "image" not in part.get("type", "")
+            ]
+            self.evictions["images"] += self._images[i]
+            self._resize(messages, i)
+
+    def _evict_texts(self, messages: List[Dict], over):
+        last_turn = self._last_turn_start(messages)
+        for i in range(1, last_turn):
+            if not over():
+                return
+            message = messages[i]
+            if message["role"] != "assistant" or message["content"] == _EVICTED_CONTENT:
+                continue
+            message["content"] = list(_EVICTED_CONTENT)
+            self.evictions["texts"] += 1
+            self._resize(messages, i)
+
+    def _evict_turns(self, messages: List[Dict], over):
+        while over() and 1 < self._last_turn_start(messages):
+            # A turn is a user message and the replies up to the next user message
+            self._pop(messages, 1)
+            while len(messages) > 1 and messages[1]["role"] != "user":
+                self._pop(messages, 1)
+            self.evictions["turns"] += 1
+
+    def stats(self) -> Dict:
+        return {
+            "tokens": self.tokens,
+            "images": self.num_images,
+            "turns": self.num_turns,
+            "evictions": dict(self.evictions),
+        }
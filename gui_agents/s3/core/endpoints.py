@@ -0,0 +1,133 @@
+"""Request routing across replicas of a self-hosted model server.
+
+Engines for self-hosted servers (vLLM, TGI) accept several endpoints as a list or as a
+comma-separated base_url. An EndpointPool then picks the endpoint of every request, either the
+one with the fewest outstanding requests or the better of two random picks, and ejects an
+endpoint after repeated failures. A background thread health-checks ejected endpoints
+(GET {base_url}/models) and puts them back into rotation once they answer again.
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import List, Optional, Union
+
+from gui_agents.s3.core.retry import is_provider_failure
+
+logger = logging.getLogger("desktopenv.agent")
+
+ROUTING_POLICIES = ("least_outstanding", "power_of_two")
+
+
+def parse_endpoints(base_url: Union[str, List[str], None]) -> List[str]:
+    """Splits a base_url given as a list or a comma-separated string into endpoint URLs."""
+    if not base_url:
+        return []
+    if isinstance(base_url, str):
+        base_url = base_url.split(",")
+    return [url.strip().rstrip("/") for url in base_url if url.strip()]
+
+
+class EndpointPool:
+    """Routes requests across endpoints and keeps track of their health."""
+
+    def __init__(
+        self,
+        endpoints: List[str],
+        api_key: Optional[str] = None,
+        policy: str = "least_outstanding",
+        max_failures: int = 2,
+        health_check_interval: float = 10.0,
+    ):
+        if not endpoints:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(
+                f"Unknown routing policy '{policy}', expected one of {ROUTING_POLICIES}"
+            )
+        self.endpoints = list(endpoints)
+        self.api_key = api_key
+        self.policy = policy
+        self.max_failures = max_failures
+        self.health_check_interval = health_check_interval
+        self.outstanding = {url: 0 for url in self.endpoints}
+        self.failures = {url: 0 for url in self.endpoints}
+        # url -> time of ejection
+        self.ejected = {}
+        self._lock = threading.Lock()
+        self._health_thread = None
+
+    @classmethod
+    def from_base_url(
+        cls, base_url, api_key=None, policy="least_outstanding", **kwargs
+    ) -> Optional["EndpointPool"]:
+        """Builds a pool if base_url names several endpoints. Returns None for a single endpoint."""
+        endpoints = parse_endpoints(base_url)
+        if len(endpoints) < 2:
+            return None
+        return cls(endpoints, api_key=api_key, policy=policy, **kwargs)
+
+    def acquire(self) -> str:
+        """Picks the endpoint of the next request and counts it as outstanding until release()."""
+        with self._lock:
+            healthy = [url for url in self.endpoints if url not in self.ejected]
+            if not healthy:
+                # Every endpoint is down, so try the one ejected longest ago rather than failing
+                healthy = [min(self.ejected, key=self.ejected.get)]
+            if self.policy == "power_of_two" and len(healthy) > 2:
+                candidates = random.sample(healthy, 2)
+            else:
+                candidates = healthy
+            fewest = min(self.outstanding[url] for url in candidates)
+            endpoint = random.choice(
+                [url for url in candidates if self.outstanding[url] == fewest]
+            )
+            self.outstanding[endpoint] += 1
+        return endpoint
+
+    def release(self, endpoint: str, error: Optional[Exception] = None):
+        """Ends a request. An endpoint is ejected after max_failures consecutive failures."""
+        with self._lock:
+            self.outstanding[endpoint] -= 1
+            # Only connection errors and 5xx say the endpoint is unhealthy, not a bad request or a
+            # local error raised while building the request
+            if error is None or not is_provider_failure(error):
+                self.failures[endpoint] = 0
+                return
+            self.failures[endpoint] += 1
+            if self.failures[endpoint] < self.max_failures or endpoint in self.ejected:
+                return
+            logger.warning("Ejecting endpoint %s after error: %s", endpoint, error)
+            self.ejected[endpoint] = time.time()
+            if self._health_thread is None or not self._health_thread.is_alive():
+                self._health_thread = threading.Thread(
+                    target=self._health_check_loop, daemon=True
+                )
+                self._health_thread.start()
+
+    def _is_healthy(self, endpoint: str) -> bool:
+        import httpx
+
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        try:
+            response = httpx.get(f"{endpoint}/models", headers=headers, timeout=5.0)
+        except httpx.HTTPError:
+            return False
+        return response.status_code == 200
+
+    def _health_check_loop(self):
+        # Runs while any endpoint is ejected
+        while True:
+            time.sleep(self.health_check_interval)
+            with self._lock:
+                ejected = list(self.ejected)
+                if not ejected:
+                    self._health_thread = None
+                    return
+            for endpoint in ejected:
+                if self._is_healthy(endpoint):
+                    logger.info("Endpoint %s is healthy again", endpoint)
+                    with self._lock:
+                        self.ejected.pop(endpoint, None)
+                        self.failures[endpoint] = 0
@@ -1,19 +1,296 @@
+import asyncio
 import os
+import time
+from contextlib import contextmanager
 
-import backoff
-from anthropic import Anthropic
-from openai import (
-    AzureOpenAI,
-    APIConnectionError,
-    APIError,
-    AzureOpenAI,
-    OpenAI,
-    RateLimitError,
-)
+from gui_agents.s3.core.client_pool import get_async_client, get_client, run_sync
+from gui_agents.s3.core.endpoints import EndpointPool
+from gui_agents.s3.core.rate_limit import RateLimiter, estimate_tokens
+from gui_agents.s3.core.replay import ReplayLog
+from gui_agents.s3.core.retry import CircuitBreaker, RetryPolicy, retried
+
+_EPHEMERAL = {"type": "ephemeral"}
+
+
+def _sum_usage(usages):
+    usages = [usage for usage in usages if usage]
+    if not usages:
+        return None
+    total = {}
+    for usage in usages:
+        for field, value in usage.items():
+            total[field] = total.get(field, 0) + (value or 0)
+    return total
 
 
 class LMMEngine:
-    pass
+    """Base class for all engines.
+
+    Subclasses describe how to reach their provider in _client_params() and how to build a
+    request in _request_params(). The sync generate() and async agenerate() entry points
+    share both, so the two paths always send identical requests.
+    """
+
+    # Provider key used by the client pool
+    provider = "openai"
+    # Shared request/token budget, see _init_rate_limiter
+    rate_limiter = None
+    # Normalized usage of the last request and retry counters, read by LMMAgent
+    last_usage = None
+    retry_count = 0
+    backoff_time = 0.0
+    circuit_rejections = 0
+    # See _init_retry
+    retry_policy = RetryPolicy()
+    circuit_breaker = None
+    # Replicas to route requests across, see _routed_client
+    endpoint_pool = None
+    # Default bound on the concurrent requests of agenerate_batch
+    batch_max_in_flight = 8
+
+    def _client_params(self):
+        """Returns the keyword arguments for client_pool.get_client, validating credentials."""
+        raise NotImplementedError
+
+    def _request_params(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        """Returns the keyword arguments for chat.completions.create."""
+        raise NotImplementedError
+
+    def _parse_response(self, completion):
+        return completion.choices[0].message.content
+
+    def _endpoint(self):
+        return getattr(self, "base_url", None) or getattr(self, "azure_endpoint", None)
+
+    def _init_rate_limiter(self, rate_limit=-1, token_rate_limit=-1):
+        """Sets up the cross-process limiter for this engine's (type, model, endpoint) budget."""
+        endpoint = self._endpoint()
+        self.rate_limiter = RateLimiter.from_params(
+            f"{type(self).__name__}|{getattr(self, 'model', None)}|{endpoint}",
+            rate_limit=rate_limit,
+            token_rate_limit=token_rate_limit,
+        )
+
+    def _init_retry(
+        self,
+        retry_max_time=60.0,
+        retry_max_attempts=8,
+        circuit_failure_threshold=5,
+        circuit_reset_timeout=30.0,
+        **kwargs,
+    ):
+        """Sets up this engine's retry policy and the circuit breaker of its provider endpoint."""
+        self.retry_policy = RetryPolicy(
+            max_time=retry_max_time, max_attempts=retry_max_attempts
+        )
+        self.circuit_breaker = CircuitBreaker.for_key(
+            f"{self.provider}|{self._endpoint()}",
+            failure_threshold=circuit_failure_threshold,
+            reset_timeout=circuit_reset_timeout,
+        )
+
+    def _acquire_rate_limit(self, messages):
+        """Waits for budget for one request. Returns the token estimate that was debited."""
+        if self.rate_limiter is None:
+            return 0
+        estimate = estimate_tokens(messages)
+        self.rate_limiter.acquire(estimate)
+        return estimate
+
+    async def _aacquire_rate_limit(self, messages):
+        if self.rate_limiter is None:
+            return 0
+        estimate = estimate_tokens(messages)
+        await self.rate_limiter.aacquire(estimate)
+        return estimate
+
+    def _usage(self, response):
+        """Normalizes the usage block of a response. Returns None if the provider did not report one."""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return None
+        prompt_details = getattr(usage, "prompt_tokens_details", None)
+        completion_details = getattr(usage, "completion_tokens_details", None)
+        return {
+            "input_tokens": usage.prompt_tokens or 0,
+            "cached_tokens": getattr(prompt_details, "cached_tokens", None) or 0,
+            "output_tokens": usage.completion_tokens or 0,
+            "thinking_tokens": getattr(completion_details, "reasoning_tokens", None)
+            or 0,
+        }
+
+    def _rate_limited_tokens(self, usage):
+        return usage["input_tokens"] + usage["output_tokens"]
+
+    def _record_usage(self, estimate, usage):
+        """Keeps the usage of the request for the calling LMMAgent and settles the rate limiter with it."""
+        self.last_usage = usage
+        if self.rate_limiter is not None and usage is not None:
+            self.rate_limiter.settle(estimate, self._rate_limited_tokens(usage))
+
+    def _get_client(self):
+        if not self.llm_client:
+            # Retries are left to retry_policy, the SDK must not retry on its own
+            self.llm_client = get_client(
+                self.provider, **self._client_params(), max_retries=0
+            )
+        return self.llm_client
+
+    def _get_async_client(self):
+        # Async clients are bound to the running event loop, the pool caches them per loop
+        return get_async_client(self.provider, **self._client_params(), max_retries=0)
+
+    @contextmanager
+    def _routed_client(self, is_async=False):
+        """Yields the client for one request, on the endpoint picked by endpoint_pool if there is one."""
+        if self.endpoint_pool is None:
+            yield self._get_async_client() if is_async else self._get_client()
+            return
+        endpoint = self.endpoint_pool.acquire()
+        # Fail over to another replica through the engine's retries
+        params = {**self._client_params(), "base_url": endpoint, "max_retries": 0}
+        error = None
+        try:
+            if is_async:
+                yield get_async_client(self.provider, **params)
+            else:
+                yield get_client(self.provider, **params)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Also on cancellation, which must not leave the replica looking busy
+            self.endpoint_pool.release(endpoint, error=error)
+
+    @retried
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        """Generate the next message based on previous messages"""
+        estimate = self._acquire_rate_limit(messages)
+        with self._routed_client() as client:
+            completion = client.chat.completions.create(
+                **self._request_params(
+                    messages,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                )
+            )
+        self._record_usage(estimate, self._usage(completion))
+        return self._parse_response(completion)
+
+    @retried
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        """Async variant of generate, with the same request and retry behavior"""
+        estimate = await self._aacquire_rate_limit(messages)
+        with self._routed_client(is_async=True) as client:
+            completion = await client.chat.completions.create(
+                **self._request_params(
+                    messages,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                )
+            )
+        self._record_usage(estimate, self._usage(completion))
+        return self._parse_response(completion)
+
+    @retried
+    def _open_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        # Only opening the stream is retried, a stream that fails midway surfaces to the caller
+        estimate = self._acquire_rate_limit(messages)
+        # A routed stream counts as outstanding until its response headers arrived
+        with self._routed_client() as client:
+            stream = client.chat.completions.create(
+                **self._request_params(
+                    messages,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                ),
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+        return stream, estimate
+
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        """Generate the next message as a stream of text deltas.
+
+        Closing the returned generator closes the underlying HTTP response, which stops
+        the generation on the provider side.
+        """
+        stream, estimate = self._open_stream(
+            messages, temperature=temperature, max_new_tokens=max_new_tokens, **kwargs
+        )
+        usage = None
+        try:
+            for chunk in stream:
+                # Usage arrives in a final chunk without choices, so a stopped stream has none
+                if getattr(chunk, "usage", None):
+                    usage = self._usage(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+            self._record_usage(estimate, usage)
+
+    async def agenerate_batch(
+        self,
+        list_of_messages,
+        temperature=0.0,
+        max_new_tokens=None,
+        max_in_flight=None,
+        **kwargs,
+    ):
+        """Generate responses for many independent requests, submitted concurrently.
+
+        At most max_in_flight (default batch_max_in_flight) requests are outstanding at a time,
+        so a server with continuous batching stays busy without being flooded. Each request is
+        retried on its own, and last_usage holds the summed usage of the batch.
+
+        Returns:
+            The responses in the order of list_of_messages. A request that failed after its
+            retries has its exception in place of the response.
+        """
+        semaphore = asyncio.Semaphore(max_in_flight or self.batch_max_in_flight)
+        usages = []
+
+        async def generate_one(messages):
+            async with semaphore:
+                response = await self.agenerate(
+                    messages,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                )
+                # No other coroutine ran since agenerate set last_usage
+                usages.append(self.last_usage)
+                return response
+
+        responses = await asyncio.gather(
+            *[generate_one(messages) for messages in list_of_messages],
+            return_exceptions=True,
+        )
+        self.last_usage = _sum_usage(usages)
+        return responses
+
+    def generate_batch(
+        self,
+        list_of_messages,
+        temperature=0.0,
+        max_new_tokens=None,
+        max_in_flight=None,
+        **kwargs,
+    ):
+        """Sync variant of agenerate_batch, run on the shared background event loop."""
+        return run_sync(
+            self.agenerate_batch(
+                list_of_messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                max_in_flight=max_in_flight,
+                **kwargs,
+            )
+        )
 
 
 class LMMEngineOpenAI(LMMEngine):
@@ -23,6 +300,7 @@ class LMMEngineOpenAI(LMMEngine):
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_rate_limit=-1,
         temperature=None,
         organization=None,
         **kwargs,
@@ -32,124 +310,272 @@ class LMMEngineOpenAI(LMMEngine):
         self.base_url = base_url
         self.api_key = api_key
         self.organization = organization
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
         self.llm_client = None
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
         self.temperature = temperature  # Can force temperature to be the same (in the case of o3 requiring temperature to be 1)
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("OPENAI_API_KEY")
         if api_key is None:
             raise ValueError(
                 "An API Key needs to be provided in either the api_key parameter or as an environment variable named OPENAI_API_KEY"
             )
         organization = self.organization or os.getenv("OPENAI_ORG_ID")
-        if not self.llm_client:
-            if not self.base_url:
-                self.llm_client = OpenAI(api_key=api_key, organization=organization)
-            else:
-                self.llm_client = OpenAI(
-                    base_url=self.base_url, api_key=api_key, organization=organization
-                )
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                # max_completion_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=(
-                    temperature if self.temperature is None else self.temperature
-                ),
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return {
+            "api_key": api_key,
+            "base_url": self.base_url,
+            "organization": organization,
+        }
+
+    def _request_params(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return dict(
+            model=self.model,
+            messages=messages,
+            # max_completion_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=(temperature if self.temperature is None else self.temperature),
+            **kwargs,
         )
 
 
 class LMMEngineAnthropic(LMMEngine):
+    provider = "anthropic"
+
     def __init__(
         self,
         base_url=None,
         api_key=None,
         model=None,
         thinking=False,
+        rate_limit=-1,
+        token_rate_limit=-1,
         temperature=None,
+        prompt_caching=True,
         **kwargs,
     ):
         assert model is not None, "model must be provided"
         self.model = model
         self.thinking = thinking
+        # Mark the system prompt and the trajectory prefix as cacheable, see _cache_breakpoints
+        self.prompt_caching = prompt_caching
+        self.base_url = base_url
         self.api_key = api_key
         self.llm_client = None
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("ANTHROPIC_API_KEY")
         if api_key is None:
             raise ValueError(
                 "An API Key needs to be provided in either the api_key parameter or as an environment variable named ANTHROPIC_API_KEY"
             )
-        self.llm_client = Anthropic(api_key=api_key)
-        # Use the instance temperature if not specified in the call
-        temp = self.temperature if temperature is None else temperature
-        if self.thinking:
-            full_response = self.llm_client.messages.create(
-                system=messages[0]["content"][0]["text"],
+        return {"api_key": api_key, "base_url": self.base_url}
+
+    def _cache_breakpoints(self, messages):
+        """Returns the system prompt and turns with cache_control set on the stable prefix.
+
+        Breakpoints go on the system prompt and on the last two user turns: the newest one
+        writes the cache for the next step, the previous one reads what the last step wrote.
+        The caller's messages are left untouched.
+        """
+        system = messages[0]["content"][0]["text"]
+        turns = messages[1:]
+        if not self.prompt_caching:
+            return system, turns
+        system = [{"type": "text", "text": system, "cache_control": _EPHEMERAL}]
+        turns = list(turns)
+        user_turns = [i for i, turn in enumerate(turns) if turn["role"] == "user"]
+        for i in user_turns[-2:]:
+            content = turns[i]["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            content = list(content)
+            content[-1] = {**content[-1], "cache_control": _EPHEMERAL}
+            turns[i] = {**turns[i], "content": content}
+        return system, turns
+
+    def _request_params(
+        self, messages, temperature=0.0, max_new_tokens=None, thinking=False, **kwargs
+    ):
+        system, turns = self._cache_breakpoints(messages)
+        if thinking:
+            return dict(
+                system=system,
                 model=self.model,
-                messages=messages[1:],
+                messages=turns,
                 max_tokens=8192,
                 thinking={"type": "enabled", "budget_tokens": 4096},
                 **kwargs,
             )
-            thoughts = full_response.content[0].thinking
+        # Use the instance temperature if not specified in the call
+        temp = self.temperature if temperature is None else temperature
+        return dict(
+            system=system,
+            model=self.model,
+            messages=turns,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temp,
+            **kwargs,
+        )
+
+    def _parse_response(self, full_response):
+        if self.thinking:
             return full_response.content[1].text
-        return (
-            self.llm_client.messages.create(
-                system=messages[0]["content"][0]["text"],
-                model=self.model,
-                messages=messages[1:],
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temp,
+        return full_response.content[0].text
+
+    def _usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return None
+        # Anthropic reports cache reads and writes separately from the uncached input_tokens
+        cached = getattr(usage, "cache_read_input_tokens", None) or 0
+        created = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return {
+            "input_tokens": (usage.input_tokens or 0) + cached + created,
+            "cached_tokens": cached,
+            "cache_creation_tokens": created,
+            "output_tokens": usage.output_tokens or 0,
+        }
+
+    def _rate_limited_tokens(self, usage):
+        # Cache reads do not count towards Anthropic's input token limits
+        return usage["input_tokens"] - usage["cached_tokens"] + usage["output_tokens"]
+
+    @staticmethod
+    def _format_thinking_response(full_response):
+        thoughts = full_response.content[0].thinking
+        answer = full_response.content[1].text
+        return f"<thoughts>\n{thoughts}\n</thoughts>\n\n<answer>\n{answer}\n</answer>\n"
+
+    @retried
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        client = self._get_client()
+        estimate = self._acquire_rate_limit(messages)
+        full_response = client.messages.create(
+            **self._request_params(
+                messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                thinking=self.thinking,
+                **kwargs,
+            )
+        )
+        self._record_usage(estimate, self._usage(full_response))
+        return self._parse_response(full_response)
+
+    @retried
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        client = self._get_async_client()
+        estimate = await self._aacquire_rate_limit(messages)
+        full_response = await client.messages.create(
+            **self._request_params(
+                messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                thinking=self.thinking,
                 **kwargs,
             )
-            .content[0]
-            .text
         )
+        self._record_usage(estimate, self._usage(full_response))
+        return self._parse_response(full_response)
+
+    @retried
+    def _open_stream(
+        self, messages, temperature=0.0, max_new_tokens=None, thinking=None, **kwargs
+    ):
+        client = self._get_client()
+        estimate = self._acquire_rate_limit(messages)
+        stream = client.messages.create(
+            **self._request_params(
+                messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                thinking=self.thinking if thinking is None else thinking,
+                **kwargs,
+            ),
+            stream=True,
+        )
+        return stream, estimate
+
+    def generate_stream(
+        self, messages, temperature=0.0, max_new_tokens=None, thinking=None, **kwargs
+    ):
+        """Generate the next message as a stream of text deltas.
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
+        With thinking=True the deltas are framed like generate_with_thinking, as
+        <thoughts>...</thoughts> followed by <answer>...</answer>.
+        """
+        keep_thoughts = bool(thinking)
+        stream, estimate = self._open_stream(
+            messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            thinking=thinking,
+            **kwargs,
+        )
+        usage = None
+        # Characters streamed, to estimate the output of a stream closed before message_delta
+        streamed_chars = 0
+        output_reported = False
+        try:
+            in_thoughts = False
+            for event in stream:
+                # Input usage comes with message_start, the output count with message_delta
+                if event.type == "message_start":
+                    usage = self._usage(event.message)
+                elif event.type == "message_delta" and usage is not None:
+                    usage["output_tokens"] = event.usage.output_tokens or 0
+                    output_reported = True
+                if event.type != "content_block_delta":
+                    continue
+                if event.delta.type == "thinking_delta":
+                    streamed_chars += len(event.delta.thinking)
+                    if keep_thoughts:
+                        if not in_thoughts:
+                            in_thoughts = True
+                            yield "<thoughts>\n"
+                        yield event.delta.thinking
+                elif event.delta.type == "text_delta":
+                    streamed_chars += len(event.delta.text)
+                    if in_thoughts:
+                        in_thoughts = False
+                        yield "\n</thoughts>\n\n<answer>\n"
+                    yield event.delta.text
+        finally:
+            stream.close()
+            if usage is not None and not output_reported:
+                usage["output_tokens"] = streamed_chars // 4
+                usage["estimated_calls"] = 1
+            self._record_usage(estimate, usage)
+
+    @retried
     # Compatible with Claude-3.7 Sonnet thinking mode
     def generate_with_thinking(
         self, messages, temperature=0.0, max_new_tokens=None, **kwargs
     ):
         """Generate the next message based on previous messages, and keeps the thinking tokens"""
-        api_key = self.api_key or os.getenv("ANTHROPIC_API_KEY")
-        if api_key is None:
-            raise ValueError(
-                "An API Key needs to be provided in either the api_key parameter or as an environment variable named ANTHROPIC_API_KEY"
-            )
-        self.llm_client = Anthropic(api_key=api_key)
-        full_response = self.llm_client.messages.create(
-            system=messages[0]["content"][0]["text"],
-            model=self.model,
-            messages=messages[1:],
-            max_tokens=8192,
-            thinking={"type": "enabled", "budget_tokens": 4096},
-            **kwargs,
+        client = self._get_client()
+        estimate = self._acquire_rate_limit(messages)
+        full_response = client.messages.create(
+            **self._request_params(messages, thinking=True, **kwargs)
         )
+        self._record_usage(estimate, self._usage(full_response))
+        return self._format_thinking_response(full_response)
 
-        thoughts = full_response.content[0].thinking
-        answer = full_response.content[1].text
-        full_response = (
-            f"<thoughts>\n{thoughts}\n</thoughts>\n\n<answer>\n{answer}\n</answer>\n"
+    @retried
+    async def agenerate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        """Async variant of generate_with_thinking"""
+        client = self._get_async_client()
+        estimate = await self._aacquire_rate_limit(messages)
+        full_response = await client.messages.create(
+            **self._request_params(messages, thinking=True, **kwargs)
         )
-        return full_response
+        self._record_usage(estimate, self._usage(full_response))
+        return self._format_thinking_response(full_response)
 
 
 class LMMEngineGemini(LMMEngine):
@@ -159,6 +585,7 @@ class LMMEngineGemini(LMMEngine):
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_rate_limit=-1,
         temperature=None,
         **kwargs,
     ):
@@ -166,14 +593,12 @@ class LMMEngineGemini(LMMEngine):
         self.model = model
         self.base_url = base_url
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
         self.llm_client = None
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("GEMINI_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -184,20 +609,17 @@ class LMMEngineGemini(LMMEngine):
             raise ValueError(
                 "An endpoint URL needs to be provided in either the endpoint_url parameter or as an environment variable named GEMINI_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
+        return {"api_key": api_key, "base_url": base_url}
+
+    def _request_params(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
         # Use the temperature passed to generate, otherwise use the instance's temperature, otherwise default to 0.0
         temp = self.temperature if temperature is None else temperature
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temp,
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return dict(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temp,
+            **kwargs,
         )
 
 
@@ -208,6 +630,7 @@ class LMMEngineOpenRouter(LMMEngine):
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_rate_limit=-1,
         temperature=None,
         **kwargs,
     ):
@@ -215,14 +638,12 @@ class LMMEngineOpenRouter(LMMEngine):
         self.model = model
         self.base_url = base_url
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
         self.llm_client = None
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("OPENROUTER_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -233,24 +654,23 @@ class LMMEngineOpenRouter(LMMEngine):
             raise ValueError(
                 "An endpoint URL needs to be provided in either the endpoint_url parameter or as an environment variable named OPEN_ROUTER_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
+        return {"api_key": api_key, "base_url": base_url}
+
+    def _request_params(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
         # Use self.temperature if set, otherwise use the temperature argument
         temp = self.temperature if self.temperature is not None else temperature
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temp,
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return dict(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temp,
+            **kwargs,
         )
 
 
 class LMMEngineAzureOpenAI(LMMEngine):
+    provider = "azure"
+
     def __init__(
         self,
         base_url=None,
@@ -259,6 +679,7 @@ class LMMEngineAzureOpenAI(LMMEngine):
         model=None,
         api_version=None,
         rate_limit=-1,
+        token_rate_limit=-1,
         temperature=None,
         **kwargs,
     ):
@@ -267,15 +688,12 @@ class LMMEngineAzureOpenAI(LMMEngine):
         self.api_version = api_version
         self.api_key = api_key
         self.azure_endpoint = azure_endpoint
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
         self.llm_client = None
-        self.cost = 0.0
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("AZURE_OPENAI_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -291,24 +709,30 @@ class LMMEngineAzureOpenAI(LMMEngine):
             raise ValueError(
                 "An Azure API endpoint needs to be provided in either the azure_endpoint parameter or as an environment variable named AZURE_OPENAI_ENDPOINT"
             )
-        if not self.llm_client:
-            self.llm_client = AzureOpenAI(
-                azure_endpoint=azure_endpoint,
-                api_key=api_key,
-                api_version=api_version,
-            )
+        return {
+            "api_key": api_key,
+            "azure_endpoint": azure_endpoint,
+            "api_version": api_version,
+        }
+
+    def _request_params(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
         # Use self.temperature if set, otherwise use the temperature argument
         temp = self.temperature if self.temperature is not None else temperature
-        completion = self.llm_client.chat.completions.create(
+        return dict(
             model=self.model,
             messages=messages,
             max_tokens=max_new_tokens if max_new_tokens else 4096,
             temperature=temp,
             **kwargs,
         )
-        total_tokens = completion.usage.total_tokens
-        self.cost += 0.02 * ((total_tokens + 500) / 1000)
-        return completion.choices[0].message.content
+
+    def _usage(self, response):
+        usage = super()._usage(response)
+        if usage is not None:
+            # Flat-rate cost approximation, kept from the original Azure accounting
+            total_tokens = usage["input_tokens"] + usage["output_tokens"]
+            usage["cost"] = 0.02 * ((total_tokens + 500) / 1000)
+        return usage
 
 
 class LMMEnginevLLM(LMMEngine):
@@ -318,44 +742,56 @@ class LMMEnginevLLM(LMMEngine):
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_rate_limit=-1,
         temperature=None,
+        routing_policy="least_outstanding",
+        batch_max_in_flight=64,
         **kwargs,
     ):
         assert model is not None, "model must be provided"
         self.model = model
         self.api_key = api_key
+        # A vLLM server batches concurrent requests, so batches keep many in flight
+        self.batch_max_in_flight = batch_max_in_flight
+        # A list or comma-separated string of replicas is load-balanced by an EndpointPool
         self.base_url = base_url
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.endpoint_pool = EndpointPool.from_base_url(
+            base_url or os.getenv("vLLM_ENDPOINT_URL"),
+            api_key=api_key or os.getenv("vLLM_API_KEY"),
+            policy=routing_policy,
+        )
         self.llm_client = None
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(
-        self,
-        messages,
-        temperature=0.0,
-        top_p=0.8,
-        repetition_penalty=1.05,
-        max_new_tokens=512,
-        **kwargs,
-    ):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("vLLM_API_KEY")
         if api_key is None:
             raise ValueError(
                 "A vLLM API key needs to be provided in either the api_key parameter or as an environment variable named vLLM_API_KEY"
             )
         base_url = self.base_url or os.getenv("vLLM_ENDPOINT_URL")
+        if isinstance(base_url, list):
+            base_url = base_url[0]
         if base_url is None:
             raise ValueError(
                 "An endpoint URL needs to be provided in either the endpoint_url parameter or as an environment variable named vLLM_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
+        return {"api_key": api_key, "base_url": base_url}
+
+    def _request_params(
+        self,
+        messages,
+        temperature=0.0,
+        max_new_tokens=512,
+        top_p=0.8,
+        repetition_penalty=1.05,
+        **kwargs,
+    ):
         # Use self.temperature if set, otherwise use the temperature argument
         temp = self.temperature if self.temperature is not None else temperature
-        completion = self.llm_client.chat.completions.create(
+        return dict(
             model=self.model,
             messages=messages,
             max_tokens=max_new_tokens if max_new_tokens else 4096,
@@ -363,60 +799,74 @@ class LMMEnginevLLM(LMMEngine):
             top_p=top_p,
             extra_body={"repetition_penalty": repetition_penalty},
         )
-        return completion.choices[0].message.content
 
 
 class LMMEngineHuggingFace(LMMEngine):
-    def __init__(self, base_url=None, api_key=None, rate_limit=-1, **kwargs):
+    def __init__(
+        self,
+        base_url=None,
+        api_key=None,
+        rate_limit=-1,
+        token_rate_limit=-1,
+        routing_policy="least_outstanding",
+        **kwargs,
+    ):
+        # A list or comma-separated string of replicas is load-balanced by an EndpointPool
         self.base_url = base_url
+        self.endpoint_pool = EndpointPool.from_base_url(
+            base_url or os.getenv("HF_ENDPOINT_URL"),
+            api_key=api_key or os.getenv("HF_TOKEN"),
+            policy=routing_policy,
+        )
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
         self.llm_client = None
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("HF_TOKEN")
         if api_key is None:
             raise ValueError(
                 "A HuggingFace token needs to be provided in either the api_key parameter or as an environment variable named HF_TOKEN"
             )
         base_url = self.base_url or os.getenv("HF_ENDPOINT_URL")
+        if isinstance(base_url, list):
+            base_url = base_url[0]
         if base_url is None:
             raise ValueError(
                 "HuggingFace endpoint must be provided as base_url parameter or as an environment variable named HF_ENDPOINT_URL."
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
-        return (
-            self.llm_client.chat.completions.create(
-                model="tgi",
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temperature,
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return {"api_key": api_key, "base_url": base_url}
+
+    def _request_params(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return dict(
+            model="tgi",
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temperature,
+            **kwargs,
         )
 
 
 class LMMEngineParasail(LMMEngine):
     def __init__(
-        self, base_url=None, api_key=None, model=None, rate_limit=-1, **kwargs
+        self,
+        base_url=None,
+        api_key=None,
+        model=None,
+        rate_limit=-1,
+        token_rate_limit=-1,
+        **kwargs,
     ):
         assert model is not None, "Parasail model id must be provided"
         self.base_url = base_url
         self.model = model
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
         self.llm_client = None
+        self._init_rate_limiter(rate_limit, token_rate_limit)
+        self._init_retry(**kwargs)
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_params(self):
         api_key = self.api_key or os.getenv("PARASAIL_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -427,19 +877,76 @@ class LMMEngineParasail(LMMEngine):
             raise ValueError(
                 "Parasail endpoint must be provided as base_url parameter or as an environment variable named PARASAIL_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(
-                base_url=base_url if base_url else "https://api.parasail.io/v1",
-                api_key=api_key,
-            )
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temperature,
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return {
+            "api_key": api_key,
+            "base_url": base_url if base_url else "https://api.parasail.io/v1",
+        }
+
+    def _request_params(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return dict(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temperature,
+            **kwargs,
         )
+
+
+class LMMEngineReplay(LMMEngine):
+    """Serves the responses of a recording (see core/replay.py) instead of calling a provider.
+
+    Args:
+        replay_path (str): The JSONL file written by an agent with engine_params["record_path"].
+        role (str): The recorded agent name to replay, set by LMMAgent from its name.
+        replay_by (str): "index" (recorded call order) or "fingerprint" (identical requests).
+        replay_latency: Synthetic latency per call in seconds, or "recorded" for the recorded latencies.
+        replay_latency_scale (float): Multiplier applied to the latency.
+    """
+
+    def __init__(
+        self,
+        replay_path=None,
+        role=None,
+        model="replay",
+        replay_by="index",
+        replay_latency=0.0,
+        replay_latency_scale=1.0,
+        **kwargs,
+    ):
+        assert replay_path is not None, "replay_path must be provided"
+        self.replay_log = ReplayLog.for_path(replay_path)
+        self.role = role
+        self.model = model
+        self.replay_by = replay_by
+        self.replay_latency = replay_latency
+        self.replay_latency_scale = replay_latency_scale
+        self.temperature = None
+        self.llm_client = None
+
+    def _replay(self, messages):
+        entry = self.replay_log.next(self.role, messages, by=self.replay_by)
+        self.last_usage = entry.get("usage")
+        if self.replay_latency == "recorded":
+            latency = entry.get("latency") or 0.0
+        else:
+            latency = self.replay_latency
+        return entry["response"], latency * self.replay_latency_scale
+
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        response, latency = self._replay(messages)
+        time.sleep(latency)
+        return response
+
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        response, latency = self._replay(messages)
+        await asyncio.sleep(latency)
+        return response
+
+    generate_with_thinking = generate
+    agenerate_with_thinking = agenerate
+
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        # The latency is spent before the first delta, the response follows line by line
+        response, latency = self._replay(messages)
+        time.sleep(latency)
+        yield from response.splitlines(keepends=True)
@@ -0,0 +1,175 @@
+"""Hedged requests against tail latency.
+
+With engine_params["hedge_after"] set, an LMMAgent that has not received a response after that
+many seconds sends the same request again, to a second engine built from
+engine_params["hedge_engine_params"] (or from the same params), and uses whichever response
+arrives first. With engine_params["hedge_quantile"] (e.g. 0.95) the deadline follows that
+quantile of the observed latencies once enough calls were made. The number of hedges fired and
+won is reported through the agent's UsageMetrics, so the deadline can be tuned.
+"""
+
+import asyncio
+import copy
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Callable, Dict, Optional
+
+from gui_agents.s3.core.thread_pool import SharedThreadPool
+
+# Observed latencies needed before the quantile replaces the configured deadline
+MIN_SAMPLES = 20
+
+_pool = SharedThreadPool(max_workers=32, thread_name_prefix="hedge")
+
+
+class HedgePolicy:
+    """Decides when to hedge, from a fixed deadline or a latency quantile."""
+
+    def __init__(
+        self, hedge_after: float, quantile: Optional[float] = None, window: int = 200
+    ):
+        self.hedge_after = hedge_after
+        self.quantile = quantile
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_params(cls, engine_params: Optional[Dict]) -> Optional["HedgePolicy"]:
+        """Builds the policy requested by engine_params["hedge_after"], or returns None if hedging is off."""
+        if not engine_params or not engine_params.get("hedge_after"):
+            return None
+        return cls(
+            engine_params["hedge_after"],
+            quantile=engine_params.get("hedge_quantile"),
+        )
+
+    def deadline(self) -> float:
+        with self._lock:
+            if self.quantile is None or len(self.latencies) < MIN_SAMPLES:
+                return self.hedge_after
+            latencies = sorted(self.latencies)
+        return latencies[int(self.quantile * (len(latencies) - 1))]
+
+    def observe(self, latency: float):
+        with self._lock:
+            self.latencies.append(latency)
+
+
+# Engine state written by a request and read by LMMAgent after the call
+_CALL_STATE = ("last_usage", "retry_count", "backoff_time", "circuit_rejections")
+
+
+class _AttemptBreaker:
+    """Circuit breaker of one hedged request, reporting it as cancelled once it has lost."""
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.abandoned = False
+
+    def before_call(self):
+        self.breaker.before_call()
+
+    def record_success(self):
+        if self.abandoned:
+            self.breaker.record_cancelled()
+        else:
+            self.breaker.record_success()
+
+    def record_failure(self, error: Exception):
+        if self.abandoned:
+            self.breaker.record_cancelled()
+        else:
+            self.breaker.record_failure(error)
+
+    def record_cancelled(self):
+        self.breaker.record_cancelled()
+
+
+def _attempt(engine):
+    """Returns a copy of engine for one request."""
+    attempt = copy.copy(engine)
+    if engine.circuit_breaker is not None:
+        attempt.circuit_breaker = _AttemptBreaker(engine.circuit_breaker)
+    return attempt
+
+
+def _abandon(attempt):
+    # Like a cancelled async request, the loser's outcome must not close or reopen the circuit
+    if attempt.circuit_breaker is not None:
+        attempt.circuit_breaker.abandoned = True
+
+
+def _adopt(engine, attempt):
+    """Takes over the call state of attempt, a copy of engine made for one request."""
+    for name in _CALL_STATE:
+        setattr(engine, name, getattr(attempt, name))
+
+
+def hedged_call(policy: HedgePolicy, call: Callable, primary, secondary):
+    """Runs call(primary), and also call(secondary) if the first has not returned by the deadline.
+
+    Returns (response, engine that produced it, whether a hedge was fired). A thread cannot be
+    interrupted, so a losing request runs to completion in the background and is discarded. Each
+    request therefore runs on its own copy of its engine, and only the usage and retry counters of
+    the request that is used are copied back, so a loser finishing later cannot change them. The
+    loser's result is reported to the circuit breaker as cancelled.
+    """
+    executor = _pool.get()
+    start = time.time()
+    attempts = {primary: _attempt(primary)}
+    first = executor.submit(call, attempts[primary])
+    pending = {first: primary}
+    done, _ = wait([first], timeout=policy.deadline())
+    if done:
+        policy.observe(time.time() - start)
+        try:
+            return first.result(), primary, False
+        finally:
+            _adopt(primary, attempts[primary])
+
+    attempts[secondary] = _attempt(secondary)
+    pending[executor.submit(call, attempts[secondary])] = secondary
+    error, failed = None, None
+    while pending:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            engine = pending.pop(future)
+            if future.exception() is None:
+                for other, other_engine in pending.items():
+                    other.cancel()
+                    _abandon(attempts[other_engine])
+                policy.observe(time.time() - start)
+                _adopt(engine, attempts[engine])
+                return future.result(), engine, True
+            error, failed = future.exception(), engine
+    _adopt(failed, attempts[failed])
+    raise error
+
+
+async def ahedged_call(policy: HedgePolicy, call: Callable, primary, secondary):
+    """Async variant of hedged_call, where call returns a coroutine. The losing request is cancelled."""
+    start = time.time()
+    first = asyncio.ensure_future(call(primary))
+    pending = {first: primary}
+    try:
+        done, _ = await asyncio.wait([first], timeout=policy.deadline())
+        if done:
+            policy.observe(time.time() - start)
+            return first.result(), primary, False
+
+        pending[asyncio.ensure_future(call(secondary))] = secondary
+        error = None
+        while pending:
+            done, _ = await asyncio.wait(list(pending), return_when=FIRST_COMPLETED)
+            for task in done:
+                engine = pending.pop(task)
+                if task.exception() is None:
+                    policy.observe(time.time() - start)
+                    return task.result(), engine, True
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,92 @@
+"""Encode-once cache for the screenshots sent by LMMAgents.
+
+Within a step the same screenshot bytes are added to the reflection agent, the generator and the
+grounding model, and to the grounding model again for every grounded action and format retry.
+LMMAgent.add_message looks each of them up here, so the screenshot is base64-encoded once and every
+message part for it references the same string instead of holding its own multi-MB copy.
+
+Entries are keyed by the identity of the bytes object and keep it alive, so an id cannot be reused
+by other bytes while its entry exists. The cache holds the last few screenshots only, which covers
+a step and the previous one. Images transcoded by an ImagePolicy are cached per policy. Images
+referenced from messages by an ImageRef (see blobs.py) are cached by their content digest.
+"""
+
+import base64
+import threading
+from collections import OrderedDict
+
+
+def _encode(image_content, policy=None) -> str:
+    if policy is not None:
+        image_content = policy.apply(image_content)
+    return base64.b64encode(image_content).decode("utf-8")
+
+
+class EncodedImageCache:
+    """LRU of base64 encodings (optionally as data: URLs) keyed by the identity of the image bytes."""
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        # (id(image bytes), prefix, policy key) -> (image bytes, encoded string), or
+        # (blob digest, prefix, policy key) -> (None, encoded string)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, image_content, prefix: str = "", policy=None) -> str:
+        """Returns prefix + the base64 encoding of image_content.
+
+        Args:
+            image_content: Image bytes, or the path of an image file. Paths and other buffers are
+                encoded on every call, since their content may change.
+            prefix (str): e.g. "data:image/png;base64," for a data: URL.
+            policy (ImagePolicy): Transcodes the image before it is encoded, None sends it as is.
+        """
+        if isinstance(image_content, str):
+            with open(image_content, "rb") as image_file:
+                return prefix + _encode(image_file.read(), policy)
+        if not isinstance(image_content, bytes):
+            return prefix + _encode(image_content, policy)
+
+        key = (id(image_content), prefix, policy.key if policy is not None else None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is image_content:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        encoded = prefix + _encode(image_content, policy)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (image_content, encoded)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return encoded
+
+    def encode_blob(self, store, digest: str, prefix: str = "", policy=None) -> str:
+        """Like encode, for an image in a BlobStore. Entries are keyed by the image's digest."""
+        key = (digest, prefix, policy.key if policy is not None else None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        encoded = prefix + _encode(store.get(digest), policy)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (None, encoded)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return encoded
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all agents of the process
+image_cache = EncodedImageCache()
@@ -0,0 +1,88 @@
+"""Per-role transcoding and downscaling of screenshots before upload.
+
+engine_params["image_policies"] maps agent names (roles) to the image policy of that agent, e.g.
+
+    "image_policies": {
+        "reflection": {"format": "jpeg", "quality": 70, "max_dim": 960, "detail": "low"},
+        "worker": {"format": "webp", "quality": 85},
+    }
+
+LMMAgent.add_message applies the policy of its agent to every image it adds. Roles without a policy
+send their images unchanged as PNG. The grounding model predicts coordinates in the
+grounding_width x grounding_height space of the screenshots it sees, so its role ("grounding")
+should at most change the format, never max_dim.
+
+The transcoded image is cached with its encoding (see image_cache.py), so a screenshot is
+transcoded once per policy however many messages it is added to.
+"""
+
+from io import BytesIO
+from typing import Dict, Optional
+
+from PIL import Image
+
+MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class ImagePolicy:
+    """How the images of one agent are encoded: format, quality, maximum dimension and detail level."""
+
+    def __init__(
+        self,
+        format: str = "png",
+        quality: int = 85,
+        max_dim: Optional[int] = None,
+        detail: Optional[str] = None,
+    ):
+        format = format.lower().replace("jpg", "jpeg")
+        if format not in MEDIA_TYPES:
+            raise ValueError(
+                f"Unsupported image format '{format}', expected one of {list(MEDIA_TYPES)}"
+            )
+        self.format = format
+        self.quality = quality
+        self.max_dim = max_dim
+        # OpenAI image detail ("low", "high" or "auto"), None keeps the caller's
+        self.detail = detail
+
+    @classmethod
+    def from_params(
+        cls, engine_params: Optional[Dict], role: Optional[str]
+    ) -> Optional["ImagePolicy"]:
+        """Builds the policy of role from engine_params["image_policies"], or returns None if it has none."""
+        if not engine_params or not role:
+            return None
+        policy = (engine_params.get("image_policies") or {}).get(role)
+        if not policy:
+            return None
+        return cls(**policy)
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+    @property
+    def key(self) -> str:
+        return f"{self.format}|{self.quality}|{self.max_dim}"
+
+    def apply(self, image_bytes: bytes) -> bytes:
+        """Returns the image re-encoded and, if larger than max_dim, downscaled."""
+        image = Image.open(BytesIO(image_bytes))
+        downscale = self.max_dim and max(image.size) > self.max_dim
+        if not downscale and image.format == self.format.upper() == "PNG":
+            # Re-encoding a PNG as PNG gains nothing
+            return image_bytes
+        if downscale:
+            scale = self.max_dim / max(image.size)
+            image = image.resize(
+                (round(image.width * scale), round(image.height * scale)),
+                Image.LANCZOS,
+            )
+        if self.format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = BytesIO()
+        if self.format == "png":
+            image.save(output, format="PNG", optimize=False)
+        else:
+            image.save(output, format=self.format.upper(), quality=self.quality)
+        return output.getvalue()
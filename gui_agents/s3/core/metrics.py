@@ -0,0 +1,98 @@
+"""Per-agent accounting of provider-reported usage.
+
+Engines normalize the usage block of every response into a dict (see LMMEngine._usage) and each
+LMMAgent accumulates it, together with the wall time and retry count of the call, into its
+UsageMetrics, as are the retries, seconds spent backing off and calls rejected by an open circuit
+(see retry.py). AgentS3.predict collects the usage of all its agents for every step.
+
+A stream stopped before the provider reported its usage is counted with estimated token counts,
+and in estimated_calls, so totals can be read with that in mind.
+"""
+
+import threading
+from typing import Dict, Iterable, Optional
+
+USAGE_FIELDS = (
+    "calls",
+    "input_tokens",
+    "cached_tokens",
+    "cache_creation_tokens",
+    "output_tokens",
+    "thinking_tokens",
+    "wall_time",
+    "retries",
+    "backoff_time",
+    "circuit_rejections",
+    "hedges",
+    "hedge_wins",
+    "cost",
+    "estimated_calls",
+)
+
+
+def empty_usage() -> Dict:
+    return {field: 0 for field in USAGE_FIELDS}
+
+
+class UsageMetrics:
+    """Running usage totals of one agent, with a cursor to read the usage of the current step."""
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.totals = empty_usage()
+        self._step_start = empty_usage()
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        usage: Optional[Dict] = None,
+        wall_time: float = 0.0,
+        retries: int = 0,
+        backoff_time: float = 0.0,
+        circuit_rejections: int = 0,
+        hedged: bool = False,
+        hedge_won: bool = False,
+        calls: int = 1,
+    ):
+        """Adds a call, or a batch of calls. usage holds the provider-reported token counts, None if the call failed."""
+        with self._lock:
+            self.totals["calls"] += calls
+            self.totals["wall_time"] += wall_time
+            self.totals["retries"] += retries
+            self.totals["backoff_time"] += backoff_time
+            self.totals["circuit_rejections"] += circuit_rejections
+            self.totals["hedges"] += int(hedged)
+            self.totals["hedge_wins"] += int(hedge_won)
+            for field, value in (usage or {}).items():
+                if field in self.totals and value:
+                    self.totals[field] += value
+
+    def pop_step(self) -> Dict:
+        """Returns the usage since the previous pop_step and starts a new step."""
+        with self._lock:
+            step = {
+                field: self.totals[field] - self._step_start[field]
+                for field in USAGE_FIELDS
+            }
+            self._step_start = dict(self.totals)
+        return step
+
+
+def aggregate_usage(metrics: Iterable[UsageMetrics]) -> Dict:
+    """Pops the current step of every agent. Returns {agent name: usage, ..., "total": usage}.
+
+    Agents without calls in this step are omitted; agents sharing a name are summed.
+    """
+    result = {}
+    total = empty_usage()
+    for agent_metrics in metrics:
+        step = agent_metrics.pop_step()
+        if not step["calls"]:
+            continue
+        name = agent_metrics.name or "agent"
+        entry = result.setdefault(name, empty_usage())
+        for field in USAGE_FIELDS:
+            entry[field] += step[field]
+            total[field] += step[field]
+    result["total"] = total
+    return result
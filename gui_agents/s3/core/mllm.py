@@ -1,7 +1,18 @@
-import base64
+import copy
+import time
 
 import numpy as np
 
+from gui_agents.s3.core.blobs import ImageRef, blob_store, materialize
+from gui_agents.s3.core.cache import is_deterministic, request_hash
+from gui_agents.s3.core.context import ContextWindow
+from gui_agents.s3.core.image_cache import image_cache
+from gui_agents.s3.core.image_policy import ImagePolicy
+from gui_agents.s3.core.hedging import HedgePolicy, ahedged_call, hedged_call
+from gui_agents.s3.core.metrics import UsageMetrics
+from gui_agents.s3.core.rate_limit import estimate_tokens
+from gui_agents.s3.core.replay import ResponseRecorder
+from gui_agents.s3.core.retry import CircuitOpenError
 from gui_agents.s3.core.engine import (
     LMMEngineAnthropic,
     LMMEngineAzureOpenAI,
@@ -9,59 +20,154 @@ from gui_agents.s3.core.engine import (
     LMMEngineOpenAI,
     LMMEngineOpenRouter,
     LMMEngineParasail,
+    LMMEngineReplay,
     LMMEnginevLLM,
     LMMEngineGemini,
 )
 
 
 class LMMAgent:
-    def __init__(self, engine_params=None, system_prompt=None, engine=None):
+    def __init__(
+        self,
+        engine_params=None,
+        system_prompt=None,
+        engine=None,
+        response_cache=None,
+        name=None,
+        metrics=None,
+        single_flight=None,
+    ):
         if engine is None:
             if engine_params is not None:
-                engine_type = engine_params.get("engine_type")
-                if engine_type == "openai":
-                    self.engine = LMMEngineOpenAI(**engine_params)
-                elif engine_type == "anthropic":
-                    self.engine = LMMEngineAnthropic(**engine_params)
-                elif engine_type == "azure":
-                    self.engine = LMMEngineAzureOpenAI(**engine_params)
-                elif engine_type == "vllm":
-                    self.engine = LMMEnginevLLM(**engine_params)
-                elif engine_type == "huggingface":
-                    self.engine = LMMEngineHuggingFace(**engine_params)
-                elif engine_type == "gemini":
-                    self.engine = LMMEngineGemini(**engine_params)
-                elif engine_type == "open_router":
-                    self.engine = LMMEngineOpenRouter(**engine_params)
-                elif engine_type == "parasail":
-                    self.engine = LMMEngineParasail(**engine_params)
-                else:
-                    raise ValueError(f"engine_type '{engine_type}' is not supported")
+                self.engine = self._create_engine(engine_params, name)
             else:
                 raise ValueError("engine_params must be provided")
         else:
             self.engine = engine
 
         self.messages = []  # Empty messages
+        # Estimated size of the messages, and the limits fit_context trims them to
+        self.context = ContextWindow.from_params(engine_params)
+
+        # Optional ResponseCache, consulted only for deterministic (temperature 0) calls
+        self.response_cache = response_cache
+        # Optional SingleFlight, shares one call among identical concurrent requests
+        self.single_flight = single_flight
+
+        # Provider-reported usage of this agent's calls, may be shared with other agents
+        self.metrics = metrics if metrics is not None else UsageMetrics(name)
+
+        # Optional hedging of slow calls, against a second engine created on first use
+        self.hedge_policy = HedgePolicy.from_params(engine_params)
+        self.hedge_engine_params = (
+            engine_params.get("hedge_engine_params") or engine_params
+            if self.hedge_policy is not None
+            else None
+        )
+        self.hedge_engine = None
+
+        # Optional recording of every response, for replay by LMMEngineReplay
+        self.recorder = (
+            ResponseRecorder.for_path(engine_params["record_path"])
+            if engine_params and engine_params.get("record_path")
+            else None
+        )
+
+        # Optional transcoding and downscaling of the images this agent sends, by its name
+        self.image_policy = ImagePolicy.from_params(engine_params, name)
+
+        # Time to first token of the last streamed response, in seconds
+        self.last_ttft = None
+
+        # See concurrent_copies
+        self._copies = []
 
         if system_prompt:
             self.add_system_prompt(system_prompt)
         else:
             self.add_system_prompt("You are a helpful assistant.")
 
-    def encode_image(self, image_content):
-        # if image_content is a path to an image file, check type of the image_content to verify
-        if isinstance(image_content, str):
-            with open(image_content, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode("utf-8")
+    def concurrent_copies(self, n):
+        """Returns n agents to send requests concurrently with, each with its own engines.
+
+        An engine keeps the usage of its last request for the agent, so concurrent requests must not
+        share one. The copies share everything else with this agent (metrics, response cache,
+        single-flight, hedging and recording) and are reused across calls.
+        """
+        while len(self._copies) < n:
+            agent = copy.copy(self)
+            agent.engine = copy.copy(self.engine)
+            agent.hedge_engine = copy.copy(self.hedge_engine)
+            agent.messages = []
+            agent._copies = []
+            self._copies.append(agent)
+        return self._copies[:n]
+
+    @staticmethod
+    def _create_engine(engine_params, name=None):
+        engine_type = engine_params.get("engine_type")
+        if engine_type == "openai":
+            return LMMEngineOpenAI(**engine_params)
+        elif engine_type == "anthropic":
+            return LMMEngineAnthropic(**engine_params)
+        elif engine_type == "azure":
+            return LMMEngineAzureOpenAI(**engine_params)
+        elif engine_type == "vllm":
+            return LMMEnginevLLM(**engine_params)
+        elif engine_type == "huggingface":
+            return LMMEngineHuggingFace(**engine_params)
+        elif engine_type == "gemini":
+            return LMMEngineGemini(**engine_params)
+        elif engine_type == "open_router":
+            return LMMEngineOpenRouter(**engine_params)
+        elif engine_type == "parasail":
+            return LMMEngineParasail(**engine_params)
+        elif engine_type == "replay":
+            # Recordings are keyed by agent name
+            return LMMEngineReplay(**{"role": name, **engine_params})
         else:
-            return base64.b64encode(image_content).decode("utf-8")
+            raise ValueError(f"engine_type '{engine_type}' is not supported")
+
+    def encode_image(self, image_content):
+        # image_content is image bytes or the path to an image file
+        return image_cache.encode(image_content, policy=self.image_policy)
+
+    def _image_media_type(self):
+        return self.image_policy.media_type if self.image_policy else "image/png"
+
+    def _image_ref(self, image_content, prefix=""):
+        """Returns the payload of an image part, an ImageRef that is encoded when a request is sent.
+
+        Image files and arrays are encoded right away, since they may change in the meantime.
+        """
+        if isinstance(image_content, bytes):
+            return ImageRef(blob_store.put(image_content), prefix, self.image_policy)
+        return image_cache.encode(image_content, prefix, self.image_policy)
+
+    def _image_url(self, image_content, media_type=None):
+        """Returns the data: URL of an image, as transcoded by the agent's image policy."""
+        media_type = media_type or self._image_media_type()
+        return self._image_ref(image_content, f"data:{media_type};base64,")
+
+    def _image_detail(self, image_detail):
+        if self.image_policy is not None and self.image_policy.detail:
+            return self.image_policy.detail
+        return image_detail
 
     def reset(
         self,
     ):
 
-        self.messages = [
+        self.context.invalidate()
+        self.messages = self.initial_messages()
+
+    def initial_messages(self):
+        """Returns a new message list holding only the system prompt.
+
+        Requests built on it with add_message(messages=...) leave the agent's own messages untouched,
+        so that several can be in flight at once.
+        """
+        return [
             {
                 "role": "system",
                 "content": [{"type": "text", "text": self.system_prompt}],
@@ -70,6 +176,7 @@ class LMMAgent:
 
     def add_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
+        self.context.invalidate()
         if len(self.messages) > 0:
             self.messages[0] = {
                 "role": "system",
@@ -87,28 +194,34 @@ class LMMAgent:
         """Remove a message at a given index"""
         if index < len(self.messages):
             self.messages.pop(index)
+            self.context.invalidate()
 
     def replace_message_at(
         self, index, text_content, image_content=None, image_detail="high"
     ):
         """Replace a message at a given index"""
         if index < len(self.messages):
+            self.context.invalidate()
             self.messages[index] = {
                 "role": self.messages[index]["role"],
                 "content": [{"type": "text", "text": text_content}],
             }
             if image_content:
-                base64_image = self.encode_image(image_content)
                 self.messages[index]["content"].append(
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}",
-                            "detail": image_detail,
+                            "url": self._image_url(image_content),
+                            "detail": self._image_detail(image_detail),
                         },
                     }
                 )
 
+    def fit_context(self):
+        """Trims the messages to the limits of self.context. Returns the size of the kept context."""
+        self.context.fit(self.messages)
+        return self.context.stats()
+
     def add_message(
         self,
         text_content,
@@ -116,8 +229,11 @@ class LMMAgent:
         role=None,
         image_detail="high",
         put_text_last=False,
+        messages=None,
     ):
-        """Add a new message to the list of messages"""
+        """Add a new message to the list of messages, or to messages if given"""
+        if messages is None:
+            messages = self.messages
 
         # API-style inference from OpenAI and AzureOpenAI
         if isinstance(
@@ -129,15 +245,16 @@ class LMMAgent:
                 LMMEngineGemini,
                 LMMEngineOpenRouter,
                 LMMEngineParasail,
+                LMMEngineReplay,
             ),
         ):
             # infer role from previous message
             if role != "user":
-                if self.messages[-1]["role"] == "system":
+                if messages[-1]["role"] == "system":
                     role = "user"
-                elif self.messages[-1]["role"] == "user":
+                elif messages[-1]["role"] == "user":
                     role = "assistant"
-                elif self.messages[-1]["role"] == "assistant":
+                elif messages[-1]["role"] == "assistant":
                     role = "user"
 
             message = {
@@ -150,25 +267,23 @@ class LMMAgent:
                 if isinstance(image_content, list):
                     # If image_content is a list of images, loop through each image
                     for image in image_content:
-                        base64_image = self.encode_image(image)
                         message["content"].append(
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/png;base64,{base64_image}",
-                                    "detail": image_detail,
+                                    "url": self._image_url(image),
+                                    "detail": self._image_detail(image_detail),
                                 },
                             }
                         )
                 else:
                     # If image_content is a single image, handle it directly
-                    base64_image = self.encode_image(image_content)
                     message["content"].append(
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}",
-                                "detail": image_detail,
+                                "url": self._image_url(image_content),
+                                "detail": self._image_detail(image_detail),
                             },
                         }
                     )
@@ -178,17 +293,17 @@ class LMMAgent:
                 text_content = message["content"].pop(0)
                 message["content"].append(text_content)
 
-            self.messages.append(message)
+            messages.append(message)
 
         # For API-style inference from Anthropic
         elif isinstance(self.engine, LMMEngineAnthropic):
             # infer role from previous message
             if role != "user":
-                if self.messages[-1]["role"] == "system":
+                if messages[-1]["role"] == "system":
                     role = "user"
-                elif self.messages[-1]["role"] == "user":
+                elif messages[-1]["role"] == "user":
                     role = "assistant"
-                elif self.messages[-1]["role"] == "assistant":
+                elif messages[-1]["role"] == "assistant":
                     role = "user"
 
             message = {
@@ -201,41 +316,39 @@ class LMMAgent:
                 if isinstance(image_content, list):
                     # If image_content is a list of images, loop through each image
                     for image in image_content:
-                        base64_image = self.encode_image(image)
                         message["content"].append(
                             {
                                 "type": "image",
                                 "source": {
                                     "type": "base64",
-                                    "media_type": "image/png",
-                                    "data": base64_image,
+                                    "media_type": self._image_media_type(),
+                                    "data": self._image_ref(image),
                                 },
                             }
                         )
                 else:
                     # If image_content is a single image, handle it directly
-                    base64_image = self.encode_image(image_content)
                     message["content"].append(
                         {
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/png",
-                                "data": base64_image,
+                                "media_type": self._image_media_type(),
+                                "data": self._image_ref(image_content),
                             },
                         }
                     )
-            self.messages.append(message)
+            messages.append(message)
 
         # Locally hosted vLLM model inference
         elif isinstance(self.engine, LMMEnginevLLM):
             # infer role from previous message
             if role != "user":
-                if self.messages[-1]["role"] == "system":
+                if messages[-1]["role"] == "system":
                     role = "user"
-                elif self.messages[-1]["role"] == "user":
+                elif messages[-1]["role"] == "user":
                     role = "assistant"
-                elif self.messages[-1]["role"] == "assistant":
+                elif messages[-1]["role"] == "assistant":
                     role = "user"
 
             message = {
@@ -248,26 +361,24 @@ class LMMAgent:
                 if isinstance(image_content, list):
                     # If image_content is a list of images, loop through each image
                     for image in image_content:
-                        base64_image = self.encode_image(image)
                         message["content"].append(
                             {
                                 "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image;base64,{base64_image}"
-                                },
+                                "image_url": {"url": self._image_url(image, "image")},
                             }
                         )
                 else:
                     # If image_content is a single image, handle it directly
-                    base64_image = self.encode_image(image_content)
                     message["content"].append(
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:image;base64,{base64_image}"},
+                            "image_url": {
+                                "url": self._image_url(image_content, "image")
+                            },
                         }
                     )
 
-            self.messages.append(message)
+            messages.append(message)
         else:
             raise ValueError("engine_type is not supported")
 
@@ -278,9 +389,18 @@ class LMMAgent:
         temperature=0.0,
         max_new_tokens=None,
         use_thinking=False,
+        stream=False,
+        stop_condition=None,
         **kwargs,
     ):
-        """Generate the next response based on previous messages"""
+        """Generate the next response based on previous messages
+
+        Args:
+            stream (bool): Consume the response incrementally. The time to first token is stored in last_ttft.
+            stop_condition (Callable[[str], bool]): Only used when streaming. Called with the text received so
+                far whenever a code fence arrives; returning True stops the request and returns that text.
+        """
+        start_time = time.time()
         if messages is None:
             messages = self.messages
         if user_message:
@@ -288,18 +408,366 @@ class LMMAgent:
                 {"role": "user", "content": [{"type": "text", "text": user_message}]}
             )
 
-        # Regular generation
-        if use_thinking:
-            return self.engine.generate_with_thinking(
+        if stream:
+            response = self._get_streamed_response(
                 messages,
                 temperature=temperature,
                 max_new_tokens=max_new_tokens,
+                use_thinking=use_thinking,
+                stop_condition=stop_condition,
                 **kwargs,
             )
+            self._record_response(messages, response, start_time)
+            return response
+
+        request_key = self._request_key(
+            messages, temperature, max_new_tokens, use_thinking, **kwargs
+        )
+        cache_key = self._cache_key(request_key, temperature)
+        if cache_key is not None:
+            response = self.response_cache.get(cache_key)
+            if response is not None:
+                self._record_response(messages, response, start_time)
+                return response
 
-        return self.engine.generate(
+        # Regular generation
+        def generate(engine):
+            if use_thinking:
+                return engine.generate_with_thinking(
+                    materialize(messages),
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                )
+            return engine.generate(
+                materialize(messages),
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+
+        if self.single_flight is not None:
+            response = self.single_flight.do(
+                request_key, lambda: self._call_engine(generate)
+            )
+        else:
+            response = self._call_engine(generate)
+
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
+        self._record_response(messages, response, start_time)
+        return response
+
+    async def aget_responses(
+        self,
+        list_of_messages,
+        temperature=0.0,
+        max_new_tokens=None,
+        max_in_flight=None,
+        **kwargs,
+    ):
+        """Generate responses for many independent requests through the engine's batch path.
+
+        Identical requests are sent once. Like get_response, each request is looked up in the
+        response cache and joins an identical request already in flight (single-flight), and only
+        the remaining ones are batched. Hedging is not used.
+
+        Returns:
+            The responses in order, with the exception in place of a request that failed.
+        """
+        start_time = time.time()
+        keys = [
+            # The key of get_response, so that both share the cache and in-flight requests
+            request_hash(
+                self.engine,
+                messages,
+                temperature,
+                max_new_tokens=max_new_tokens,
+                use_thinking=False,
+                **kwargs,
+            )
+            for messages in list_of_messages
+        ]
+        unique = {}
+        for key, messages in zip(keys, list_of_messages):
+            unique.setdefault(key, messages)
+
+        cacheable = self.response_cache is not None and is_deterministic(
+            self.engine, temperature
+        )
+        by_key = {}
+        if cacheable:
+            for key, messages in unique.items():
+                response = self.response_cache.get(key)
+                if response is not None:
+                    by_key[key] = response
+                    self._record_response(messages, response, start_time)
+        misses = [key for key in unique if key not in by_key]
+
+        async def generate_batch(batch_keys):
+            call = self._start_call()
+            try:
+                responses = await self.engine.agenerate_batch(
+                    [materialize(unique[key]) for key in batch_keys],
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    max_in_flight=max_in_flight,
+                    **kwargs,
+                )
+            finally:
+                self._record_call(call, calls=len(batch_keys))
+            if self.recorder is not None:
+                # Only the summed usage of the batch is known, so none is recorded per request
+                latency = time.time() - call[0]
+                for key, response in zip(batch_keys, responses):
+                    if not isinstance(response, Exception):
+                        self.recorder.record(
+                            self.metrics.name, unique[key], response, latency=latency
+                        )
+            return responses
+
+        if not misses:
+            responses = []
+        elif self.single_flight is not None:
+            responses = await self.single_flight.ado_batch(misses, generate_batch)
+        else:
+            responses = await generate_batch(misses)
+
+        for key, response in zip(misses, responses):
+            by_key[key] = response
+            if cacheable and not isinstance(response, Exception):
+                self.response_cache.put(key, response)
+        return [by_key[key] for key in keys]
+
+    def _record_response(self, messages, response, start_time):
+        if self.recorder is not None:
+            self.recorder.record(
+                self.metrics.name,
+                messages,
+                response,
+                latency=time.time() - start_time,
+                usage=getattr(self.engine, "last_usage", None),
+            )
+
+    def _call_engine(self, generate):
+        """Runs generate(engine) on the agent's engine, hedged if configured, and records the call"""
+        call = self._start_call()
+        engine, hedged = self.engine, False
+        try:
+            if self.hedge_policy is None:
+                response = generate(self.engine)
+            else:
+                try:
+                    response, engine, hedged = hedged_call(
+                        self.hedge_policy,
+                        generate,
+                        self.engine,
+                        self._get_hedge_engine(),
+                    )
+                except CircuitOpenError:
+                    # The primary provider is down, fail over to the hedge engine right away
+                    engine = self._get_hedge_engine()
+                    response = generate(engine)
+        finally:
+            self._record_call(call, engine, hedged)
+        return response
+
+    async def _acall_engine(self, agenerate):
+        call = self._start_call()
+        engine, hedged = self.engine, False
+        try:
+            if self.hedge_policy is None:
+                response = await agenerate(self.engine)
+            else:
+                try:
+                    response, engine, hedged = await ahedged_call(
+                        self.hedge_policy,
+                        agenerate,
+                        self.engine,
+                        self._get_hedge_engine(),
+                    )
+                except CircuitOpenError:
+                    engine = self._get_hedge_engine()
+                    response = await agenerate(engine)
+        finally:
+            self._record_call(call, engine, hedged)
+        return response
+
+    def _get_hedge_engine(self):
+        # A separate engine instance, so that concurrent requests keep their usage apart
+        if self.hedge_engine is None:
+            self.hedge_engine = self._create_engine(
+                self.hedge_engine_params, self.metrics.name
+            )
+        return self.hedge_engine
+
+    def _engines(self):
+        return [e for e in (self.engine, self.hedge_engine) if e is not None]
+
+    def _retry_counters(self):
+        engines = self._engines()
+        return (
+            sum(e.retry_count for e in engines),
+            sum(e.backoff_time for e in engines),
+            sum(e.circuit_rejections for e in engines),
+        )
+
+    def _start_call(self):
+        for engine in self._engines():
+            engine.last_usage = None
+        return time.time(), self._retry_counters()
+
+    def _record_call(self, call, engine=None, hedged=False, calls=1):
+        """Records the usage, wall time, retries and hedging of the call begun by _start_call.
+
+        Args:
+            engine: The engine whose response was used, the agent's engine by default.
+            hedged (bool): Whether a hedge request was fired.
+        """
+        start_time, (retries, backoff_time, circuit_rejections) = call
+        # A hedge engine created during the call started from zero
+        retries_after, backoff_time_after, circuit_rejections_after = (
+            self._retry_counters()
+        )
+        engine = engine or self.engine
+        self.metrics.record(
+            getattr(engine, "last_usage", None),
+            wall_time=time.time() - start_time,
+            retries=retries_after - retries,
+            backoff_time=backoff_time_after - backoff_time,
+            circuit_rejections=circuit_rejections_after - circuit_rejections,
+            hedged=hedged,
+            hedge_won=engine is not self.engine,
+            calls=calls,
+        )
+
+    def _request_key(
+        self, messages, temperature, max_new_tokens, use_thinking, **kwargs
+    ):
+        """Returns the hash of a request, or None if neither the response cache nor single-flight needs it"""
+        if self.response_cache is None and self.single_flight is None:
+            return None
+        return request_hash(
+            self.engine,
             messages,
-            temperature=temperature,
+            temperature,
             max_new_tokens=max_new_tokens,
+            use_thinking=use_thinking,
             **kwargs,
         )
+
+    def _cache_key(self, request_key, temperature):
+        """Returns the response cache key of a request, or None if the request must not be cached"""
+        if self.response_cache is None or not is_deterministic(
+            self.engine, temperature
+        ):
+            return None
+        return request_key
+
+    def _get_streamed_response(
+        self,
+        messages,
+        temperature=0.0,
+        max_new_tokens=None,
+        use_thinking=False,
+        stop_condition=None,
+        **kwargs,
+    ):
+        if use_thinking:
+            kwargs["thinking"] = True
+        call = self._start_call()
+        start_time = call[0]
+        self.last_ttft = None
+        response = ""
+        try:
+            deltas = self.engine.generate_stream(
+                materialize(messages),
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+            try:
+                for delta in deltas:
+                    if self.last_ttft is None:
+                        self.last_ttft = time.time() - start_time
+                    response += delta
+                    # Code fences are the only point where a stop condition can flip
+                    if stop_condition and "`" in delta and stop_condition(response):
+                        break
+            finally:
+                deltas.close()
+            if self.engine.last_usage is None and response:
+                # A stream stopped early never receives its usage block
+                self.engine.last_usage = self._estimated_usage(messages, response)
+        finally:
+            self._record_call(call)
+        return response
+
+    def _estimated_usage(self, messages, response):
+        """Estimates the usage of a request whose provider-reported usage is missing."""
+        if messages is self.messages:
+            # The context window already counts the agent's own messages
+            self.context.track(messages)
+            input_tokens = self.context.tokens
+        else:
+            input_tokens = estimate_tokens(messages)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": len(response) // 4,
+            "estimated_calls": 1,
+        }
+
+    async def aget_response(
+        self,
+        user_message=None,
+        messages=None,
+        temperature=0.0,
+        max_new_tokens=None,
+        use_thinking=False,
+        **kwargs,
+    ):
+        """Async variant of get_response, awaiting the engine's native async API"""
+        start_time = time.time()
+        if messages is None:
+            messages = self.messages
+        if user_message:
+            messages.append(
+                {"role": "user", "content": [{"type": "text", "text": user_message}]}
+            )
+
+        request_key = self._request_key(
+            messages, temperature, max_new_tokens, use_thinking, **kwargs
+        )
+        cache_key = self._cache_key(request_key, temperature)
+        if cache_key is not None:
+            response = self.response_cache.get(cache_key)
+            if response is not None:
+                self._record_response(messages, response, start_time)
+                return response
+
+        def agenerate(engine):
+            if use_thinking:
+                return engine.agenerate_with_thinking(
+                    materialize(messages),
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                )
+            return engine.agenerate(
+                materialize(messages),
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+
+        if self.single_flight is not None:
+            response = await self.single_flight.ado(
+                request_key, lambda: self._acall_engine(agenerate)
+            )
+        else:
+            response = await self._acall_engine(agenerate)
+
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
+        self._record_response(messages, response, start_time)
+        return response
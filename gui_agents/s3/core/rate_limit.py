@@ -0,0 +1,189 @@
+"""Client-side rate limiting shared by every process on the machine.
+
+Each engine with a rate_limit (requests/min) or token_rate_limit (tokens/min) gets a
+RateLimiter. Limiters for the same (engine type, model, endpoint) share one token bucket
+stored in a small state file guarded by a file lock, so the N EnvProcess workers spawned by
+the OSWorld runner draw from one budget instead of each assuming it owns the whole quota.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Rough cost of one image in input tokens, used until the provider reports real usage
+IMAGE_TOKEN_ESTIMATE = 1500
+
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """Cheap input token estimate of a request: ~4 characters per token plus a flat cost per image."""
+    num_chars = 0
+    num_images = 0
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, str):
+            num_chars += len(content)
+            continue
+        for part in content:
+            if "image" in part.get("type", ""):
+                num_images += 1
+            else:
+                num_chars += len(part.get("text", ""))
+    return num_chars // 4 + num_images * IMAGE_TOKEN_ESTIMATE
+
+
+class _FileLock:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+
+
+class RateLimiter:
+    """Token bucket over requests/min and tokens/min, persisted in a file shared across processes.
+
+    Both buckets hold at most one minute of budget and refill continuously. A request waits
+    until one request and its estimated tokens are available, and settle() later corrects the
+    token bucket with the usage the provider actually reported.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        state_dir: Optional[str] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        state_dir = state_dir or os.getenv(
+            "AGENT_S_RATE_LIMIT_DIR",
+            os.path.join(tempfile.gettempdir(), "agent_s_rate_limits"),
+        )
+        os.makedirs(state_dir, exist_ok=True)
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        self.state_path = os.path.join(state_dir, f"{name}.json")
+        self.lock_path = os.path.join(state_dir, f"{name}.lock")
+
+    @classmethod
+    def from_params(
+        cls, key: str, rate_limit: float = -1, token_rate_limit: float = -1
+    ) -> Optional["RateLimiter"]:
+        """Builds a limiter from engine params, where -1 (or None) means unlimited. Returns None if both are unlimited."""
+        rpm = rate_limit if rate_limit not in (None, -1) else None
+        tpm = token_rate_limit if token_rate_limit not in (None, -1) else None
+        if rpm is None and tpm is None:
+            return None
+        return cls(key, requests_per_minute=rpm, tokens_per_minute=tpm)
+
+    def _load(self, now: float) -> Dict:
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {
+                "requests": self.requests_per_minute or 0.0,
+                "tokens": self.tokens_per_minute or 0.0,
+                "updated": now,
+            }
+        # Refill both buckets for the time elapsed since the last update
+        elapsed = max(0.0, now - state["updated"])
+        if self.requests_per_minute:
+            state["requests"] = min(
+                self.requests_per_minute,
+                state["requests"] + elapsed * self.requests_per_minute / 60.0,
+            )
+        if self.tokens_per_minute:
+            state["tokens"] = min(
+                self.tokens_per_minute,
+                state["tokens"] + elapsed * self.tokens_per_minute / 60.0,
+            )
+        state["updated"] = now
+        return state
+
+    def _save(self, state: Dict):
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Takes one request and the tokens from the buckets if available. Returns 0 on success, otherwise the seconds to wait."""
+        with _FileLock(self.lock_path):
+            state = self._load(time.time())
+            wait = 0.0
+            if self.requests_per_minute and state["requests"] < 1:
+                wait = (1 - state["requests"]) * 60.0 / self.requests_per_minute
+            if self.tokens_per_minute:
+                # A request larger than the whole budget only needs a full bucket
+                needed = min(tokens, self.tokens_per_minute)
+                if state["tokens"] < needed:
+                    wait = max(
+                        wait,
+                        (needed - state["tokens"]) * 60.0 / self.tokens_per_minute,
+                    )
+            if wait == 0.0:
+                if self.requests_per_minute:
+                    state["requests"] -= 1
+                if self.tokens_per_minute:
+                    state["tokens"] -= tokens
+            self._save(state)
+        return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Blocks until the request fits in the budget. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0.0:
+                return waited
+            # Re-check at least every second since other processes also refill/drain the bucket
+            wait = min(wait, 1.0)
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        """Async variant of acquire that sleeps without blocking the event loop."""
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0.0:
+                return waited
+            wait = min(wait, 1.0)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Corrects the token bucket once the provider reported how many tokens the request really used."""
+        if not self.tokens_per_minute or actual_tokens is None:
+            return
+        with _FileLock(self.lock_path):
+            state = self._load(time.time())
+            # The bucket may go negative, which holds back the next requests
+            state["tokens"] -= actual_tokens - estimated_tokens
+            self._save(state)
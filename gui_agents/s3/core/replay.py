@@ -0,0 +1,160 @@
+"""Recording and replaying LLM responses, to run agents without a provider.
+
+An LMMAgent with engine_params["record_path"] appends every response it returns to that JSONL
+file, tagged with the agent's name (its role), the per-role call index and a fingerprint of the
+request. An LMMAgent with engine_type "replay" and engine_params["replay_path"] pointing at such
+a file then serves those responses back, so AgentS3.predict can be benchmarked offline on the
+screenshots of a recorded trajectory.
+
+Concurrent requests of one role (e.g. the start and end of a drag) are recorded in the order they
+complete, which may differ between runs, so index replay serves an identical request among the
+next few recorded calls of the role before falling back to the recorded order.
+
+Call indices are only meaningful within one task run by one process, so a benchmark running many
+tasks switches the recorder to a new file (RECORDING_FILE in the task's result directory) before
+each task, see osworld_setup/s3/run.py.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict, deque
+from typing import Dict, List, Optional
+
+from gui_agents.s3.core.blobs import ImageRef
+
+_lock = threading.Lock()
+_recorders: Dict[str, "ResponseRecorder"] = {}
+_replay_logs: Dict[str, "ReplayLog"] = {}
+
+# Name of the recording of one task in its result directory
+RECORDING_FILE = "responses.jsonl"
+
+# Recorded calls of a role among which index replay matches a request by fingerprint, since
+# concurrent requests (e.g. the two ends of a drag) are recorded in the order they complete
+REORDER_WINDOW = 8
+
+
+def _image_payload(data) -> bytes:
+    # The recorder sees the agent's ImageRefs, the replay engine their encoding, which must match
+    if isinstance(data, ImageRef):
+        data = data.materialize()
+    return data.split("base64,", 1)[-1].encode()
+
+
+def request_fingerprint(messages: List[Dict]) -> str:
+    """Hash of the roles, texts and image payloads of a request, independent of the engine's message format."""
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(message["role"].encode("utf-8"))
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for part in content:
+            if part.get("type") == "text":
+                digest.update(part["text"].encode("utf-8"))
+            elif part.get("type") == "image_url":
+                digest.update(_image_payload(part["image_url"]["url"]))
+            elif part.get("type") == "image":
+                digest.update(_image_payload(part["source"]["data"]))
+    return digest.hexdigest()
+
+
+class ResponseRecorder:
+    """Appends responses to a JSONL file, shared by all agents of a process that record to it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @classmethod
+    def for_path(cls, path: str) -> "ResponseRecorder":
+        with _lock:
+            if path not in _recorders:
+                _recorders[path] = cls(path)
+            return _recorders[path]
+
+    def switch(self, path: str):
+        """Continues the recording in the file at path, with call indices starting over from 0."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            self.path = path
+            self.counters = defaultdict(int)
+
+    def record(
+        self,
+        role: Optional[str],
+        messages: List[Dict],
+        response: str,
+        latency: float,
+        usage: Optional[Dict] = None,
+    ):
+        role = role or "agent"
+        fingerprint = request_fingerprint(messages)
+        with self._lock:
+            entry = {
+                "role": role,
+                "index": self.counters[role],
+                "fingerprint": fingerprint,
+                "response": response,
+                "latency": latency,
+                "usage": usage,
+            }
+            self.counters[role] += 1
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False))
+                f.write("\n")
+
+
+class ReplayLog:
+    """The responses of a recording, served by role and call order or by request fingerprint."""
+
+    def __init__(self, path: str):
+        # Entries of each role not served yet, in recorded order
+        self.by_role = defaultdict(list)
+        self.by_fingerprint = defaultdict(deque)
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.by_role[entry["role"]].append(entry)
+                    self.by_fingerprint[entry["fingerprint"]].append(entry)
+        self.cursors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path: str) -> "ReplayLog":
+        with _lock:
+            if path not in _replay_logs:
+                _replay_logs[path] = cls(path)
+            return _replay_logs[path]
+
+    def next(self, role: Optional[str], messages: List[Dict], by: str = "index"):
+        """Returns the recorded entry for the next call of role.
+
+        Args:
+            by (str): "index" replays a role's responses in recorded order, except that an
+                identical request among the next REORDER_WINDOW is served first. "fingerprint"
+                looks up the response to an identical request anywhere first, falling back to the
+                recorded order.
+        """
+        role = role or "agent"
+        fingerprint = request_fingerprint(messages)
+        with self._lock:
+            if by == "fingerprint":
+                matches = self.by_fingerprint.get(fingerprint)
+                if matches:
+                    return matches.popleft()
+            entries = self.by_role.get(role, [])
+            if not entries:
+                raise LookupError(
+                    f"No recorded response left for role '{role}' (call {self.cursors[role]})"
+                )
+            self.cursors[role] += 1
+            for i, entry in enumerate(entries[:REORDER_WINDOW]):
+                if entry["fingerprint"] == fingerprint:
+                    return entries.pop(i)
+            return entries.pop(0)
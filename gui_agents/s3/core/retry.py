@@ -0,0 +1,310 @@
+"""Retrying provider calls, and failing fast while a provider is down.
+
+Every engine owns a RetryPolicy. It retries connection errors, timeouts, rate limits and server
+errors with full-jitter exponential backoff, waits as long as the server asks for through
+Retry-After (or the x-ratelimit-reset headers) instead, and gives up once the total deadline would
+be exceeded. The SDKs' own retries are disabled, so this is the only retry layer under an engine.
+
+Engines talking to the same provider endpoint share a CircuitBreaker. After failure_threshold
+consecutive connection or server errors it opens, and calls fail immediately with
+CircuitOpenError until reset_timeout has passed. Then a single trial call is let through, which
+closes the circuit again on success. Retries, time spent backing off and calls rejected by an open
+circuit are counted on the engine and reported through the agent's UsageMetrics.
+"""
+
+import asyncio
+import email.utils
+import functools
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger("desktopenv.agent")
+
+# Retried on top of every 5xx server error (which includes Anthropic's 529 overloaded)
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+_lock = threading.Lock()
+_breakers: Dict[str, "CircuitBreaker"] = {}
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a provider whose circuit is open."""
+
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(
+            f"Circuit for {key} is open after repeated failures, retry in {retry_after:.1f}s"
+        )
+        self.retry_after = retry_after
+
+
+def _sdk_errors(name: str):
+    # The SDKs are imported lazily, an error cannot come from an SDK that was never imported
+    sdk = sys.modules.get(name)
+    if sdk is None:
+        return (), ()
+    return (sdk.APIConnectionError,), (sdk.APIStatusError,)
+
+
+def _classify(error: Exception):
+    """Returns (is a connection error or timeout, HTTP status code or None) of an SDK error."""
+    for name in ("openai", "anthropic"):
+        connection_errors, status_errors = _sdk_errors(name)
+        if connection_errors and isinstance(error, connection_errors):
+            return True, None
+        if status_errors and isinstance(error, status_errors):
+            return False, error.status_code
+    return False, None
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for connection errors, timeouts, rate limits and server errors of the provider SDKs."""
+    is_connection_error, status_code = _classify(error)
+    if is_connection_error:
+        return True
+    return status_code is not None and (
+        status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    )
+
+
+def is_provider_failure(error: Exception) -> bool:
+    """True if an error says the provider is unhealthy, which rate limits and bad requests do not."""
+    is_connection_error, status_code = _classify(error)
+    return is_connection_error or (status_code is not None and status_code >= 500)
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    # OpenAI reports resets as durations like "1s", "6m0s" or "20ms"
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Returns the seconds the server asked to wait before retrying, None if it gave no hint."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(
+                    email.utils.parsedate_to_datetime(value).timestamp() - time.time(),
+                    0.0,
+                )
+            except (TypeError, ValueError):
+                pass
+    resets = []
+    for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        value = headers.get(header)
+        if value:
+            try:
+                resets.append(float(value))
+            except ValueError:
+                duration = _parse_duration(value)
+                if duration is not None:
+                    resets.append(duration)
+    return max(resets) if resets else None
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker shared by the engines of one provider endpoint."""
+
+    def __init__(self, key: str, failure_threshold: int = 5, reset_timeout=30.0):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_key(cls, key: str, **kwargs) -> "CircuitBreaker":
+        with _lock:
+            if key not in _breakers:
+                _breakers[key] = cls(key, **kwargs)
+            return _breakers[key]
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.time() - self.opened_at < self.reset_timeout:
+                return "open"
+            return "half_open"
+
+    def before_call(self):
+        """Raises CircuitOpenError unless the call may go through."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.reset_timeout - (time.time() - self.opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(self.key, remaining)
+            # Half open: a single trial call decides whether the circuit closes again
+            if self.trial_in_flight:
+                raise CircuitOpenError(self.key, 0.0)
+            self.trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Circuit for %s closed", self.key)
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_cancelled(self):
+        # A cancelled call (e.g. a losing hedge) says nothing about the provider
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            was_trial = self.trial_in_flight
+            self.trial_in_flight = False
+            if not is_provider_failure(error):
+                return
+            self.failures += 1
+            if was_trial or (
+                self.opened_at is None and self.failures >= self.failure_threshold
+            ):
+                logger.warning(
+                    "Opening circuit for %s after %d consecutive failures: %s",
+                    self.key,
+                    self.failures,
+                    error,
+                )
+                self.opened_at = time.time()
+
+
+class RetryPolicy:
+    """Retries an engine's calls with server-hinted or jittered exponential backoff under a deadline."""
+
+    def __init__(
+        self,
+        max_time: float = 60.0,
+        max_attempts: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+    ):
+        self.max_time = max_time
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def next_delay(self, error: Exception, attempt: int, deadline: float):
+        """Returns the seconds to wait before retrying after the attempt-th failure, or None to give up."""
+        if not is_retryable(error) or attempt + 1 >= self.max_attempts:
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            # Full jitter, so that clients that failed together do not retry together
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if time.time() + delay > deadline:
+            return None
+        return delay
+
+    def call(self, engine, method, *args, **kwargs):
+        """Runs method(engine, *args, **kwargs) under this policy and the engine's circuit breaker."""
+        breaker = engine.circuit_breaker
+        deadline = time.time() + self.max_time
+        attempt = 0
+        while True:
+            _before_call(engine, breaker)
+            try:
+                result = method(engine, *args, **kwargs)
+            except Exception as e:
+                if breaker is not None:
+                    breaker.record_failure(e)
+                delay = self.next_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                _count_retry(engine, delay, e)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    async def acall(self, engine, method, *args, **kwargs):
+        """Async variant of call, for a coroutine method."""
+        breaker = engine.circuit_breaker
+        deadline = time.time() + self.max_time
+        attempt = 0
+        while True:
+            _before_call(engine, breaker)
+            try:
+                result = await method(engine, *args, **kwargs)
+            except asyncio.CancelledError:
+                if breaker is not None:
+                    breaker.record_cancelled()
+                raise
+            except Exception as e:
+                if breaker is not None:
+                    breaker.record_failure(e)
+                delay = self.next_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                _count_retry(engine, delay, e)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+
+def _before_call(engine, breaker):
+    if breaker is None:
+        return
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        engine.circuit_rejections += 1
+        raise
+
+
+def _count_retry(engine, delay, error):
+    engine.retry_count += 1
+    engine.backoff_time += delay
+    logger.info(
+        "Retrying %s in %.2fs after error: %s", type(engine).__name__, delay, error
+    )
+
+
+def retried(method):
+    """Decorates an engine method to run under the engine's retry_policy and circuit_breaker."""
+    if asyncio.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def async_wrapper(engine, *args, **kwargs):
+            return await engine.retry_policy.acall(engine, method, *args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(engine, *args, **kwargs):
+        return engine.retry_policy.call(engine, method, *args, **kwargs)
+
+    return wrapper
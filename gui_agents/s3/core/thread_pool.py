@@ -0,0 +1,43 @@
+"""Lazily created thread pools that are safe across os.fork.
+
+The threads of a ThreadPoolExecutor do not exist in a forked child (e.g. a benchmark worker
+process), so a pool created before the fork would hang there. A SharedThreadPool creates its
+executor on first use, and again on first use in a forked child.
+"""
+
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+_pools = weakref.WeakSet()
+
+
+class SharedThreadPool:
+    """A ThreadPoolExecutor created on first use, for module-level pools."""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    def get(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=self.thread_name_prefix,
+                )
+            return self._executor
+
+
+def _reset_after_fork():
+    for pool in list(_pools):
+        pool._executor = None
+        pool._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,3 +1,4 @@
+import asyncio
 import re
 import time
 from io import BytesIO
@@ -5,6 +6,7 @@ from PIL import Image
 
 from typing import Tuple, Dict
 
+from gui_agents.s3.core.retry import CircuitOpenError, is_retryable
 from gui_agents.s3.memory.procedural_memory import PROCEDURAL_MEMORY
 
 import logging
@@ -50,12 +52,44 @@ def call_llm_safe(
         except Exception as e:
             attempt += 1
             print(f"Attempt {attempt} failed: {e}")
+            if is_retryable(e) or isinstance(e, CircuitOpenError):
+                # The engine already retried transient errors up to its deadline
+                print("Provider unavailable. Handling failure.")
+                break
             if attempt == max_retries:
                 print("Max retries reached. Handling failure.")
         time.sleep(1.0)
     return response if response is not None else ""
 
 
+async def acall_llm_safe(
+    agent, temperature: float = 0.0, use_thinking: bool = False, **kwargs
+) -> str:
+    """Async variant of call_llm_safe, awaiting LMMAgent.aget_response."""
+    max_retries = 3
+    attempt = 0
+    response = ""
+    while attempt < max_retries:
+        try:
+            response = await agent.aget_response(
+                temperature=temperature, use_thinking=use_thinking, **kwargs
+            )
+            assert response is not None, "Response from agent should not be None"
+            print("Response success!")
+            break
+        except Exception as e:
+            attempt += 1
+            print(f"Attempt {attempt} failed: {e}")
+            if is_retryable(e) or isinstance(e, CircuitOpenError):
+                # The engine already retried transient errors up to its deadline
+                print("Provider unavailable. Handling failure.")
+                break
+            if attempt == max_retries:
+                print("Max retries reached. Handling failure.")
+        await asyncio.sleep(1.0)
+    return response if response is not None else ""
+
+
 def call_llm_formatted(generator, format_checkers, **kwargs):
     """
     Calls the generator agent's LLM and ensures correct formatting.
@@ -81,42 +115,8 @@ def call_llm_formatted(generator, format_checkers, **kwargs):
         del kwargs["messages"]  # Remove messages from kwargs to avoid passing it twice
     while attempt < max_retries:
         response = call_llm_safe(generator, messages=messages, **kwargs)
-
-        # Prepare feedback messages for incorrect formatting
-        feedback_msgs = []
-        for format_checker in format_checkers:
-            success, feedback = format_checker(response)
-            if not success:
-                feedback_msgs.append(feedback)
-        if not feedback_msgs:
-            # logger.info(f"Response formatted correctly on attempt {attempt} for {generator.engine.model}")
+        if _check_format(generator, format_checkers, messages, response, attempt):
             break
-        logger.error(
-            f"Response formatting error on attempt {attempt} for {generator.engine.model}. Response: {response} {', '.join(feedback_msgs)}"
-        )
-        messages.append(
-            {
-                "role": "assistant",
-                "content": [{"type": "text", "text": response}],
-            }
-        )
-        logger.info(f"Bad response: {response}")
-        delimiter = "\n- "
-        formatting_feedback = f"- {delimiter.join(feedback_msgs)}"
-        messages.append(
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": PROCEDURAL_MEMORY.FORMATTING_FEEDBACK_PROMPT.replace(
-                            "FORMATTING_FEEDBACK", formatting_feedback
-                        ),
-                    }
-                ],
-            }
-        )
-        logger.info("Feedback:\n%s", formatting_feedback)
 
         attempt += 1
         if attempt == max_retries:
@@ -127,6 +127,74 @@ def call_llm_formatted(generator, format_checkers, **kwargs):
     return response
 
 
+async def acall_llm_formatted(generator, format_checkers, **kwargs):
+    """Async variant of call_llm_formatted, awaiting acall_llm_safe."""
+    max_retries = 3
+    attempt = 0
+    response = ""
+    if kwargs.get("messages") is None:
+        messages = generator.messages.copy()
+    else:
+        messages = kwargs["messages"]
+        del kwargs["messages"]
+    while attempt < max_retries:
+        response = await acall_llm_safe(generator, messages=messages, **kwargs)
+        if _check_format(generator, format_checkers, messages, response, attempt):
+            break
+
+        attempt += 1
+        if attempt == max_retries:
+            logger.error(
+                "Max retries reached when formatting response. Handling failure."
+            )
+        await asyncio.sleep(1.0)
+    return response
+
+
+def _check_format(generator, format_checkers, messages, response, attempt) -> bool:
+    """Runs the format checkers on a response.
+
+    Returns True if the response is correctly formatted. Otherwise appends the bad response
+    and the formatting feedback to messages for the next attempt, and returns False.
+    """
+    # Prepare feedback messages for incorrect formatting
+    feedback_msgs = []
+    for format_checker in format_checkers:
+        success, feedback = format_checker(response)
+        if not success:
+            feedback_msgs.append(feedback)
+    if not feedback_msgs:
+        # logger.info(f"Response formatted correctly on attempt {attempt} for {generator.engine.model}")
+        return True
+    logger.error(
+        f"Response formatting error on attempt {attempt} for {generator.engine.model}. Response: {response} {', '.join(feedback_msgs)}"
+    )
+    messages.append(
+        {
+            "role": "assistant",
+            "content": [{"type": "text", "text": response}],
+        }
+    )
+    logger.info(f"Bad response: {response}")
+    delimiter = "\n- "
+    formatting_feedback = f"- {delimiter.join(feedback_msgs)}"
+    messages.append(
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": PROCEDURAL_MEMORY.FORMATTING_FEEDBACK_PROMPT.replace(
+                        "FORMATTING_FEEDBACK", formatting_feedback
+                    ),
+                }
+            ],
+        }
+    )
+    logger.info("Feedback:\n%s", formatting_feedback)
+    return False
+
+
 def split_thinking_response(full_response: str) -> Tuple[str, str]:
     try:
         # Extract thoughts section
@@ -166,6 +234,25 @@ def parse_code_from_string(input_string):
     return relevant_code
 
 
+def agent_action_block_complete(response: str) -> bool:
+    """Checks whether a (partial) response already contains a closed code block with an agent action.
+
+    Used as the stop condition when streaming worker plans, which end with the grounded action block.
+
+    Args:
+        response (str): The response text received so far.
+
+    Returns:
+        bool: True if the answer contains a complete ```...``` block calling an agent action.
+    """
+    # With thinking enabled, only the answer section holds the final action
+    if "<thoughts>" in response:
+        if "<answer>" not in response:
+            return False
+        response = response.split("<answer>")[-1]
+    return len(extract_agent_functions(parse_code_from_string(response))) > 0
+
+
 def extract_agent_functions(code):
     """Extracts all agent function calls from the given code.
 
@@ -179,6 +266,20 @@ def extract_agent_functions(code):
     return re.findall(pattern, code)
 
 
+def crop_box(
+    image_size: Tuple[int, int], x: int, y: int, width: int, height: int
+) -> Tuple[int, int, int, int]:
+    """Returns the (left, top, right, bottom) box of width x height centered on (x, y), shifted to fit the image.
+
+    Args:
+        image_size (Tuple[int, int]): (width, height) of the image, at least width x height.
+    """
+    W, H = image_size
+    left = min(max(x - width // 2, 0), W - width)
+    top = min(max(y - height // 2, 0), H - height)
+    return left, top, left + width, top + height
+
+
 def compress_image(image_bytes: bytes = None, image: Image = None) -> bytes:
     """Compresses an image represented as bytes.
 
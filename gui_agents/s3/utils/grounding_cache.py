@@ -0,0 +1,103 @@
+"""Cross-step cache of grounded elements.
+
+Agents often ground the same element again a few steps later ("the Save button in the toolbar").
+GroundingCache maps the normalized description of every grounded element to its coordinates and
+the hash of a small patch of the screenshot around them. On a later lookup the patch at the same
+place in the new screenshot is hashed again: if it is unchanged, the element is still there and
+the coordinates are reused without a grounding model call, otherwise the entry is dropped.
+
+Elements in featureless patches (e.g. "the empty area below the list") are not cached, since an
+unchanged patch says nothing about them. The cache belongs to an episode: the Worker clears it on
+reset, and it holds at most max_entries descriptions. Its hit rate and the grounding calls saved
+are reported in OSWorldACI.grounding_stats().
+"""
+
+import hashlib
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from gui_agents.s3.utils.common_utils import crop_box
+
+# Standard deviation of the patch pixel values below which a patch is featureless
+MIN_PATCH_STD = 4.0
+
+
+def normalize_description(description: str) -> str:
+    return " ".join(re.findall(r"[0-9a-z]+", description.lower()))
+
+
+class GroundingCache:
+    """LRU of description -> (coordinates, screenshot size, patch box, patch hash)."""
+
+    def __init__(self, max_entries: int = 64, patch_size: int = 32):
+        """
+        Args:
+            max_entries (int): Number of descriptions kept.
+            patch_size (int): Side in screenshot pixels of the patch validating an entry.
+        """
+        self.max_entries = max_entries
+        self.patch_size = patch_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _patch_hash(
+        self, image: Image.Image, box: Tuple[int, int, int, int]
+    ) -> Optional[str]:
+        patch = np.asarray(image.crop(box).convert("RGB"))
+        if patch.std() < MIN_PATCH_STD:
+            return None
+        return hashlib.sha1(patch.tobytes()).hexdigest()
+
+    def get(self, description: str, image: Image.Image) -> Optional[List[int]]:
+        """Returns the cached coordinates of description if its patch is unchanged in image."""
+        key = normalize_description(description)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        coords, size, box, digest = entry
+        if size != image.size or self._patch_hash(image, box) != digest:
+            del self._entries[key]
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return list(coords)
+
+    def put(
+        self,
+        description: str,
+        image: Image.Image,
+        coords: List[int],
+        pixel: Tuple[int, int],
+    ):
+        """Caches coords, grounded at pixel of image, unless the patch around it is featureless."""
+        side = min(self.patch_size, *image.size)
+        box = crop_box(image.size, pixel[0], pixel[1], side, side)
+        digest = self._patch_hash(image, box)
+        if digest is None:
+            return
+        key = normalize_description(description)
+        self._entries[key] = (list(coords), image.size, box, digest)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,303 @@
+"""OCR of screenshots for text grounding.
+
+OSWorldACI.get_ocr_elements runs through the shared ocr_engine, which caches the words found in
+each screenshot by the hash of its bytes (and the region OCRed), so the start and end of a text
+span, format retries and repeated lookups on the same screen OCR it once.
+
+A new screenshot usually differs from the last one OCRed in a small region only (a dialog, a
+typed line), so OCREngine.elements_since OCRs just that region of interest, widened to the words
+it cuts, and reuses the words of the last screenshot outside it. OSWorldACI does so when the
+changed region is at most MAX_REGION_FRACTION of the screen.
+
+Two backends are available:
+
+- "tesserocr" keeps a Tesseract engine loaded in-process through the tesserocr package, which
+  saves the process spawn and model load that pytesseract pays on every call.
+- "pytesseract" runs the tesseract executable for every call.
+
+The backend is chosen with AGENT_S_OCR_BACKEND: "auto" (default) uses tesserocr if it is
+installed and usable (e.g. its language data is found) and pytesseract otherwise.
+"""
+
+import hashlib
+import heapq
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+# (left, top, right, bottom) in screenshot pixels
+Region = Tuple[int, int, int, int]
+
+OCR_FIELDS = ("text", "block_num", "left", "top", "width", "height")
+
+# Largest changed fraction of a screenshot for which only the changed region is OCRed
+MAX_REGION_FRACTION = 0.5
+
+
+class PytesseractBackend:
+    """Runs the tesseract executable through pytesseract."""
+
+    name = "pytesseract"
+
+    def image_to_data(self, image: Image.Image) -> Dict[str, List]:
+        import pytesseract
+        from pytesseract import Output
+
+        return pytesseract.image_to_data(image, output_type=Output.DICT)
+
+
+class TesserocrBackend:
+    """Keeps a Tesseract engine loaded in-process through tesserocr."""
+
+    name = "tesserocr"
+
+    def __init__(self, lang: str = "eng"):
+        import tesserocr
+
+        self._tesserocr = tesserocr
+        self._api = tesserocr.PyTessBaseAPI(lang=lang)
+        # The engine holds the current image, calls must not interleave
+        self._lock = threading.Lock()
+
+    def image_to_data(self, image: Image.Image) -> Dict[str, List]:
+        """Returns the words found in image, in the format of pytesseract's Output.DICT."""
+        RIL = self._tesserocr.RIL
+        data = {field: [] for field in OCR_FIELDS}
+        with self._lock:
+            self._api.SetImage(image)
+            self._api.Recognize()
+            iterator = self._api.GetIterator()
+            if iterator is None:
+                return data
+            block_num = 0
+            for word in self._tesserocr.iterate_level(iterator, RIL.WORD):
+                if word.IsAtBeginningOf(RIL.BLOCK):
+                    block_num += 1
+                box = word.BoundingBox(RIL.WORD)
+                if box is None:
+                    continue
+                left, top, right, bottom = box
+                data["text"].append(word.GetUTF8Text(RIL.WORD) or "")
+                data["block_num"].append(block_num)
+                data["left"].append(left)
+                data["top"].append(top)
+                data["width"].append(right - left)
+                data["height"].append(bottom - top)
+        return data
+
+
+BACKENDS = {"pytesseract": PytesseractBackend, "tesserocr": TesserocrBackend}
+
+
+def create_backend(name: Optional[str] = None):
+    """Creates the OCR backend called name, by default the one set by AGENT_S_OCR_BACKEND."""
+    name = name or os.getenv("AGENT_S_OCR_BACKEND", "auto")
+    if name == "auto":
+        try:
+            return TesserocrBackend()
+        except Exception:
+            # Not installed, or Tesseract failed to initialize (e.g. a RuntimeError without tessdata)
+            return PytesseractBackend()
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unsupported OCR backend '{name}', expected one of {['auto', *BACKENDS]}"
+        )
+    return BACKENDS[name]()
+
+
+def build_ocr_elements(
+    image_data: Dict[str, List], offset: Tuple[int, int] = (0, 0)
+) -> Tuple[str, List[Dict]]:
+    """Builds the text table shown to the text span agent and the word elements it refers to.
+
+    Args:
+        image_data: OCR output in the format of pytesseract's Output.DICT.
+        offset: (left, top) added to the word boxes, e.g. of the OCRed region.
+    """
+    ocr_elements = []
+    # Obtain the <id, text, group number, word number> for each valid element
+    grouping_map = defaultdict(list)
+    for i, word in enumerate(image_data["text"]):
+        # Clean text by removing leading and trailing spaces and non-alphabetical characters, but keeping punctuation
+        text = re.sub(r"^[^a-zA-Z\s.,!?;:\-\+]+|[^a-zA-Z\s.,!?;:\-\+]+$", "", word)
+        if not text:
+            continue
+        block_num = image_data["block_num"][i]
+        grouping_map[block_num].append(text)
+        ocr_id = len(ocr_elements)
+        ocr_elements.append(
+            {
+                "id": ocr_id,
+                "text": text,
+                "group_num": block_num,
+                "word_num": len(grouping_map[block_num]),
+                "left": image_data["left"][i] + offset[0],
+                "top": image_data["top"][i] + offset[1],
+                "width": image_data["width"][i],
+                "height": image_data["height"][i],
+            }
+        )
+    return text_table(ocr_elements), ocr_elements
+
+
+def text_table(ocr_elements: List[Dict]) -> str:
+    return "".join(
+        ["Text Table:\nWord id\tText\n"]
+        + [f"{element['id']}\t{element['text']}\n" for element in ocr_elements]
+    )
+
+
+def _overlaps(element: Dict, region: Region) -> bool:
+    left, top, right, bottom = region
+    return (
+        element["left"] < right
+        and element["left"] + element["width"] > left
+        and element["top"] < bottom
+        and element["top"] + element["height"] > top
+    )
+
+
+def _renumbered(ocr_elements: List[Dict]) -> List[Dict]:
+    """Copies of ocr_elements with the ids and word numbers of their new order."""
+    word_counts = defaultdict(int)
+    renumbered = []
+    for ocr_id, element in enumerate(ocr_elements):
+        word_counts[element["group_num"]] += 1
+        renumbered.append(
+            {
+                **element,
+                "id": ocr_id,
+                "word_num": word_counts[element["group_num"]],
+            }
+        )
+    return renumbered
+
+
+class OCREngine:
+    """OCR with an LRU cache of results keyed by (screenshot hash, region)."""
+
+    def __init__(self, backend=None, max_entries: int = 16):
+        """
+        Args:
+            backend: An object with image_to_data(image), created by create_backend on first use if None.
+            max_entries (int): Number of (screenshot, region) results kept.
+        """
+        self._backend = backend
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = create_backend()
+            return self._backend
+
+    def _cached(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return result
+
+    def _store(self, key, result):
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = result
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def is_cached(self, screenshot: bytes) -> bool:
+        with self._lock:
+            return (hashlib.sha256(screenshot).hexdigest(), None) in self._entries
+
+    def elements(
+        self, screenshot: bytes, region: Optional[Region] = None
+    ) -> Tuple[str, List[Dict]]:
+        """Returns the text table and word elements of screenshot, or of its region if given.
+
+        Word boxes are in screenshot coordinates either way. The returned elements are shared with
+        the cache and must not be modified.
+        """
+        key = (hashlib.sha256(screenshot).hexdigest(), region)
+        result = self._cached(key)
+        if result is not None:
+            return result
+
+        image = Image.open(BytesIO(screenshot))
+        offset = (0, 0)
+        if region is not None:
+            image = image.crop(region)
+            offset = region[:2]
+        result = build_ocr_elements(self.backend.image_to_data(image), offset)
+        self._store(key, result)
+        return result
+
+    def elements_since(
+        self, screenshot: bytes, previous: bytes, region: Region
+    ) -> Tuple[str, List[Dict]]:
+        """Like elements(screenshot), for a screenshot that differs from previous only in region.
+
+        Only region, widened to the words of previous it cuts, is OCRed. The words of previous
+        outside it are reused, merged in reading order with the words found in it.
+        """
+        key = (hashlib.sha256(screenshot).hexdigest(), None)
+        result = self._cached(key)
+        if result is not None:
+            return result
+
+        _, previous_elements = self.elements(previous)
+        left, top, right, bottom = region
+        for element in previous_elements:
+            if _overlaps(element, region):
+                left = min(left, element["left"])
+                top = min(top, element["top"])
+                right = max(right, element["left"] + element["width"])
+                bottom = max(bottom, element["top"] + element["height"])
+        width, height = Image.open(BytesIO(screenshot)).size
+        region = (max(0, left), max(0, top), min(width, right), min(height, bottom))
+        _, region_elements = self.elements(screenshot, region)
+
+        kept = [e for e in previous_elements if not _overlaps(e, region)]
+        # Blocks found in the region are new blocks
+        first_block = max((e["group_num"] for e in kept), default=0) + 1
+        region_elements = [
+            {**e, "group_num": first_block + e["group_num"]} for e in region_elements
+        ]
+        # Both lists are in reading order, merge them on it
+        ocr_elements = _renumbered(
+            list(
+                heapq.merge(kept, region_elements, key=lambda e: (e["top"], e["left"]))
+            )
+        )
+        result = (text_table(ocr_elements), ocr_elements)
+        self._store(key, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all grounding agents of the process
+ocr_engine = OCREngine()
+
+
+def _reset_after_fork():
+    ocr_engine._lock = threading.Lock()
+    backend = ocr_engine._backend
+    if isinstance(backend, TesserocrBackend):
+        backend._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
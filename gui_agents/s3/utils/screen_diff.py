@@ -0,0 +1,122 @@
+"""Fast detection of screen changes between screenshots.
+
+Screenshots are compared on a grayscale copy downsampled by an integer factor: a 64-bit difference
+hash (dHash) gives a coarse similarity, and the pixels whose gray level moved by more than a
+threshold give the changed fraction and the bounding box of the changed region, in full-resolution
+coordinates. Comparing two 1920x1080 screenshots takes a few milliseconds, most of it decoding.
+
+The Worker compares every new screenshot with the last one it sent to the models and sends a short
+note instead of the image when nothing changed; set "skip_unchanged_screenshots": False in the worker
+engine params to always send it. The diff of the current step is available as Worker.screen_diff,
+as the grounding agent's screen_diff and in the "screen_diff" entry of the executor info.
+"""
+
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def _grayscale(screenshot: bytes, factor: int) -> np.ndarray:
+    image = Image.open(BytesIO(screenshot)).convert("L")
+    if factor > 1:
+        image = image.reduce(factor)
+    return np.asarray(image, dtype=np.int16)
+
+
+def dhash(gray: np.ndarray) -> int:
+    """Returns the 64-bit difference hash of a grayscale image."""
+    small = np.asarray(
+        Image.fromarray(gray.astype(np.uint8)).resize((9, 8), Image.BILINEAR),
+        dtype=np.int16,
+    )
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class ScreenDiff:
+    """How a screenshot differs from the reference screenshot."""
+
+    def __init__(
+        self,
+        changed: bool,
+        hash_distance: int = 0,
+        changed_fraction: float = 0.0,
+        bbox: Optional[Tuple[int, int, int, int]] = None,
+    ):
+        self.changed = changed
+        # Hamming distance of the dHashes, 0 to 64
+        self.hash_distance = hash_distance
+        # Fraction of the (downsampled) pixels that changed
+        self.changed_fraction = changed_fraction
+        # (left, top, right, bottom) of the changed region in screenshot pixels, None if unchanged
+        self.bbox = bbox
+
+    def to_dict(self) -> Dict:
+        return {
+            "changed": self.changed,
+            "hash_distance": self.hash_distance,
+            "changed_fraction": self.changed_fraction,
+            "bbox": self.bbox,
+        }
+
+
+class ScreenChangeDetector:
+    """Compares screenshots with a reference, which is the last screenshot that changed."""
+
+    def __init__(self, factor: int = 4, pixel_threshold: int = 16):
+        """
+        Args:
+            factor (int): Downsampling factor of the comparison.
+            pixel_threshold (int): Gray level difference (0-255) from which a pixel counts as changed.
+        """
+        self.factor = factor
+        self.pixel_threshold = pixel_threshold
+        self.reference = None
+        self._reference_gray = None
+        self._reference_hash = None
+
+    def reset(self):
+        self.reference = None
+        self._reference_gray = None
+        self._reference_hash = None
+
+    def diff(self, screenshot: bytes) -> ScreenDiff:
+        """Compares screenshot with the reference. A changed screenshot becomes the new reference."""
+        if self.reference is not None and screenshot == self.reference:
+            return ScreenDiff(changed=False)
+
+        gray = _grayscale(screenshot, self.factor)
+        screen_hash = dhash(gray)
+        if self._reference_gray is None or gray.shape != self._reference_gray.shape:
+            height, width = gray.shape
+            result = ScreenDiff(
+                changed=True,
+                hash_distance=64 if self._reference_gray is not None else 0,
+                changed_fraction=1.0,
+                bbox=(0, 0, width * self.factor, height * self.factor),
+            )
+        else:
+            mask = np.abs(gray - self._reference_gray) > self.pixel_threshold
+            rows = np.flatnonzero(mask.any(axis=1))
+            hash_distance = bin(screen_hash ^ self._reference_hash).count("1")
+            if rows.size == 0:
+                return ScreenDiff(changed=False, hash_distance=hash_distance)
+            cols = np.flatnonzero(mask.any(axis=0))
+            result = ScreenDiff(
+                changed=True,
+                hash_distance=hash_distance,
+                changed_fraction=float(mask.mean()),
+                bbox=(
+                    int(cols[0]) * self.factor,
+                    int(rows[0]) * self.factor,
+                    (int(cols[-1]) + 1) * self.factor,
+                    (int(rows[-1]) + 1) * self.factor,
+                ),
+            )
+
+        self.reference = screenshot
+        self._reference_gray = gray
+        self._reference_hash = screen_hash
+        return result
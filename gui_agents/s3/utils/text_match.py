@@ -0,0 +1,116 @@
+"""Local matching of text-span phrases against OCR words.
+
+The text span agent is given the OCR word table and the screenshot to pick the word a phrase
+starts or ends at. Most phrases appear verbatim, or nearly so, among the OCR words, in which case
+PhraseMatcher finds them without a model call:
+
+1. Phrase tokens and OCR words are normalized (lowercase, letters and digits only).
+2. Every (phrase token, distinct OCR word) pair is scored by its normalized edit distance.
+3. Each run of consecutive OCR words as long as the phrase is scored by the mean similarity of
+   its words to the phrase tokens, for all runs at once with NumPy.
+
+The best run is used if it scores at least min_score and no other run comes within min_margin of
+it. Phrases that match nowhere, or in several places (e.g. a word repeated on screen), are left
+to the text span agent, which sees the screenshot. The hit rate is reported in
+OSWorldACI.grounding_stats().
+"""
+
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"[^0-9a-z]+", "", text.lower())
+
+
+@lru_cache(maxsize=1 << 16)
+def similarity(a: str, b: str) -> float:
+    """Returns 1 - the edit distance of a and b over the longer length, 0.0 for dissimilar lengths."""
+    if a == b:
+        return 1.0
+    shorter, longer = sorted((a, b), key=len)
+    # The edit distance is at least the length difference
+    if len(shorter) < len(longer) / 2:
+        return 0.0
+    previous = list(range(len(shorter) + 1))
+    for i, char in enumerate(longer, 1):
+        current = [i]
+        for j, other in enumerate(shorter, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char != other),
+                )
+            )
+        previous = current
+    return 1.0 - previous[-1] / len(longer)
+
+
+class PhraseMatcher:
+    """Finds the OCR words of a phrase when they are a confident and unambiguous match."""
+
+    def __init__(self, min_score: float = 0.85, min_margin: float = 0.15):
+        """
+        Args:
+            min_score (float): Mean word similarity (0-1) from which a run of words is a match.
+            min_margin (float): Lead the best run must have over every other run.
+        """
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.hits = 0
+        self.misses = 0
+
+    def match(self, phrase: str, ocr_elements: List[Dict]) -> Optional[List[int]]:
+        """Returns the indices in ocr_elements of the words of phrase, or None if not confident."""
+        indices = self._match(phrase, ocr_elements)
+        if indices is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return indices
+
+    def _match(self, phrase: str, ocr_elements: List[Dict]) -> Optional[List[int]]:
+        tokens = [token for token in map(normalize, phrase.split()) if token]
+        # OCR words that are only punctuation are skipped, like in the phrase
+        positions, words = [], []
+        for i, element in enumerate(ocr_elements):
+            word = normalize(element["text"])
+            if word:
+                positions.append(i)
+                words.append(word)
+        k, n = len(tokens), len(words)
+        if k == 0 or n < k:
+            return None
+
+        # Screens repeat words, so each distinct word is scored once
+        distinct = {}
+        inverse = np.array([distinct.setdefault(word, len(distinct)) for word in words])
+        token_similarity = np.array(
+            [[similarity(token, word) for word in distinct] for token in tokens]
+        )[:, inverse]
+        # scores[s]: mean similarity of the run of k words starting at s
+        scores = np.zeros(n - k + 1)
+        for i in range(k):
+            scores += token_similarity[i, i : i + n - k + 1]
+        scores /= k
+
+        best = int(np.argmax(scores))
+        best_score = scores[best]
+        if best_score < self.min_score:
+            return None
+        scores[best] = 0.0
+        if scores.max() > best_score - self.min_margin:
+            return None
+        return positions[best : best + k]
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -2,7 +2,7 @@ import os
 import json
 import asyncio
 import argparse
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
 
 from gui_agents.s3.bbon.behavior_narrator import BehaviorNarrator
@@ -11,14 +11,13 @@ from utils import get_new_tasks_classification
 load_dotenv()
 
 
-async def generate_single_fact_caption(
+def load_transition(
     task_dir: str,
     screenshot_files: List[str],
     i: int,
-    judge: BehaviorNarrator,
     trajectory_lines: List[str],
-):
-    """Generate a single fact caption for a screenshot pair."""
+) -> Tuple[int, bytes, bytes, str]:
+    """Loads the screenshots around step i + 1 and its action, as a transition for the narrator."""
     before_file = os.path.join(task_dir, screenshot_files[i])
     after_file = os.path.join(task_dir, screenshot_files[i + 1])
 
@@ -43,25 +42,19 @@ async def generate_single_fact_caption(
     except Exception as e:
         raise Exception(f"Error reading images: {e}")
 
-    # Generate fact caption using behavior narrator
-    result = await asyncio.to_thread(
-        judge.judge,
-        screenshot_num=i + 1,
-        before_img_bytes=before_bytes,
-        after_img_bytes=after_bytes,
-        pyautogui_action=pyautogui_action,
-    )
-    result["screenshot_num"] = i + 1
-
-    return result
+    return i + 1, before_bytes, after_bytes, pyautogui_action
 
 
 async def generate_fact_captions_parallel(
     task_dir: str,
     judge: BehaviorNarrator,
-    step_semaphore: Optional[asyncio.Semaphore] = None,
+    max_in_flight: Optional[int] = None,
 ):
-    """Generate fact captions for a task directory when they don't exist (parallelized version)."""
+    """Generate fact captions for a task directory when they don't exist.
+
+    The steps of the task are narrated in one batch (BehaviorNarrator.ajudge_many), with at most
+    max_in_flight requests outstanding, so that a self-hosted server can batch them.
+    """
     print(f"Generating fact captions for {task_dir}...")
 
     # Find all screenshot files
@@ -93,61 +86,51 @@ async def generate_fact_captions_parallel(
         except:
             pass
 
-    # Use shared semaphore to limit concurrent judge calls
-    if step_semaphore is None:
-        step_semaphore = asyncio.Semaphore(5)  # Default limit
-
-    async def bounded_task(task_func, *args, **kwargs):
-        async with step_semaphore:
-            return await task_func(*args, **kwargs)
+    transitions = []
+    for i in range(len(screenshot_files) - 1):
+        try:
+            transitions.append(
+                load_transition(task_dir, screenshot_files, i, trajectory_lines)
+            )
+        except Exception as e:
+            print(f"Error generating fact caption for step {i+1}: {e}")
 
     try:
-        # Create bounded tasks for parallel execution
-        bounded_tasks = [
-            bounded_task(
-                generate_single_fact_caption,
-                task_dir,
-                screenshot_files,
-                i,
-                judge,
-                trajectory_lines,
-            )
-            for i in range(len(screenshot_files) - 1)
-        ]
-        results = await asyncio.gather(*bounded_tasks, return_exceptions=True)
+        results = await judge.ajudge_many(transitions, max_in_flight=max_in_flight)
     except Exception as e:
-        print(f"Error in parallel execution: {e}")
+        print(f"Error in batched execution: {e}")
         return []
 
     # Process results and save to file
     fact_captions = []
-    successful_results = []
     fact_captions_file = os.path.join(task_dir, "fact_captions.jsonl")
 
-    for i, result in enumerate(results):
-        if isinstance(result, Exception):
-            print(f"Error generating fact caption for step {i+1}: {result}")
-            continue
-        successful_results.append(result)
-        fact_caption = f"Fact Caption from Screenshot {result['screenshot_num']}: {result['fact_answer']}"
+    for (screenshot_num, _, _, _), result in zip(transitions, results):
+        result["screenshot_num"] = screenshot_num
+        fact_caption = (
+            f"Fact Caption from Screenshot {screenshot_num}: {result['fact_answer']}"
+        )
         fact_captions.append(fact_caption)
 
     # Save all results to file at once
-    if successful_results:
+    if results:
         with open(fact_captions_file, "w") as f:
-            for result in successful_results:
+            for result in results:
                 f.write(json.dumps(result) + "\n")
 
     print(f"Generated {len(fact_captions)} fact captions for {task_dir}")
     return fact_captions
 
 
-async def main(engine_params: dict, results_dirs: List[str]):
+async def main(
+    engine_params: dict, results_dirs: List[str], max_in_flight: Optional[int] = None
+):
     """Main function to generate fact captions for multiple task directories.
 
     Args:
         engine_params: Engine parameters for BehaviorNarrator
         results_dirs: List of results directories to analyze for task classification
+        max_in_flight: Bound on the concurrent narrator requests of each task directory
     """
     # Get task IDs automatically using get_new_tasks_classification
     tasks_classification = get_new_tasks_classification(results_dirs)
@@ -157,7 +140,6 @@ async def main(engine_params: dict, results_dirs: List[str]):
     judge = BehaviorNarrator(engine_params=engine_params)
 
     # Get concurrency settings from environment
-    per_step = int(os.getenv("DIFFCAP_PER_STEP_CONCURRENCY", "100"))
     per_taskdir = int(os.getenv("DIFFCAP_PER_TASKDIR_CONCURRENCY", "4"))
 
     # Build list of task directories to process
@@ -185,14 +167,13 @@ async def main(engine_params: dict, results_dirs: List[str]):
     print(f"Scheduling {len(task_dirs)} task directories...")
 
     # Set up semaphores for concurrency control
-    shared_step_semaphore = asyncio.Semaphore(per_step)
     taskdir_semaphore = asyncio.Semaphore(per_taskdir)
 
     async def run_one(task_dir):
         async with taskdir_semaphore:
             print(f"Processing {task_dir}")
             return await generate_fact_captions_parallel(
-                task_dir, judge, step_semaphore=shared_step_semaphore
+                task_dir, judge, max_in_flight=max_in_flight
             )
 
     # Execute all tasks in parallel
@@ -208,6 +189,7 @@ async def main(engine_params: dict, results_dirs: List[str]):
         )
     else:
         print("Completed all task directories successfully.")
+    print(f"Narrator request dedup: {judge.judge_agent.single_flight.stats()}")
 
 
 if __name__ == "__main__":
@@ -227,6 +209,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "--temperature", type=float, default=1.0, help="Temperature for generation"
     )
+    parser.add_argument(
+        "--response-cache",
+        default=None,
+        help="Directory of an on-disk response cache (only used with --temperature 0)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=None,
+        help="Concurrent narrator requests per task directory, the engine's default if unset",
+    )
 
     args = parser.parse_args()
 
@@ -235,7 +228,8 @@ if __name__ == "__main__":
         "model": args.model,
         "engine_type": args.engine_type,
         "temperature": args.temperature,
+        "response_cache": args.response_cache,
     }
 
     print(f"Results directories: {args.results_dirs}")
-    asyncio.run(main(engine_params, args.results_dirs))
+    asyncio.run(main(engine_params, args.results_dirs, args.max_in_flight))
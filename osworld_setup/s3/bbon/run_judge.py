@@ -2,7 +2,6 @@ import json
 import os
 import asyncio
 import argparse
-import concurrent.futures
 from typing import List, Tuple, Optional
 from dotenv import load_dotenv
 from tqdm.asyncio import tqdm_asyncio
@@ -18,6 +17,16 @@ from utils import (
 from gui_agents.s3.bbon.comparative_judge import ComparativeJudge
 
 
+def load_all_fact_captions(task: str, result_dirs: List[str]) -> List[List[str]]:
+    """Load the fact captions of every trajectory for a task."""
+    all_fact_captions = []
+    for result_dir in result_dirs:
+        task_dir = os.path.join(result_dir, task.split("/")[0], task.split("/")[1])
+        fact_captions = load_facts(task_dir)
+        all_fact_captions.append(fact_captions)
+    return all_fact_captions
+
+
 def run_judge(
     task: str, task_instruction: str, result_dirs: List[str], judge: ComparativeJudge
 ) -> Tuple[str, str, Optional[str]]:
@@ -25,28 +34,13 @@ def run_judge(
     Fact captions + initial/final screenshots judging.
     Pipeline: load trajectories → load existing fact captions → include initial/final screenshots → judge.
     """
-    # 1. Use provided task instruction
-    # task_instruction is now a direct input parameter
-
-    # 2. Load fact captions for all trajectories
-    all_fact_captions = []
-    for result_dir in result_dirs:
-        task_dir = os.path.join(result_dir, task.split("/")[0], task.split("/")[1])
-        fact_captions = load_facts(task_dir)
-        all_fact_captions.append(fact_captions)
-
-    # 3. Use the new Judge class method
+    all_fact_captions = load_all_fact_captions(task, result_dirs)
     return judge.judge(task_instruction, task, result_dirs, all_fact_captions)
 
 
-def evaluate_trajectories(
-    task: str, task_instruction: str, result_dirs: List[str], judge: ComparativeJudge
+def make_record(
+    task: str, answer: str, thoughts: str, selected_trajectory: Optional[str]
 ) -> Tuple[str, str, dict]:
-    """Wrapper that runs fact-only MCQ judge and returns results."""
-    answer, thoughts, selected_trajectory = run_judge(
-        task, task_instruction, result_dirs, judge
-    )
-
     record = {
         "selected_trajectory": selected_trajectory,
         "answer": answer,
@@ -57,22 +51,25 @@ def evaluate_trajectories(
     return answer, thoughts, record
 
 
-asyncio.get_event_loop().set_default_executor(
-    concurrent.futures.ThreadPoolExecutor(max_workers=100)
-)
+def evaluate_trajectories(
+    task: str, task_instruction: str, result_dirs: List[str], judge: ComparativeJudge
+) -> Tuple[str, str, dict]:
+    """Wrapper that runs fact-only MCQ judge and returns results."""
+    answer, thoughts, selected_trajectory = run_judge(
+        task, task_instruction, result_dirs, judge
+    )
+    return make_record(task, answer, thoughts, selected_trajectory)
 
 
 async def run_async(
     task: str, task_instruction: str, result_dirs: List[str], judge: ComparativeJudge
 ):
-    """Async wrapper for fact-only MCQ evaluation."""
-    return await asyncio.to_thread(
-        evaluate_trajectories,
-        task=task,
-        task_instruction=task_instruction,
-        result_dirs=result_dirs,
-        judge=judge,
+    """Async fact-only MCQ evaluation, using the judge's native async API."""
+    all_fact_captions = load_all_fact_captions(task, result_dirs)
+    answer, thoughts, selected_trajectory = await judge.ajudge(
+        task_instruction, task, result_dirs, all_fact_captions
     )
+    return make_record(task, answer, thoughts, selected_trajectory)
 
 
 async def evaluate_and_save(
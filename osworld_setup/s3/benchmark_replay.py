@@ -0,0 +1,120 @@
+"""Benchmark AgentS3.predict offline by replaying a recorded task.
+
+Record the model responses of the tasks with run.py --record_responses, which writes them to
+responses.jsonl in the result directory of each example, then run
+
+    python benchmark_replay.py --example_result_dir <results/.../example_id>
+
+to re-run every step on the recorded screenshots with no provider and no VM. Per-step latency then
+only contains the agent's own overhead plus the synthetic --replay_latency.
+"""
+
+import argparse
+import json
+import os
+import time
+
+from gui_agents.s3.agents.agent_s import AgentS3
+from gui_agents.s3.agents.grounding import OSWorldACI
+from gui_agents.s3.core.replay import RECORDING_FILE
+
+
+def load_observations(example_result_dir: str):
+    """Returns the instruction and the screenshots each step was predicted from, in order."""
+    with open(
+        os.path.join(example_result_dir, "instruction.txt"), "r", encoding="utf-8"
+    ) as f:
+        instruction = f.read()
+    screenshot_files = ["step_0.png"]
+    with open(
+        os.path.join(example_result_dir, "traj.jsonl"), "r", encoding="utf-8"
+    ) as f:
+        for line in f:
+            if line.strip():
+                screenshot_files.append(json.loads(line)["screenshot_file"])
+    screenshots = []
+    # The screenshot after the last step was never predicted from
+    for screenshot_file in screenshot_files[:-1]:
+        with open(os.path.join(example_result_dir, screenshot_file), "rb") as f:
+            screenshots.append(f.read())
+    return instruction, screenshots
+
+
+def main(args):
+    instruction, screenshots = load_observations(args.example_result_dir)
+    engine_params = {
+        "engine_type": "replay",
+        "replay_path": args.replay_path
+        or os.path.join(args.example_result_dir, RECORDING_FILE),
+        "replay_by": args.replay_by,
+        "replay_latency": (
+            "recorded"
+            if args.replay_latency == "recorded"
+            else float(args.replay_latency)
+        ),
+    }
+    engine_params_for_grounding = {
+        **engine_params,
+        "grounding_width": args.grounding_width,
+        "grounding_height": args.grounding_height,
+    }
+    grounding_agent = OSWorldACI(
+        env=None,
+        platform="linux",
+        engine_params_for_generation=engine_params,
+        engine_params_for_grounding=engine_params_for_grounding,
+        width=args.screen_width,
+        height=args.screen_height,
+    )
+    agent = AgentS3(engine_params, grounding_agent, platform="linux")
+
+    step_times = []
+    for step_idx, screenshot in enumerate(screenshots):
+        start = time.time()
+        info, actions = agent.predict(instruction, {"screenshot": screenshot})
+        step_times.append(time.time() - start)
+        print(
+            f"Step {step_idx + 1}: {step_times[-1]:.3f}s, "
+            f"{info['usage']['total']['calls']} calls, action: {actions[0][:80]!r}"
+        )
+
+    print(
+        f"{len(step_times)} steps in {sum(step_times):.3f}s "
+        f"(mean {sum(step_times) / max(len(step_times), 1):.3f}s, max {max(step_times, default=0):.3f}s)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded task to benchmark AgentS3.predict offline"
+    )
+    parser.add_argument(
+        "--example_result_dir",
+        type=str,
+        required=True,
+        help="Result directory of one example, with instruction.txt, traj.jsonl and the screenshots",
+    )
+    parser.add_argument(
+        "--replay_path",
+        type=str,
+        default=None,
+        help="Responses recorded with run.py --record_responses, by default the example's responses.jsonl",
+    )
+    parser.add_argument(
+        "--replay_by",
+        type=str,
+        default="index",
+        choices=["index", "fingerprint"],
+        help="Match responses by call order per agent or by identical request",
+    )
+    parser.add_argument(
+        "--replay_latency",
+        type=str,
+        default="0",
+        help="Synthetic latency per call in seconds, or 'recorded'",
+    )
+    parser.add_argument("--screen_width", type=int, default=1920)
+    parser.add_argument("--screen_height", type=int, default=1080)
+    parser.add_argument("--grounding_width", type=int, default=1920)
+    parser.add_argument("--grounding_height", type=int, default=1080)
+    main(parser.parse_args())
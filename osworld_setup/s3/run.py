@@ -103,6 +103,7 @@ def run_env_tasks(
                 snapshot_name = None
         from gui_agents.s3.agents.agent_s import AgentS3
         from gui_agents.s3.agents.grounding import OSWorldACI
+        from gui_agents.s3.core.replay import RECORDING_FILE, ResponseRecorder
 
         env = DesktopEnv(
             path_to_vm=args.path_to_vm,
@@ -156,6 +157,11 @@ def run_env_tasks(
                     example_id,
                 )
                 os.makedirs(example_result_dir, exist_ok=True)
+                if engine_params.get("record_path"):
+                    # One recording per example, so that its call indices are its own
+                    ResponseRecorder.for_path(engine_params["record_path"]).switch(
+                        os.path.join(example_result_dir, RECORDING_FILE)
+                    )
                 logger.info(f"[{current_process().name}][Domain]: {domain}")
                 logger.info(f"[{current_process().name}][Example ID]: {example_id}")
                 logger.info(f"[{current_process().name}][Instruction]: {instruction}")
@@ -318,6 +324,25 @@ def config() -> argparse.Namespace:
         default=None,
         help="Temperature to fix the generation model at (e.g. o3 can only be run with 1.0)",
     )
+    parser.add_argument(
+        "--model_stream",
+        action="store_true",
+        default=False,
+        help="Stream the main generation model and stop once the action code block is complete",
+    )
+
+    parser.add_argument(
+        "--model_rate_limit",
+        type=int,
+        default=-1,
+        help="Requests/min budget for the main generation model, shared by all env processes (-1 for unlimited)",
+    )
+    parser.add_argument(
+        "--model_token_rate_limit",
+        type=int,
+        default=-1,
+        help="Tokens/min budget for the main generation model, shared by all env processes (-1 for unlimited)",
+    )
 
     # grounding model config
     parser.add_argument(
@@ -327,7 +352,10 @@ def config() -> argparse.Namespace:
         help="The provider for the grounding model",
     )
     parser.add_argument(
-        "--ground_url", type=str, required=True, help="The URL of the grounding model"
+        "--ground_url",
+        type=str,
+        required=True,
+        help="The URL of the grounding model (vllm/huggingface: comma-separated replicas are load-balanced)",
     )
     parser.add_argument(
         "--ground_api_key",
@@ -354,6 +382,60 @@ def config() -> argparse.Namespace:
         help="Height of screenshot image after processor rescaling",
     )
 
+    parser.add_argument(
+        "--ground_rate_limit",
+        type=int,
+        default=-1,
+        help="Requests/min budget for the grounding model, shared by all env processes (-1 for unlimited)",
+    )
+    parser.add_argument(
+        "--ground_token_rate_limit",
+        type=int,
+        default=-1,
+        help="Tokens/min budget for the grounding model, shared by all env processes (-1 for unlimited)",
+    )
+    parser.add_argument(
+        "--record_responses",
+        action="store_true",
+        help="Record the model responses of each example to responses.jsonl in its result directory, for replay with benchmark_replay.py",
+    )
+    parser.add_argument(
+        "--model_hedge_after",
+        type=float,
+        default=None,
+        help="Seconds after which a slow main model call is duplicated, taking the first response",
+    )
+    parser.add_argument(
+        "--ground_hedge_after",
+        type=float,
+        default=None,
+        help="Seconds after which a slow grounding call is duplicated, taking the first response",
+    )
+    parser.add_argument(
+        "--ground_response_cache",
+        type=str,
+        default=None,
+        help="Directory of an on-disk cache of grounding responses, reused when re-running tasks",
+    )
+    parser.add_argument(
+        "--ground_coarse_to_fine",
+        action="store_true",
+        help="Ground on a downscaled screenshot first, then refine on a full resolution crop. Requires --ground_coordinates",
+    )
+    parser.add_argument(
+        "--ground_coordinates",
+        type=str,
+        default=None,
+        choices=["normalized", "pixel"],
+        help="Whether the grounding model answers in grounding_width x grounding_height space or in pixels of the image it is shown (e.g. UI-TARS)",
+    )
+    parser.add_argument(
+        "--image_policies",
+        type=json.loads,
+        default=None,
+        help='Per-agent image encoding as JSON, e.g. \'{"reflection": {"format": "jpeg", "quality": 70, "max_dim": 960}}\'',
+    )
+
     args = parser.parse_args()
 
     return args
@@ -365,12 +447,25 @@ def test(args: argparse.Namespace, test_all_meta: dict) -> None:
     all_tasks = distribute_tasks(test_all_meta)
     logger.info(f"Total tasks: {len(all_tasks)}")
 
+    record_path = None
+    if args.record_responses:
+        from gui_agents.s3.core.replay import RECORDING_FILE
+
+        # Switched to the result directory of each example before it starts
+        record_path = os.path.join(args.result_dir, RECORDING_FILE)
+
     engine_params = {
         "engine_type": args.model_provider,
         "model": args.model,
         "base_url": getattr(args, "model_url", ""),
         "api_key": getattr(args, "model_api_key", ""),
         "temperature": getattr(args, "model_temperature", None),
+        "stream": getattr(args, "model_stream", False),
+        "rate_limit": args.model_rate_limit,
+        "token_rate_limit": args.model_token_rate_limit,
+        "hedge_after": args.model_hedge_after,
+        "record_path": record_path,
+        "image_policies": args.image_policies,
     }
     engine_params_for_grounding = {
         "engine_type": args.ground_provider,
@@ -379,6 +474,14 @@ def test(args: argparse.Namespace, test_all_meta: dict) -> None:
         "api_key": getattr(args, "ground_api_key", ""),
         "grounding_width": args.grounding_width,
         "grounding_height": args.grounding_height,
+        "rate_limit": args.ground_rate_limit,
+        "token_rate_limit": args.ground_token_rate_limit,
+        "response_cache": args.ground_response_cache,
+        "hedge_after": args.ground_hedge_after,
+        "record_path": record_path,
+        "image_policies": args.image_policies,
+        "coarse_to_fine": args.ground_coarse_to_fine,
+        "grounding_coordinates": args.ground_coordinates,
     }
 
     with Manager() as manager:
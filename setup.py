@@ -32,7 +32,10 @@ setup(
         'pywinauto; platform_system == "Windows"',  # Only for Windows
         'pywin32; platform_system == "Windows"',  # Only for Windows
     ],
-    extras_require={"dev": ["black"]},  # Code formatter for linting
+    extras_require={
+        "dev": ["black"],  # Code formatter for linting
+        "ocr": ["tesserocr"],  # In-process Tesseract, see gui_agents/s3/utils/ocr.py
+    },
     entry_points={
         "console_scripts": [
             "agent_s=gui_agents.s3.cli_app:main",
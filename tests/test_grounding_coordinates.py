@@ -0,0 +1,116 @@
+"""Grounds a known point through OSWorldACI in both grounding coordinate modes.
+
+The grounding model is replaced by one that finds a red marker in the image it is sent and
+answers either in pixels of that image or in grounding_width x grounding_height space.
+"""
+
+import base64
+import unittest
+from io import BytesIO
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+from gui_agents.s3.agents.grounding import OSWorldACI
+from gui_agents.s3.core.blobs import materialize
+
+SCREEN_SIZE = (1920, 1080)
+# Center of the marker in screen pixels
+TARGET = (1500, 250)
+# Grounding space of the normalized model, unrelated to the image sizes
+NORMALIZED_SIZE = (1000, 1000)
+
+
+def screenshot() -> bytes:
+    image = np.full((SCREEN_SIZE[1], SCREEN_SIZE[0], 3), 255, dtype=np.uint8)
+    x, y = TARGET
+    image[y - 8 : y + 8, x - 8 : x + 8] = (255, 0, 0)
+    output = BytesIO()
+    Image.fromarray(image).save(output, format="PNG")
+    return output.getvalue()
+
+
+def sent_image(messages) -> Image.Image:
+    for part in materialize(messages)[-1]["content"]:
+        if part["type"] == "image_url":
+            data = part["image_url"]["url"].split("base64,", 1)[1]
+            return Image.open(BytesIO(base64.b64decode(data))).convert("RGB")
+    raise AssertionError("No image in the grounding request")
+
+
+def fake_model(mode):
+    def get_responses(agent, list_of_messages):
+        responses = []
+        for messages in list_of_messages:
+            image = sent_image(messages)
+            pixels = np.asarray(image).astype(int)
+            red = (pixels[..., 0] > 200) & (pixels[..., 1] < 80) & (pixels[..., 2] < 80)
+            ys, xs = np.nonzero(red)
+            x, y = xs.mean(), ys.mean()
+            if mode == "normalized":
+                x = x * NORMALIZED_SIZE[0] / image.width
+                y = y * NORMALIZED_SIZE[1] / image.height
+            responses.append(f"({round(x)}, {round(y)})")
+        return responses
+
+    return get_responses
+
+
+class GroundingCoordinatesTest(unittest.TestCase):
+    def make_aci(self, mode, coarse_to_fine=True):
+        grounding_size = NORMALIZED_SIZE if mode == "normalized" else SCREEN_SIZE
+        engine_params = {
+            "engine_type": "openai",
+            "model": "test",
+            "base_url": "http://127.0.0.1:1/v1",
+            "api_key": "test",
+        }
+        engine_params_for_grounding = {
+            **engine_params,
+            "grounding_width": grounding_size[0],
+            "grounding_height": grounding_size[1],
+            "grounding_coordinates": mode,
+            "coarse_to_fine": coarse_to_fine,
+        }
+        return OSWorldACI(
+            None,
+            "linux",
+            engine_params,
+            engine_params_for_grounding,
+            width=SCREEN_SIZE[0],
+            height=SCREEN_SIZE[1],
+        )
+
+    def ground(self, aci, mode):
+        with mock.patch.object(
+            OSWorldACI, "_get_responses", staticmethod(fake_model(mode))
+        ):
+            point = aci.generate_coords("the red square", {"screenshot": screenshot()})
+        return aci.resize_coordinates(point)
+
+    def assert_near_target(self, point):
+        self.assertLessEqual(abs(point[0] - TARGET[0]), 2, point)
+        self.assertLessEqual(abs(point[1] - TARGET[1]), 2, point)
+
+    def test_pixel_model_coarse_to_fine(self):
+        self.assert_near_target(self.ground(self.make_aci("pixel"), "pixel"))
+
+    def test_normalized_model_coarse_to_fine(self):
+        self.assert_near_target(self.ground(self.make_aci("normalized"), "normalized"))
+
+    def test_single_stage(self):
+        for mode in ("pixel", "normalized"):
+            with self.subTest(mode=mode):
+                aci = self.make_aci(mode, coarse_to_fine=False)
+                self.assert_near_target(self.ground(aci, mode))
+
+    def test_coarse_to_fine_requires_coordinate_mode(self):
+        with self.assertRaises(ValueError):
+            self.make_aci(None)
+        with self.assertRaises(ValueError):
+            self.make_aci("percent")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Importing the agent and the CLI must stay cheap.
+
+Provider SDKs, OpenCV, OCR and GUI automation are imported when first used, so a fresh
+interpreter importing gui_agents.s3.agents.agent_s or gui_agents.s3.cli_app must not load them.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAZY_MODULES = ("openai", "anthropic", "cv2", "pytesseract", "pyautogui")
+
+# Generous, the imports take a fraction of this on a developer machine
+BUDGET_SECONDS = 5.0
+
+
+def import_in_subprocess(module):
+    """Returns the cumulative import time of module in seconds and the lazy modules it loaded."""
+    code = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    # The CLI opens log files in the working directory
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            cwd=cwd,
+            env=env,
+            check=True,
+        )
+    # Lines read "import time: self [us] | cumulative | imported package"
+    cumulative = None
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative = int(fields[1]) / 1e6
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative, loaded
+
+
+class ImportTimeTest(unittest.TestCase):
+    def check(self, module):
+        cumulative, loaded = import_in_subprocess(module)
+        self.assertEqual(loaded, [], f"{module} imports {loaded} eagerly")
+        self.assertIsNotNone(cumulative, f"No import time reported for {module}")
+        self.assertLess(cumulative, BUDGET_SECONDS)
+
+    def test_agent_s(self):
+        self.check("gui_agents.s3.agents.agent_s")
+
+    def test_cli_app(self):
+        self.check("gui_agents.s3.cli_app")
+
+
+if __name__ == "__main__":
+    unittest.main()